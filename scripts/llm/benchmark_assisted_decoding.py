@@ -0,0 +1,107 @@
+"""
+Compares the latency of the HuggingfaceChatAPI with and without a draft model for assisted decoding on day schedule
+like prompts, and reports the acceptance rate of the drafted tokens, e.g.
+
+    python benchmark_assisted_decoding.py --model-id Qwen/Qwen3-4B-Instruct-2507 --assistant-model-id Qwen/Qwen3-0.6B
+"""
+import argparse
+import json
+
+from llm.huggingface_chat_api import HuggingfaceChatAPI
+
+PERSONAS = [
+    'a 34 year old nurse living in Wedding who works in shifts',
+    'a 71 year old retired teacher without a car',
+    'a 19 year old student commuting to the TU Berlin',
+    'a 45 year old craftsman with two children and a van',
+]
+
+
+def get_prompts(num_prompts):
+    return [f'Plan a realistic Monday of {PERSONAS[index % len(PERSONAS)]} (person {index}).\n'
+            f'Only provide a RFC8259 compliant JSON response following this format without deviation.\n'
+            f'{{"day_schedule":[{{"time":"HH:MM","action":"what the person does","building_type":"kind of place"}}]}}\n'
+            f'The JSON Response:\n'
+            for index in range(num_prompts)]
+
+
+def get_day_schedule_schema():
+    return {
+        'type': 'object',
+        'properties': {
+            'day_schedule': {
+                'type': 'array',
+                'items': {
+                    'type': 'object',
+                    'properties': {
+                        'time': {'type': 'string'},
+                        'action': {'type': 'string'},
+                        'building_type': {'type': 'string'},
+                    },
+                },
+            },
+        },
+    }
+
+
+def benchmark(llm_api, prompts, constrained_decoding):
+    schemas = [get_day_schedule_schema()] * len(prompts) if constrained_decoding else None
+    # the first call includes one-off costs such as the token index of the constraint, it is not measured
+    llm_api.get_completions(prompts[:1], schemas[:1] if schemas else None, stage='WARMUP')
+    if llm_api.assistant_model is not None:
+        llm_api.pop_assisted_decoding_stats()
+    completions = llm_api.get_completions(prompts, schemas, stage='BENCHMARK')
+    metrics = llm_api.metrics.get_summary()['stages']['BENCHMARK']
+    result = {
+        'wall_time': round(metrics['wall_time'], 2),
+        'generated_tokens': metrics['generated_tokens'],
+        'tokens_per_second': round(metrics['tokens_per_second'], 2),
+    }
+    if llm_api.assistant_model is not None:
+        result.update(llm_api.pop_assisted_decoding_stats())
+    return result, completions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark assisted decoding of the HuggingfaceChatAPI.')
+    parser.add_argument('--model-id', default='Qwen/Qwen3-4B-Instruct-2507')
+    parser.add_argument('--assistant-model-id', default='Qwen/Qwen3-0.6B')
+    parser.add_argument('--prompts', type=int, default=8)
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help='batch size without assistant, assisted decoding always runs one prompt at a time')
+    parser.add_argument('--n-predict', type=int, default=400)
+    parser.add_argument('--constrained-decoding', action='store_true')
+    parser.add_argument('--output', default=None, help='optional path of a JSON file for the results')
+    args = parser.parse_args()
+
+    prompts = get_prompts(args.prompts)
+    baseline_api = HuggingfaceChatAPI(model_id=args.model_id, n_predict=args.n_predict, batch_size=args.batch_size,
+                                      constrained_decoding=args.constrained_decoding)
+    baseline, baseline_completions = benchmark(baseline_api, prompts, args.constrained_decoding)
+    baseline_api = None
+
+    assisted_api = HuggingfaceChatAPI(model_id=args.model_id, n_predict=args.n_predict,
+                                      constrained_decoding=args.constrained_decoding,
+                                      assistant_model_id=args.assistant_model_id)
+    assisted, assisted_completions = benchmark(assisted_api, prompts, args.constrained_decoding)
+
+    results = {
+        'baseline': baseline,
+        'assisted': assisted,
+        'speedup': round(baseline['wall_time'] / assisted['wall_time'], 2) if assisted['wall_time'] else 0.0,
+        # greedy decoding gives the same completions with and without assistant, up to numerical differences
+        'identical_completions': sum(first == second for first, second in zip(baseline_completions,
+                                                                               assisted_completions)),
+    }
+    print(f'baseline: {baseline["tokens_per_second"]:>8.2f} tokens/s | {baseline["wall_time"]:>7.2f}s')
+    print(f'assisted: {assisted["tokens_per_second"]:>8.2f} tokens/s | {assisted["wall_time"]:>7.2f}s | '
+          f'{assisted["acceptance_rate"]:.1%} of {assisted["draft_tokens"]} drafted tokens accepted')
+    print(f'speedup: {results["speedup"]:.2f}x, {results["identical_completions"]}/{len(prompts)} identical completions')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
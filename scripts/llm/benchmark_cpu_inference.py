@@ -0,0 +1,90 @@
+"""
+Compares the CPU generation throughput (generated tokens/s) of the HuggingfaceChatAPI across dtypes, attention
+implementations, torch.compile and thread counts, e.g.
+
+    python benchmark_cpu_inference.py --model-id Qwen/Qwen3-4B-Instruct-2507 --threads 4 8 --prompts 16
+"""
+import argparse
+import json
+import time
+
+import torch
+
+from llm.huggingface_chat_api import HuggingfaceChatAPI
+from module.profile.prompt.description import get_description_schema
+
+SETTINGS = {
+    'float32': {'cpu_dtype': 'float32'},
+    'float32_sdpa': {'cpu_dtype': 'float32', 'attn_implementation': 'sdpa'},
+    'bfloat16_sdpa': {'cpu_dtype': 'bfloat16', 'attn_implementation': 'sdpa'},
+    'int8_sdpa': {'cpu_dtype': 'int8', 'attn_implementation': 'sdpa'},
+    'bfloat16_sdpa_compiled': {'cpu_dtype': 'bfloat16', 'attn_implementation': 'sdpa', 'compile_model': True},
+}
+
+PERSONAS = [
+    'a 34 year old nurse living in Wedding who works in shifts',
+    'a 71 year old retired teacher without a car',
+    'a 19 year old student commuting to the TU Berlin',
+    'a 45 year old craftsman with two children and a van',
+]
+
+
+def get_prompts(num_prompts):
+    return [f'Write a realistic one paragraph description of {PERSONAS[index % len(PERSONAS)]} (person {index}).\n'
+            f'Only provide a RFC8259 compliant JSON response following this format without deviation.\n'
+            f'{{"persona_description":"realistic one paragraph description"}}\n'
+            f'The JSON Response:\n'
+            for index in range(num_prompts)]
+
+
+def benchmark(model_id, setting, threads, prompts, batch_size, n_predict, constrained_decoding):
+    torch.set_num_threads(threads)
+    load_start = time.perf_counter()
+    llm_api = HuggingfaceChatAPI(model_id=model_id, n_predict=n_predict, batch_size=batch_size,
+                                 constrained_decoding=constrained_decoding, **SETTINGS[setting])
+    load_time = time.perf_counter() - load_start
+
+    schemas = [get_description_schema()] * len(prompts)
+    # the first call includes one-off costs such as compilation, it is not measured
+    llm_api.get_completions(prompts[:1], schemas[:1], stage='WARMUP')
+    llm_api.get_completions(prompts, schemas, stage='BENCHMARK')
+    metrics = llm_api.metrics.get_summary()['stages']['BENCHMARK']
+    return {
+        'setting': setting,
+        'threads': threads,
+        'load_time': round(load_time, 2),
+        'wall_time': round(metrics['wall_time'], 2),
+        'generated_tokens': metrics['generated_tokens'],
+        'tokens_per_second': round(metrics['tokens_per_second'], 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark CPU inference settings of the HuggingfaceChatAPI.')
+    parser.add_argument('--model-id', default='Qwen/Qwen3-4B-Instruct-2507')
+    parser.add_argument('--settings', nargs='+', default=list(SETTINGS.keys()), choices=list(SETTINGS.keys()))
+    parser.add_argument('--threads', nargs='+', type=int, default=[torch.get_num_threads()])
+    parser.add_argument('--prompts', type=int, default=8)
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--n-predict', type=int, default=128)
+    parser.add_argument('--constrained-decoding', action='store_true')
+    parser.add_argument('--output', default=None, help='optional path of a JSON file for the results')
+    args = parser.parse_args()
+
+    prompts = get_prompts(args.prompts)
+    results = []
+    for threads in args.threads:
+        for setting in args.settings:
+            result = benchmark(args.model_id, setting, threads, prompts, args.batch_size, args.n_predict,
+                               args.constrained_decoding)
+            print(f'{result["setting"]:>24} | {result["threads"]:>3} threads | '
+                  f'{result["tokens_per_second"]:>8.2f} tokens/s | {result["wall_time"]:>7.2f}s')
+            results.append(result)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
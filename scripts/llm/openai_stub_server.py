@@ -0,0 +1,77 @@
+"""
+Minimal OpenAI compatible chat completion server for trying the 'openai' LLM backend without a GPU.
+
+Answers every request with the smallest response that is valid for its 'response_format' JSON schema (or a fixed
+persona description if there is none). With --failure-rate a share of the requests is answered with HTTP 503 to
+exercise the retries of the client.
+
+    python openai_stub_server.py --port 8000
+"""
+import argparse
+import json
+import random
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def get_instance(schema):
+    if 'const' in schema:
+        return schema['const']
+    if 'enum' in schema:
+        return schema['enum'][0]
+    schema_type = schema.get('type')
+    if schema_type == 'object':
+        return {name: get_instance(property_schema) for name, property_schema in schema.get('properties', {}).items()}
+    if schema_type == 'array':
+        if 'prefixItems' in schema:
+            return [get_instance(item) for item in schema['prefixItems']]
+        return [get_instance(schema['items'])] * max(1, schema.get('minItems', 1))
+    return 'stub'
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    failure_rate = 0.0
+
+    def do_POST(self):
+        if not self.path.endswith('/chat/completions'):
+            self.send_error(404)
+            return
+        if random.random() < self.failure_rate:
+            self.send_error(503, 'Stub failure')
+            return
+
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        response_format = request.get('response_format')
+        if response_format and response_format.get('type') == 'json_schema':
+            content = json.dumps(get_instance(response_format['json_schema']['schema']))
+        else:
+            content = json.dumps({'persona_description': 'A stub persona living in Berlin.'})
+
+        choices = [{'index': index, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}
+                   for index in range(request.get('n', 1))]
+        body = json.dumps({'object': 'chat.completion', 'model': request.get('model'), 'choices': choices})
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body.encode('utf-8'))))
+        self.end_headers()
+        self.wfile.write(body.encode('utf-8'))
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    StubHandler.failure_rate = args.failure_rate
+    server = ThreadingHTTPServer((args.host, args.port), StubHandler)
+    print(f'Serving stub chat completions on http://{args.host}:{args.port}/v1')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
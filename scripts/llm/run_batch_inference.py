@@ -0,0 +1,81 @@
+"""
+Answers the request files the offline backend wrote (see llm/offline_batch.py) with a real backend, independently of
+the pipeline. Every request file gets a response file of the same name, so the runner can be stopped and restarted
+at any time and several runners can share the files, e.g. one per GPU:
+
+    python run_batch_inference.py --config config_berlin_sumo --shard 0 --num-shards 2 --device-id 0
+    python run_batch_inference.py --config config_berlin_sumo --shard 1 --num-shards 2 --device-id 1
+
+Afterwards the pipeline is run again with load_from_storage, it ingests the responses into its completion cache.
+"""
+import argparse
+import json
+import os
+import zlib
+
+import config.config as configs
+from llm.inference_pool import get_llm_api
+from llm.offline_batch import DEFAULT_OFFLINE_PATH, get_pending_request_files, get_requests_folder, \
+    get_responses_folder, read_jsonl, write_jsonl
+from util.logging import log_info, log_warning
+
+
+def get_config_stage(stage, llm_config):
+    """Returns the entry of llm_config['stages'] a recorded stage belongs to, e.g. DAY_SCHEDULE for its repairs."""
+    return next((name for name in (llm_config.get('stages') or {}) if (stage or '').startswith(name)), None)
+
+
+def answer_requests(requests, llm_config, backend, device_id):
+    """Generates the completions of the requests of one file, which all come from one call of the offline backend."""
+    stage = requests[0]['stage']
+    llm_api = get_llm_api(device_id, {**llm_config, 'backend': backend, 'cache_path': None, 'metrics_path': None},
+                          stage=get_config_stage(stage, llm_config))
+    if llm_api.model_id != requests[0]['model_id']:
+        log_warning(f'[OFFLINE] The requests of {stage} were written for {requests[0]["model_id"]}, but are answered '
+                    f'by {llm_api.model_id}.')
+    llm_api.system_prompt = requests[0]['system_prompt']
+
+    prompts = [request['prompt'] for request in requests]
+    schemas = [request['schema'] for request in requests]
+    schemas = schemas if any(schema is not None for schema in schemas) else None
+    if 'num_return_sequences' in requests[0]:
+        sampled_completions = llm_api.get_sampled_completions(
+            prompts, [request['num_return_sequences'] for request in requests], schemas, stage=stage)
+        responses = [json.dumps(completions, ensure_ascii=False) for completions in sampled_completions]
+    else:
+        # failed generations are left unanswered, the next run of the pipeline requests them again
+        responses = [completion or None for completion in llm_api.get_completions(prompts, schemas, stage=stage)]
+    return [{'custom_id': request['custom_id'], 'response': response} for request, response in zip(requests, responses)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Answer the request files of the offline LLM backend.')
+    parser.add_argument('--config', default='config_berlin_sumo', help='name of the config in config/config.py')
+    parser.add_argument('--offline-path', default=None,
+                        help=f'folder of the request files, defaults to offline_path of the llm config or '
+                             f'{DEFAULT_OFFLINE_PATH}')
+    parser.add_argument('--backend', default='huggingface', help='backend that answers the requests')
+    parser.add_argument('--device-id', type=int, default=0)
+    parser.add_argument('--shard', type=int, default=0, help='index of the share of request files to answer')
+    parser.add_argument('--num-shards', type=int, default=1)
+    args = parser.parse_args()
+
+    llm_config = getattr(configs, args.config)['llm']
+    offline_path = args.offline_path or llm_config.get('offline_path', DEFAULT_OFFLINE_PATH)
+    os.makedirs(get_responses_folder(offline_path), exist_ok=True)
+
+    # the shards are assigned by the file names, as the set of pending files shrinks while the runners work
+    request_files = [file_name for file_name in get_pending_request_files(offline_path)
+                     if zlib.crc32(file_name.encode('utf-8')) % args.num_shards == args.shard]
+    log_info(f'[OFFLINE] Answering {len(request_files)} request files of shard {args.shard}/{args.num_shards}.')
+    for count, file_name in enumerate(request_files):
+        if os.path.exists(os.path.join(get_responses_folder(offline_path), file_name)):
+            continue
+        requests = read_jsonl(os.path.join(get_requests_folder(offline_path), file_name))
+        responses = answer_requests(requests, llm_config, args.backend, args.device_id) if requests else []
+        write_jsonl(os.path.join(get_responses_folder(offline_path), file_name), responses)
+        log_info(f'[OFFLINE] {count + 1}/{len(request_files)} {file_name}: {len(responses)} responses.')
+
+
+if __name__ == '__main__':
+    main()
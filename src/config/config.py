@@ -1,3 +1,34 @@
+# LLM inference shared by the configs below. The features that change the completions (constrained_decoding,
+# continuous_batching, prefix_caching, a cpu_dtype other than float32) and the completion cache are off by default.
+config_llm = {
+    'backend': 'huggingface',
+    'model_id': 'Qwen/Qwen3-4B-Instruct-2507',
+    'batch_size': 16,
+    # replays the stored completion of a prompt on reruns instead of generating (sampling) it again, e.g.
+    # 'cache_path': 'cache/llm_completions.sqlite', 'cache_max_entries': 2000000,
+    'cache_path': None,
+    'constrained_decoding': False,
+    'stop_at_json_end': True,
+    'continuous_batching': False,
+    # requires continuous_batching, moves the persona behind the static instructions of a stage to share their prefill
+    'prefix_caching': False,
+    # requires continuous_batching, reuses the encoded persona (which leads the schedule and mode choice prompts) across
+    # the stages instead of sharing the static instructions of a stage
+    'agent_prefix_caching': False,
+    'agent_prefix_cache_path': 'cache/agent_prefixes',
+    # Qwen3-4B keeps 144 KiB per token in bfloat16 (36 layers * 8 KV heads * 128 dims * 2 (keys, values) * 2 bytes),
+    # so the offloaded persona of a few hundred tokens takes tens of MB, i.e. this keeps the last ~800 agents used
+    'agent_prefix_cache_max_bytes': 32 * 1024 ** 3,
+    # only used without CUDA, 'bfloat16' or 'int8' halve or quarter the memory
+    'cpu_dtype': 'float32',
+    'attn_implementation': 'sdpa',
+    # a small draft model of the same family for assisted decoding of the listed stages, one prompt at a time, e.g.
+    # 'assistant_model_id': 'Qwen/Qwen3-0.6B', 'assistant_stages': ['DAY_SCHEDULE'],
+    # per stage overrides of the entries above ('DESCRIPTION', 'DAY_SCHEDULE', 'ROUTE_DECISIONS'), e.g.
+    # 'ROUTE_DECISIONS': {'model_id': 'Qwen/Qwen3-1.7B'} for a smaller mode choice model
+    'stages': {},
+}
+
 config_minimal = {
     'workers': 1,
     'num_agents': 8,
@@ -13,7 +44,23 @@ config_minimal = {
     'census_file': 'data/census/B1_Standard-Datensatzpaket/CSV/MiD2017_Personen.csv',
     'day': 'Monday',
     'exclude_too_young': True,
-    'exclude_too_old': False
+    'exclude_too_old': False,
+    'deduplicate_seeds': True,
+    'max_repair_attempts': 2,
+    'mode_choice_pack_size': 4,
+    # 'generate' (reasoning and mode as JSON), 'logprob' (most likely mode) or 'logprob_sample' (sampled mode)
+    'mode_choice_strategy': 'generate',
+    'compact_building_categories': True,
+    # agents per task of the worker pools, idle workers pull the next chunk
+    'chunk_size': 64,
+    # chunks of agents move through the stages without waiting for the whole previous stage
+    'streaming_pipeline': True,
+    'pipeline_queue_size': 2,
+    # every finished chunk of a stage is stored, with load_from_storage a rerun resumes after the stored chunks
+    'checkpoint_chunks': True,
+    # chunks raising these (by class name) fail as a whole instead of being split down to single agents
+    'infrastructure_exceptions': ['OutOfMemoryError', 'ConnectionError', 'TimeoutError'],
+    'llm': {**config_llm, 'batch_size': 4},
 }
 
 config_berlin_sumo = {
@@ -32,7 +79,23 @@ config_berlin_sumo = {
     'census_file': 'data/census/B1_Standard-Datensatzpaket/CSV/MiD2017_Personen.csv',
     'day': 'Monday',
     'exclude_too_young': True,
-    'exclude_too_old': False
+    'exclude_too_old': False,
+    'deduplicate_seeds': True,
+    'max_repair_attempts': 2,
+    'mode_choice_pack_size': 4,
+    # 'generate' (reasoning and mode as JSON), 'logprob' (most likely mode) or 'logprob_sample' (sampled mode)
+    'mode_choice_strategy': 'generate',
+    'compact_building_categories': True,
+    # agents per task of the worker pools, idle workers pull the next chunk
+    'chunk_size': 64,
+    # chunks of agents move through the stages without waiting for the whole previous stage
+    'streaming_pipeline': True,
+    'pipeline_queue_size': 2,
+    # every finished chunk of a stage is stored, with load_from_storage a rerun resumes after the stored chunks
+    'checkpoint_chunks': True,
+    # chunks raising these (by class name) fail as a whole instead of being split down to single agents
+    'infrastructure_exceptions': ['OutOfMemoryError', 'ConnectionError', 'TimeoutError'],
+    'llm': {**config_llm},
 }
 
 config_berlin_otp = {
@@ -40,6 +103,10 @@ config_berlin_otp = {
     'num_agents': 35769,
     'load_from_storage': True,
     'storage_path': 'results/baseline-monday-berlin-otp',
+    # agents with location changes the OTP routing starts from, defaults to agents_3_location_changes of storage_path
+    'location_changes_path': 'results/baseline-monday-berlin-sumo/agents_3_location_changes.json',
+    # osm_traffic_simulacra.py keeps the routes stored by an earlier run (e.g. a killed job) instead of routing again
+    'resume_routes': False,
     'buildings_file': 'data/taz/berlin_buildings.gpkg',
     'taz_file': 'data/taz/berlin_taz_zones.gpkg',
     'net_file': 'data/open_street_map/berlin/berlin.net.xml',
@@ -50,7 +117,23 @@ config_berlin_otp = {
     'census_file': 'data/census/B1_Standard-Datensatzpaket/CSV/MiD2017_Personen.csv',
     'day': 'Monday',
     'exclude_too_young': True,
-    'exclude_too_old': False
+    'exclude_too_old': False,
+    'deduplicate_seeds': True,
+    'max_repair_attempts': 2,
+    'mode_choice_pack_size': 4,
+    # 'generate' (reasoning and mode as JSON), 'logprob' (most likely mode) or 'logprob_sample' (sampled mode)
+    'mode_choice_strategy': 'generate',
+    'compact_building_categories': True,
+    # agents per task of the worker pools, idle workers pull the next chunk
+    'chunk_size': 64,
+    # chunks of agents move through the stages without waiting for the whole previous stage
+    'streaming_pipeline': True,
+    'pipeline_queue_size': 2,
+    # every finished chunk of a stage is stored, with load_from_storage a rerun resumes after the stored chunks
+    'checkpoint_chunks': True,
+    # chunks raising these (by class name) fail as a whole instead of being split down to single agents
+    'infrastructure_exceptions': ['OutOfMemoryError', 'ConnectionError', 'TimeoutError'],
+    'llm': {**config_llm},
 }
 
 config_wedding_sumo = {
@@ -68,7 +151,23 @@ config_wedding_sumo = {
     'census_file': 'data/census/B1_Standard-Datensatzpaket/CSV/MiD2017_Personen.csv',
     'day': 'Monday',
     'exclude_too_young': True,
-    'exclude_too_old': False
+    'exclude_too_old': False,
+    'deduplicate_seeds': True,
+    'max_repair_attempts': 2,
+    'mode_choice_pack_size': 4,
+    # 'generate' (reasoning and mode as JSON), 'logprob' (most likely mode) or 'logprob_sample' (sampled mode)
+    'mode_choice_strategy': 'generate',
+    'compact_building_categories': True,
+    # agents per task of the worker pools, idle workers pull the next chunk
+    'chunk_size': 64,
+    # chunks of agents move through the stages without waiting for the whole previous stage
+    'streaming_pipeline': True,
+    'pipeline_queue_size': 2,
+    # every finished chunk of a stage is stored, with load_from_storage a rerun resumes after the stored chunks
+    'checkpoint_chunks': True,
+    # chunks raising these (by class name) fail as a whole instead of being split down to single agents
+    'infrastructure_exceptions': ['OutOfMemoryError', 'ConnectionError', 'TimeoutError'],
+    'llm': {**config_llm},
 }
 
 config_wedding_otp = {
@@ -76,6 +175,10 @@ config_wedding_otp = {
     'num_agents': 8680,
     'load_from_storage': True,
     'storage_path': 'results/baseline-monday-wedding-otp',
+    # agents with location changes the OTP routing starts from, defaults to agents_3_location_changes of storage_path
+    'location_changes_path': 'results/baseline-monday-wedding-sumo/agents_3_location_changes.json',
+    # osm_traffic_simulacra.py keeps the routes stored by an earlier run (e.g. a killed job) instead of routing again
+    'resume_routes': False,
     'buildings_file': 'data/taz/wedding_buildings.gpkg',
     'taz_file': 'data/taz/wedding_taz_zones.gpkg',
     'net_file': 'data/open_street_map/wedding/wedding.net.xml',
@@ -86,5 +189,21 @@ config_wedding_otp = {
     'census_file': 'data/census/B1_Standard-Datensatzpaket/CSV/MiD2017_Personen.csv',
     'day': 'Monday',
     'exclude_too_young': True,
-    'exclude_too_old': False
+    'exclude_too_old': False,
+    'deduplicate_seeds': True,
+    'max_repair_attempts': 2,
+    'mode_choice_pack_size': 4,
+    # 'generate' (reasoning and mode as JSON), 'logprob' (most likely mode) or 'logprob_sample' (sampled mode)
+    'mode_choice_strategy': 'generate',
+    'compact_building_categories': True,
+    # agents per task of the worker pools, idle workers pull the next chunk
+    'chunk_size': 64,
+    # chunks of agents move through the stages without waiting for the whole previous stage
+    'streaming_pipeline': True,
+    'pipeline_queue_size': 2,
+    # every finished chunk of a stage is stored, with load_from_storage a rerun resumes after the stored chunks
+    'checkpoint_chunks': True,
+    # chunks raising these (by class name) fail as a whole instead of being split down to single agents
+    'infrastructure_exceptions': ['OutOfMemoryError', 'ConnectionError', 'TimeoutError'],
+    'llm': {**config_llm},
 }
@@ -0,0 +1,129 @@
+import argparse
+import json
+import os
+
+import pandas as pd
+
+from eval.results_access.mid_survey_results import MidSurveyResults
+from eval.results_access.simulation_results import SimulationResults
+from eval.util.metric import compute_rmse
+
+MODES = ["By foot", "Bicycle", "MIT", "Public Transport"]
+# the metrics of the follow-up calls of a stage (packed, scored and repair prompts) are counted towards the stage
+STAGES = ["DESCRIPTION", "DAY_SCHEDULE", "ROUTE_DECISIONS"]
+
+
+def load_llm_metrics(result_folder):
+    metrics_path = os.path.join(result_folder, 'llm_metrics.json')
+    if not os.path.exists(metrics_path):
+        return {'stages': {}}
+    with open(metrics_path, 'r') as file:
+        return json.load(file)
+
+
+def summarize_stage(llm_metrics, stage):
+    """Sums the metrics of all recorded stages that belong to the given pipeline stage, e.g. ROUTE_DECISIONS_PACKED."""
+    stage_metrics = [metrics for name, metrics in llm_metrics['stages'].items() if name.startswith(stage)]
+    wall_time = sum(metrics['wall_time'] for metrics in stage_metrics)
+    generated_tokens = sum(metrics['generated_tokens'] for metrics in stage_metrics)
+    completions = sum(metrics['completions'] for metrics in stage_metrics)
+    model_ids = sorted({model_id for metrics in stage_metrics for model_id in metrics.get('model_ids', [])})
+    return {
+        'model': ', '.join(model_ids),
+        'wall_time': wall_time,
+        # per worker, as the wall times of the workers are summed up
+        'tokens_per_second': generated_tokens / wall_time if wall_time > 0 else 0.0,
+        'completions_per_second': completions / wall_time if wall_time > 0 else 0.0,
+        'generated_tokens': generated_tokens,
+    }
+
+
+def compare_stage_models(mid: MidSurveyResults, result_folders: dict):
+    """
+    Compares experiments that differ in the models of their stages: the RMSE of their modal split against MiD next to
+    the throughput of every stage. The first experiment is the baseline the speedups are relative to.
+    """
+    mid_modality = MidSurveyResults.standardize_keys(mid.get_modality_split())
+    mid_modality = {mode: mid_modality.get(mode, 0.0) for mode in MODES}
+
+    rows = {}
+    for label, result_folder in result_folders.items():
+        sim = SimulationResults(result_folder)
+        sim_modality = SimulationResults.standardize_keys(sim.calculate_modality_percent())
+        sim_modality = {mode: sim_modality.get(mode, 0.0) for mode in MODES}
+        row = {'Modal split RMSE': compute_rmse(sim_modality, mid_modality)}
+
+        llm_metrics = load_llm_metrics(result_folder)
+        total_wall_time = 0.0
+        for stage in STAGES:
+            stage_summary = summarize_stage(llm_metrics, stage)
+            total_wall_time += stage_summary['wall_time']
+            row[f'{stage} model'] = stage_summary['model']
+            row[f'{stage} tokens/s per worker'] = stage_summary['tokens_per_second']
+            row[f'{stage} completions/s per worker'] = stage_summary['completions_per_second']
+        # wall times are summed over the workers, i.e. they are LLM busy times rather than elapsed times
+        row['LLM time (s)'] = total_wall_time
+        rows[label] = row
+
+    table = pd.DataFrame.from_dict(rows, orient='index')
+    table['Speedup'] = table['LLM time (s)'].iloc[0] / table['LLM time (s)']
+    table['Δ RMSE'] = table['Modal split RMSE'] - table['Modal split RMSE'].iloc[0]
+    return table
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the modal split quality and LLM throughput of runs with different models per stage."
+    )
+    parser.add_argument(
+        '--mid-path',
+        default='../../data/census/B1_Standard-Datensatzpaket/CSV',
+        help='Path to the folder containing MID survey CSV files'
+    )
+    parser.add_argument(
+        '--bland-code',
+        type=int,
+        default=11,
+        help='Bland code to filter survey results'
+    )
+    parser.add_argument(
+        '--sim-base-folder',
+        default='../../results',
+        help='Base folder under which the result folders of the runs live'
+    )
+    parser.add_argument(
+        '--experiments',
+        nargs='+',
+        default=['4B_all_stages', '1.7B_route_decisions'],
+        help='Labels of the runs (space-separated list), the first one is the baseline'
+    )
+    parser.add_argument(
+        '--exp-folders',
+        nargs='+',
+        default=['minimal', 'minimal-small-mode-choice'],
+        help='Corresponding result folder names (storage_path of the run) for each label'
+    )
+    parser.add_argument(
+        '--output-file',
+        default='stage_model_comparison.txt',
+        help='Path to the text file where the table will be written'
+    )
+
+    args = parser.parse_args()
+
+    mid = MidSurveyResults(args.mid_path, args.bland_code)
+    result_folders = {label: os.path.join(args.sim_base_folder, folder)
+                      for label, folder in zip(args.experiments, args.exp_folders)}
+    table = compare_stage_models(mid, result_folders)
+
+    pd.set_option('display.float_format', '{:.2f}'.format)
+    pd.set_option('display.width', 250)
+    with open(args.output_file, 'w') as f:
+        f.write("===== Model per stage: modal split quality vs. throughput =====\n\n")
+        f.write(table.T.to_string())
+        f.write("\n")
+    print(table.T.to_string())
+
+
+if __name__ == '__main__':
+    main()
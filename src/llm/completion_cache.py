@@ -0,0 +1,106 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+
+class CompletionCache:
+    """
+    Persistent, content-addressed cache for LLM completions backed by SQLite.
+    Entries are keyed by a hash over the model id, the generation parameters and the prompt. If the cache grows
+    beyond max_entries, the least recently used entries are evicted. The database can be shared by several worker
+    processes.
+    """
+
+    def __init__(self, cache_path, max_entries=1000000):
+        self.cache_path = cache_path
+        self.max_entries = max_entries
+
+        self.hits = 0
+        self.misses = 0
+
+        cache_folder = os.path.dirname(cache_path)
+        if cache_folder:
+            os.makedirs(cache_folder, exist_ok=True)
+
+        self.connection = sqlite3.connect(cache_path, timeout=120)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS completions ('
+            'key TEXT PRIMARY KEY, '
+            'response TEXT NOT NULL, '
+            'last_access REAL NOT NULL)'
+        )
+        self.connection.execute('CREATE INDEX IF NOT EXISTS completions_last_access ON completions (last_access)')
+        self.connection.commit()
+
+    @staticmethod
+    def get_key(model_id, generation_parameters, prompt):
+        content = json.dumps([model_id, generation_parameters, prompt], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def get_many(self, keys):
+        responses = {}
+        unique_keys = list(set(keys))
+        # SQLite limits the number of host parameters per statement
+        for start in range(0, len(unique_keys), 500):
+            chunk = unique_keys[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            rows = self.connection.execute(f'SELECT key, response FROM completions WHERE key IN ({placeholders})',
+                                           chunk).fetchall()
+            responses.update(rows)
+
+        if responses:
+            now = time.time()
+            with self.connection:
+                self.connection.executemany('UPDATE completions SET last_access = ? WHERE key = ?',
+                                            [(now, key) for key in responses])
+
+        self.hits += sum(1 for key in keys if key in responses)
+        self.misses += sum(1 for key in keys if key not in responses)
+        return responses
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def put_many(self, responses):
+        if not responses:
+            return
+        now = time.time()
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO completions (key, response, last_access) '
+                                        'VALUES (?, ?, ?)',
+                                        [(key, response, now) for key, response in responses.items()])
+        self._evict()
+
+    def put(self, key, response):
+        self.put_many({key: response})
+
+    def delete_many(self, keys):
+        unique_keys = list(set(keys))
+        with self.connection:
+            for start in range(0, len(unique_keys), 500):
+                chunk = unique_keys[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                self.connection.execute(f'DELETE FROM completions WHERE key IN ({placeholders})', chunk)
+
+    def _evict(self):
+        count = self.connection.execute('SELECT COUNT(*) FROM completions').fetchone()[0]
+        overflow = count - self.max_entries
+        if overflow > 0:
+            with self.connection:
+                self.connection.execute('DELETE FROM completions WHERE key IN ('
+                                        'SELECT key FROM completions ORDER BY last_access ASC LIMIT ?)', (overflow,))
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,387 @@
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+import torch
+
+from llm.json_stopping_criteria import JsonObjectTracker
+from llm.kv_cache import build_cache, concat_layers, get_cache_layers, left_pad_layers, select_layer_rows, \
+    trim_layers_left
+from util.logging import log_error
+
+
+class GenerationRequest:
+    def __init__(self, input_ids, schema=None, num_return_sequences=1, temperature=None, top_p=None, prefix_key=None,
+                 agent_prefix_length=0, do_sample=None, top_k=None):
+        self.input_ids = input_ids
+        self.prefix_key = prefix_key
+        self.agent_prefix_length = agent_prefix_length
+        self.store_agent_prefix = False
+        self.schema = schema
+        self.num_return_sequences = num_return_sequences
+        self.temperature = temperature
+        self.top_p = top_p
+        self.top_k = top_k
+        self.do_sample = temperature is not None if do_sample is None else do_sample
+        self.future = Future()
+        self.completions = [None] * num_return_sequences
+        self.remaining_sequences = num_return_sequences
+
+
+class _Sequence:
+    """One row of the running batch, i.e. one of the num_return_sequences sequences of a request."""
+
+    def __init__(self, request, index, grammar, tracker):
+        self.request = request
+        self.index = index
+        self.grammar = grammar
+        self.state = grammar.initial_state() if grammar is not None else None
+        self.tracker = tracker
+        self.generated_ids = []
+        self.finished = False
+
+
+class ContinuousBatchingEngine:
+    """
+    Generates completions with continuous batching: instead of waiting until the longest sequence of a static batch is
+    done, finished sequences leave the running batch after every decoding step and waiting requests are prefilled
+    into the free slots. Short and long completions can therefore share the GPU without idle rows.
+
+    Requests are submitted from any thread and answered through futures, the decoding loop runs in a background
+    thread. The KV cache of the running batch is kept as one left padded tensor per layer, in which the rows of
+    finished sequences are dropped and the rows of admitted sequences are appended.
+
+    With a prefix_cache, admitted requests only prefill the tokens after the cached prefix of their prefix_key, the
+    prefix columns are placed in front of the (left padded) suffixes and masked out in rows without a prefix. The
+    prefix of a single agent (e.g. its persona) is looked up in the agent_prefix_store instead, if it is longer.
+    """
+
+    def __init__(self, model, tokenizer, max_batch_size, max_new_tokens, eos_token_ids, get_token_index=None,
+                 token_strings=None, prefix_cache=None, agent_prefix_store=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_new_tokens = max_new_tokens
+        self.eos_token_ids = set(eos_token_ids)
+        self.get_token_index = get_token_index
+        self.token_strings = token_strings
+        self.prefix_cache = prefix_cache
+        self.agent_prefix_store = agent_prefix_store
+        self.device = model.device
+        self.pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
+
+        self.condition = threading.Condition()
+        self.pending_requests = deque()
+        self.thread = None
+
+        # state of the running batch, only touched by the decoding thread
+        self.sequences = []
+        self.cache_layers = None
+        self.attention_mask = None
+        self.positions = None
+
+        self.stats_lock = threading.Lock()
+        self.early_stopping_stats = {'stopped_sequences': 0, 'saved_tokens': 0}
+        self.batch_stats = self._get_empty_batch_stats()
+
+    def submit(self, text, schema=None, num_return_sequences=1, temperature=None, top_p=None, prefix_key=None,
+               agent_prefix=None, do_sample=None, top_k=None):
+        """
+        Queues a prompt (with the chat template already applied) and returns a future that resolves to the list of
+        its num_return_sequences completions. Unless do_sample is given, the completion is greedy without a temperature
+        and sampled with one.
+        Prompts with the same prefix_key (e.g. the stage) share the prefill of their common prefix. agent_prefix is
+        the leading part of text that is specific to one agent and reused across stages.
+        """
+        input_ids = self.tokenizer(text, add_special_tokens=False)['input_ids']
+        agent_prefix_length = 0
+        if agent_prefix and self.agent_prefix_store is not None:
+            # tokens at the end of the prefix may merge with the following text, only the common tokens are used
+            agent_prefix_ids = self.tokenizer(agent_prefix, add_special_tokens=False)['input_ids']
+            agent_prefix_length = next((index for index, (first_id, second_id)
+                                        in enumerate(zip(agent_prefix_ids, input_ids)) if first_id != second_id),
+                                       min(len(agent_prefix_ids), len(input_ids)))
+        request = GenerationRequest(input_ids, schema, num_return_sequences, temperature, top_p, prefix_key,
+                                    agent_prefix_length, do_sample, top_k)
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='continuous-batching', daemon=True)
+                self.thread.start()
+            self.pending_requests.append(request)
+            self.condition.notify()
+        return request.future
+
+    def pop_early_stopping_stats(self):
+        with self.stats_lock:
+            stats = self.early_stopping_stats
+            self.early_stopping_stats = {'stopped_sequences': 0, 'saved_tokens': 0}
+        return stats
+
+    def pop_batch_stats(self):
+        """Returns and resets the forward passes, their summed and maximum batch sizes and the processed tokens."""
+        with self.stats_lock:
+            stats = self.batch_stats
+            self.batch_stats = self._get_empty_batch_stats()
+        return stats
+
+    @staticmethod
+    def _get_empty_batch_stats():
+        return {'batches': 0, 'batch_size_sum': 0, 'max_batch_size': 0, 'prompt_tokens': 0, 'prefix_cached_tokens': 0,
+                'generated_tokens': 0}
+
+    def _record_batch(self, batch_size, prompt_tokens=0, prefix_cached_tokens=0):
+        with self.stats_lock:
+            self.batch_stats['batches'] += 1
+            self.batch_stats['batch_size_sum'] += batch_size
+            self.batch_stats['max_batch_size'] = max(self.batch_stats['max_batch_size'], batch_size)
+            self.batch_stats['prompt_tokens'] += prompt_tokens
+            self.batch_stats['prefix_cached_tokens'] += prefix_cached_tokens
+            self.batch_stats['generated_tokens'] += batch_size
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.pending_requests and not self.sequences:
+                    self.condition.wait()
+                admitted_requests = self._pop_admissible_requests()
+            try:
+                with torch.inference_mode():
+                    self._step(admitted_requests)
+            except Exception as e:
+                log_error(e)
+                self._fail(admitted_requests, e)
+
+    def _pop_admissible_requests(self):
+        free_slots = self.max_batch_size - len(self.sequences)
+        admitted_requests = []
+        while self.pending_requests:
+            count = self.pending_requests[0].num_return_sequences
+            # a request with more sequences than slots is only admitted into an empty batch, so it cannot starve
+            if count > free_slots and (admitted_requests or self.sequences):
+                break
+            admitted_requests.append(self.pending_requests.popleft())
+            free_slots -= count
+        return admitted_requests
+
+    def _step(self, admitted_requests):
+        if self.sequences:
+            self._decode()
+            self._remove_finished_sequences()
+        if admitted_requests:
+            self._prefill(admitted_requests)
+            self._remove_finished_sequences()
+
+    def _decode(self):
+        input_ids = torch.tensor([[sequence.generated_ids[-1]] for sequence in self.sequences], device=self.device)
+        self.attention_mask = torch.cat([self.attention_mask, self.attention_mask.new_ones((len(self.sequences), 1))],
+                                        dim=1)
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=self.attention_mask,
+            position_ids=self.positions.unsqueeze(1),
+            past_key_values=build_cache(self.cache_layers),
+            use_cache=True
+        )
+        self.cache_layers = get_cache_layers(outputs.past_key_values)
+        self.positions = self.positions + 1
+        self._record_batch(len(self.sequences))
+        self._append_next_tokens(self.sequences, outputs.logits[:, -1])
+
+    def _prefill(self, requests):
+        prefixes = [self._match_prefix(request) for request in requests]
+        prefix_length = max(length for length, _ in prefixes)
+        suffixes = [request.input_ids[length:] for request, (length, _) in zip(requests, prefixes)]
+        length = max(len(suffix) for suffix in suffixes)
+        input_ids = torch.tensor([[self.pad_token_id] * (length - len(suffix)) + suffix for suffix in suffixes],
+                                 device=self.device)
+        # layout of a row: [padding, cached prefix, padding, suffix], the prefix columns are only passed as cache
+        attention_mask = torch.tensor([[0] * (prefix_length - prefix) + [1] * prefix +
+                                       [0] * (length - len(suffix)) + [1] * len(suffix)
+                                       for (prefix, _), suffix in zip(prefixes, suffixes)], device=self.device)
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=(attention_mask.cumsum(dim=1) - 1).clamp(min=0)[:, prefix_length:],
+            past_key_values=self._build_prefix_cache(prefixes, prefix_length) if prefix_length > 0 else None,
+            use_cache=True,
+            logits_to_keep=1
+        )
+        self._store_prefixes(requests, prefixes, get_cache_layers(outputs.past_key_values))
+
+        # all sequences of a request share the prefill, its cache row is repeated once per sequence
+        rows = [row for row, request in enumerate(requests) for _ in range(request.num_return_sequences)]
+        self._record_batch(len(rows), sum(len(request.input_ids) for request in requests),
+                           sum(prefix for prefix, _ in prefixes))
+        rows_tensor = torch.tensor(rows, device=self.device)
+        cache_layers = select_layer_rows(get_cache_layers(outputs.past_key_values), rows_tensor)
+        attention_mask = attention_mask.index_select(0, rows_tensor)
+
+        sequences = []
+        for request in requests:
+            grammar = self.get_token_index().get_grammar(request.schema) if request.schema else None
+            for index in range(request.num_return_sequences):
+                tracker = JsonObjectTracker() if self.token_strings is not None else None
+                sequences.append(_Sequence(request, index, grammar, tracker))
+        self._append_next_tokens(sequences, outputs.logits[:, -1].index_select(0, rows_tensor))
+
+        if self.sequences:
+            self.cache_layers = concat_layers(self.cache_layers, cache_layers)
+            length = max(self.attention_mask.shape[1], attention_mask.shape[1])
+            self.attention_mask = torch.cat([torch.nn.functional.pad(self.attention_mask,
+                                                                     (length - self.attention_mask.shape[1], 0)),
+                                             torch.nn.functional.pad(attention_mask,
+                                                                     (length - attention_mask.shape[1], 0))])
+            self.positions = torch.cat([self.positions, attention_mask.sum(dim=1)])
+        else:
+            self.cache_layers = cache_layers
+            self.attention_mask = attention_mask
+            self.positions = attention_mask.sum(dim=1)
+        self.sequences.extend(sequences)
+
+    def _match_prefix(self, request):
+        length, layers = 0, None
+        if self.prefix_cache is not None and request.prefix_key is not None:
+            length, layers = self.prefix_cache.match(request.prefix_key, request.input_ids)
+
+        agent_prefix_length = request.agent_prefix_length
+        if length < agent_prefix_length < len(request.input_ids):
+            agent_layers = self.agent_prefix_store.get(request.input_ids[:agent_prefix_length], self.device)
+            if agent_layers is not None:
+                return agent_prefix_length, agent_layers
+            request.store_agent_prefix = True
+        return length, layers
+
+    def _build_prefix_cache(self, prefixes, prefix_length):
+        reference_layers = next(layers for _, layers in prefixes if layers is not None)
+        rows = []
+        for _, layers in prefixes:
+            if layers is None:
+                # rows without a prefix get zero columns, which are masked out
+                layers = [(keys[:, :, :0], values[:, :, :0]) for keys, values in reference_layers]
+            rows.append(left_pad_layers(layers, prefix_length))
+        return build_cache([(torch.cat([row[layer][0] for row in rows]), torch.cat([row[layer][1] for row in rows]))
+                            for layer in range(len(reference_layers))])
+
+    def _store_prefixes(self, requests, prefixes, cache_layers):
+        prefix_length = max(prefix for prefix, _ in prefixes)
+        length = cache_layers[0][0].shape[2] - prefix_length
+        for row, (request, (prefix, _)) in enumerate(zip(requests, prefixes)):
+            suffix_length = len(request.input_ids) - prefix
+            if request.store_agent_prefix:
+                request.store_agent_prefix = False
+                self.agent_prefix_store.put(request.input_ids[:request.agent_prefix_length],
+                                            self._get_prompt_layers(cache_layers, row, prefix, prefix_length,
+                                                                    length - suffix_length,
+                                                                    request.agent_prefix_length))
+            # only complete prompts are stored as stage prefix, they are shrunk to the shared part later on
+            if self.prefix_cache is None or request.prefix_key is None or prefix > 0 or \
+                    self.prefix_cache.contains(request.prefix_key):
+                continue
+            self.prefix_cache.store(request.prefix_key, request.input_ids,
+                                    self._get_prompt_layers(cache_layers, row, 0, prefix_length,
+                                                            length - suffix_length, len(request.input_ids)))
+
+    @staticmethod
+    def _get_prompt_layers(cache_layers, row, prefix, prefix_length, suffix_start, count):
+        """
+        Returns the cache of the first count prompt tokens of a prefilled row, whose cached prefix ends at column
+        prefix_length and whose suffix starts suffix_start columns later.
+        """
+        columns = list(range(prefix_length - prefix, prefix_length))[:count]
+        columns += list(range(prefix_length + suffix_start, prefix_length + suffix_start + count - len(columns)))
+        columns = torch.tensor(columns, device=cache_layers[0][0].device)
+        return [(keys[row:row + 1].index_select(2, columns), values[row:row + 1].index_select(2, columns))
+                for keys, values in cache_layers]
+
+    def _append_next_tokens(self, sequences, logits):
+        logits = logits.float()
+        for row, sequence in enumerate(sequences):
+            if sequence.state is not None:
+                mask = self.get_token_index().get_allowed_mask(sequence.grammar, sequence.state).to(logits.device)
+                row_logits = logits[row, :mask.shape[0]]
+                row_logits.masked_fill_(~mask[:row_logits.shape[0]], float('-inf'))
+                # ids of the padded embedding matrix beyond the tokenizer are no tokens of the grammar either
+                logits[row, mask.shape[0]:] = float('-inf')
+
+        next_tokens = logits.argmax(dim=-1)
+        do_sample = [sequence.request.do_sample for sequence in sequences]
+        if any(do_sample):
+            sampled_tokens = self._sample(logits, sequences)
+            next_tokens = torch.where(torch.tensor(do_sample, device=logits.device), sampled_tokens, next_tokens)
+
+        for sequence, token_id in zip(sequences, next_tokens.tolist()):
+            sequence.generated_ids.append(token_id)
+            if token_id in self.eos_token_ids:
+                sequence.finished = True
+                continue
+            if sequence.state is not None and not sequence.grammar.is_complete(sequence.state):
+                sequence.state = sequence.grammar.advance(sequence.state,
+                                                          self.get_token_index().get_token_text(token_id))
+            if sequence.tracker is not None:
+                text = self.token_strings[token_id] if token_id < len(self.token_strings) else ''
+                if sequence.tracker.feed(text):
+                    sequence.finished = True
+                    with self.stats_lock:
+                        self.early_stopping_stats['stopped_sequences'] += 1
+                        self.early_stopping_stats['saved_tokens'] += self.max_new_tokens - len(sequence.generated_ids)
+            if len(sequence.generated_ids) >= self.max_new_tokens:
+                sequence.finished = True
+
+    @staticmethod
+    def _sample(logits, sequences):
+        temperatures = torch.tensor([sequence.request.temperature or 1.0 for sequence in sequences],
+                                    device=logits.device)
+        top_ps = torch.tensor([sequence.request.top_p or 1.0 for sequence in sequences], device=logits.device)
+        top_ks = torch.tensor([sequence.request.top_k or logits.shape[-1] for sequence in sequences],
+                              device=logits.device)
+        probabilities = torch.softmax(logits / temperatures.unsqueeze(1), dim=-1)
+        sorted_probabilities, sorted_ids = probabilities.sort(dim=-1, descending=True)
+        # top-k sampling: drop all tokens after the k most probable ones
+        ranks = torch.arange(logits.shape[-1], device=logits.device).unsqueeze(0)
+        sorted_probabilities = sorted_probabilities.masked_fill(ranks >= top_ks.unsqueeze(1), 0.0)
+        sorted_probabilities = sorted_probabilities / sorted_probabilities.sum(dim=-1, keepdim=True)
+        # nucleus sampling: drop all tokens outside the smallest set whose probability mass exceeds top_p
+        outside_nucleus = sorted_probabilities.cumsum(dim=-1) - sorted_probabilities > top_ps.unsqueeze(1)
+        sorted_probabilities = sorted_probabilities.masked_fill(outside_nucleus, 0.0)
+        return sorted_ids.gather(1, torch.multinomial(sorted_probabilities, 1)).squeeze(1)
+
+    def _remove_finished_sequences(self):
+        kept_rows = [row for row, sequence in enumerate(self.sequences) if not sequence.finished]
+        if len(kept_rows) == len(self.sequences):
+            return
+
+        for sequence in self.sequences:
+            if sequence.finished:
+                request = sequence.request
+                request.completions[sequence.index] = self.tokenizer.decode(sequence.generated_ids,
+                                                                            skip_special_tokens=True)
+                request.remaining_sequences -= 1
+                if request.remaining_sequences == 0:
+                    request.future.set_result(request.completions)
+
+        self.sequences = [self.sequences[row] for row in kept_rows]
+        if not self.sequences:
+            self._reset()
+            return
+
+        rows = torch.tensor(kept_rows, device=self.device)
+        self.cache_layers = select_layer_rows(self.cache_layers, rows)
+        self.attention_mask = self.attention_mask.index_select(0, rows)
+        self.positions = self.positions.index_select(0, rows)
+
+        # drop the columns that only held padding or tokens of removed sequences
+        unused_columns = int((self.attention_mask.sum(dim=0) > 0).int().argmax())
+        self.cache_layers = trim_layers_left(self.cache_layers, unused_columns)
+        self.attention_mask = self.attention_mask[:, unused_columns:]
+
+    def _fail(self, admitted_requests, exception):
+        for request in admitted_requests + [sequence.request for sequence in self.sequences]:
+            if not request.future.done():
+                request.future.set_exception(exception)
+        self.sequences = []
+        self._reset()
+
+    def _reset(self):
+        self.cache_layers = None
+        self.attention_mask = None
+        self.positions = None
@@ -0,0 +1,60 @@
+import os
+
+import torch
+
+from util.logging import log_info, log_warning
+
+CPU_DTYPES = ('float32', 'bfloat16', 'int8')
+
+
+def is_bf16_supported_on_cpu():
+    try:
+        return torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def get_cpu_load_dtype(cpu_dtype):
+    """Returns the dtype the weights are loaded in, int8 models are loaded in float32 and quantized afterwards."""
+    if cpu_dtype not in CPU_DTYPES:
+        raise NotImplementedError(f'CPU dtype "{cpu_dtype}" not implemented, use one of {CPU_DTYPES}')
+    if cpu_dtype == 'bfloat16':
+        if is_bf16_supported_on_cpu():
+            return torch.bfloat16
+        log_warning('[LLM] bfloat16 is not supported by this CPU, falling back to float32.')
+    return torch.float32
+
+
+def quantize_dynamic_int8(model):
+    """Replaces the linear layers by dynamically quantized int8 ones (weights int8, activations quantized per batch)."""
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def compile_model_forward(model):
+    try:
+        model.forward = torch.compile(model.forward, dynamic=True)
+    except Exception as e:
+        log_warning(f'[LLM] torch.compile not available, running eagerly: {e}')
+    return model
+
+
+def get_worker_cores(worker_id, num_workers):
+    """Splits the cores this process may run on into num_workers disjoint, contiguous blocks."""
+    cores = sorted(os.sched_getaffinity(0))
+    cores_per_worker = max(1, len(cores) // num_workers)
+    start = (worker_id * cores_per_worker) % len(cores)
+    return cores[start:start + cores_per_worker]
+
+
+def pin_worker_threads(worker_id, num_workers):
+    """
+    Pins the current worker process to its own block of cores and sizes the intra-op thread pool accordingly, so that
+    the workers of a pool do not all spawn one thread per core and oversubscribe the machine.
+    """
+    if not hasattr(os, 'sched_setaffinity'):
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // num_workers))
+        return
+    cores = get_worker_cores(worker_id, num_workers)
+    os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    log_info(f'[LLM] Worker {worker_id} pinned to cores {cores[0]}-{cores[-1]} with {len(cores)} threads.')
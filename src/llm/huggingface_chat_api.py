@@ -1,26 +1,72 @@
 import torch
-from transformers import pipeline, AutoModelForCausalLM, AutoTokenizer
+from transformers import pipeline, AutoModelForCausalLM, AutoTokenizer, LogitsProcessorList, StoppingCriteriaList
+
+from llm.continuous_batching import ContinuousBatchingEngine
+from llm.cpu_inference import compile_model_forward, get_cpu_load_dtype, quantize_dynamic_int8
+from llm.json_schema_constraint import ConstrainedTokenIndex, JsonSchemaLogitsProcessor, get_token_strings
+from llm.json_stopping_criteria import JsonObjectStoppingCriteria
+from llm.kv_cache import build_cache, get_cache_layers, select_layer_rows
+from llm.llm_backend import LLMBackend
+from llm.prefix_cache import AgentPrefixStore, PrefixCache
+from util.logging import log_info
 
 login_token = "" # generate on hugging face
 
-class HuggingfaceChatAPI:
-    def __init__(self, model_id="Qwen/Qwen3-4B-Instruct-2507", n_predict=700, gpu_id=0):
-        self.model_id = model_id
-        self.n_predict = n_predict
-        self.gpu_id = gpu_id
+class HuggingfaceChatAPI(LLMBackend):
+    def __init__(self, model_id="Qwen/Qwen3-4B-Instruct-2507", n_predict=700, gpu_id=0, batch_size=8,
+                 cache_path=None, cache_max_entries=1000000, sample_temperature=0.8, sample_top_p=0.95,
+                 constrained_decoding=False, stop_at_json_end=True, continuous_batching=False, metrics_path=None,
+                 metrics_log_interval=60, cpu_dtype='float32', attn_implementation=None, compile_model=False,
+                 prefix_caching=False, agent_prefix_caching=False, agent_prefix_cache_path=None,
+                 agent_prefix_cache_max_entries=1024, agent_prefix_cache_max_bytes=None, assistant_model_id=None,
+                 assistant_stages=None):
+        super().__init__(model_id, n_predict, gpu_id, cache_path, cache_max_entries, sample_temperature, sample_top_p,
+                         constrained_decoding, metrics_path, metrics_log_interval)
+        self.batch_size = max(1, batch_size)
+        self.token_index = None
+        self.stop_at_json_end = stop_at_json_end
+        self.token_strings = None
+        self.early_stopping_stats = {'stopped_sequences': 0, 'saved_tokens': 0}
+        self.continuous_batching = continuous_batching
+        self.engine = None
+        # the prefix cache is used by the continuous batching engine, which prefills one request per row
+        self.prefix_cache = PrefixCache() if prefix_caching and continuous_batching else None
+        self.prefix_caching = self.prefix_cache is not None
+        self.agent_prefix_caching = agent_prefix_caching and continuous_batching
+        self.agent_prefix_store = None
+        # stages (and their follow-up stages, e.g. DAY_SCHEDULE_REPAIR) whose completions are drafted by the assistant
+        self.assistant_stages = assistant_stages
+        self.assistant_model = None
+        self.assisted_decoding_stats = {'draft_tokens': 0, 'accepted_tokens': 0, 'verification_passes': 0}
 
         self.device = self.device_name(gpu_id)
+        # without CUDA the weights are loaded in cpu_dtype ('float32', 'bfloat16' or 'int8')
+        self.cpu_dtype = cpu_dtype if not torch.cuda.is_available() else None
 
         self.tokenizer = AutoTokenizer.from_pretrained(model_id)
-        self.model = AutoModelForCausalLM.from_pretrained(
-            model_id,
-            torch_dtype=torch.bfloat16 if torch.cuda.is_available() else torch.float32,
-            device_map={"": self.device},
-            token=login_token
-        )
+        model_kwargs = {'attn_implementation': attn_implementation} if attn_implementation else {}
+        self.model = self._load_model(model_id, model_kwargs)
+        if compile_model:
+            self.model = compile_model_forward(self.model)
+        if assistant_model_id:
+            # a small model of the same family (i.e. with the same tokenizer) drafts tokens the model verifies at once
+            self.assistant_model = self._load_model(assistant_model_id, model_kwargs)
+        if self.agent_prefix_caching:
+            # offloaded entries are only valid for the model and dtype they were computed with
+            offload_path = None
+            if agent_prefix_cache_path:
+                offload_path = f'{agent_prefix_cache_path}/{model_id.replace("/", "_")}_{self.cpu_dtype or "bfloat16"}'
+            self.agent_prefix_store = AgentPrefixStore(agent_prefix_cache_max_entries, offload_path,
+                                                       agent_prefix_cache_max_bytes)
 
         self.use_chat_template = hasattr(self.tokenizer, "apply_chat_template")
-        if not self.use_chat_template:
+        if self.use_chat_template:
+            # Decoder-only models have to be padded on the left for batched generation, otherwise the new tokens
+            # would be appended after the padding of the shorter prompts.
+            self.tokenizer.padding_side = "left"
+            if self.tokenizer.pad_token is None:
+                self.tokenizer.pad_token = self.tokenizer.eos_token
+        else:
             self.pipe = pipeline(
                 "text-generation",
                 model=self.model,
@@ -32,13 +78,17 @@ class HuggingfaceChatAPI:
                 self.tokenizer.convert_tokens_to_ids("<|eot_id|>")
             ]
 
-        self.system_prompt = (
-            "You are a highly specialized sociologist and economist with extensive, "
-            "evidence-based knowledge of German cultural, behavioral, and economic patterns. "
-            "When given descriptions of specific individuals living in Germany, you must provide detailed, "
-            "realistic, and unbiased sociological and economic insights that accurately reflect "
-            "contemporary social and economic dynamics. Ensure every output is strictly valid JSON."
+    def _load_model(self, model_id, model_kwargs):
+        model = AutoModelForCausalLM.from_pretrained(
+            model_id,
+            torch_dtype=torch.bfloat16 if torch.cuda.is_available() else get_cpu_load_dtype(self.cpu_dtype),
+            device_map={"": self.device},
+            token=login_token,
+            **model_kwargs
         )
+        if self.cpu_dtype == 'int8':
+            model = quantize_dynamic_int8(model)
+        return model
 
     def device_name(self, gpu_id):
         if torch.cuda.is_available():
@@ -46,40 +96,330 @@ class HuggingfaceChatAPI:
         else:
             return "cpu"
 
-    def get_completion(self, prompt):
-        messages = [
-            {"role": "system", "content": self.system_prompt},
-            {"role": "user", "content": prompt},
-        ]
-        return self._generate_response(messages)
-
-    def get_completions(self, prompts):
-        responses = []
-        for prompt in prompts:
-            messages = [
-                {"role": "system", "content": self.system_prompt},
-                {"role": "user", "content": prompt},
-            ]
-            responses.append(self._generate_response(messages))
+    def get_generation_parameters(self):
+        parameters = {'n_predict': self.n_predict, 'stop_at_json_end': self.stop_at_json_end}
+        if self.cpu_dtype and self.cpu_dtype != 'float32':
+            # reduced precision changes the completions, so they must not share cache entries with float32 ones
+            parameters['cpu_dtype'] = self.cpu_dtype
+        if not self.use_chat_template:
+            parameters.update({'do_sample': True, 'temperature': 0.6, 'top_p': 0.9})
+        if self.continuous_batching:
+            # the engine samples on its own, so its completions must not share cache entries with generate() ones
+            parameters['continuous_batching'] = True
+        return parameters
+
+    def _get_default_sampling_parameters(self):
+        # requests without explicit sampling parameters decode like generate() does, i.e. per the generation config
+        generation_config = self.model.generation_config
+        if not generation_config.do_sample:
+            return {'do_sample': False}
+        return {'do_sample': True, 'temperature': generation_config.temperature, 'top_p': generation_config.top_p,
+                'top_k': generation_config.top_k}
+
+    def _get_active_schemas(self, schemas):
+        # the pipeline fallback does not support logits processors
+        if not self.use_chat_template:
+            return None
+        return super()._get_active_schemas(schemas)
+
+    def _get_eos_token_ids(self):
+        eos_token_ids = self.model.generation_config.eos_token_id
+        if not isinstance(eos_token_ids, list):
+            eos_token_ids = [eos_token_ids]
+        return [token_id for token_id in eos_token_ids + [self.tokenizer.eos_token_id] if token_id is not None]
+
+    def _get_token_index(self):
+        if self.token_index is None:
+            self.token_index = ConstrainedTokenIndex(self.tokenizer, self._get_eos_token_ids())
+        return self.token_index
+
+    def _get_engine(self):
+        if self.engine is None:
+            self.engine = ContinuousBatchingEngine(
+                self.model,
+                self.tokenizer,
+                max_batch_size=self.batch_size,
+                max_new_tokens=self.n_predict,
+                eos_token_ids=self._get_eos_token_ids(),
+                get_token_index=self._get_token_index,
+                token_strings=self._get_token_strings() if self.stop_at_json_end else None,
+                prefix_cache=self.prefix_cache,
+                agent_prefix_store=self.agent_prefix_store
+            )
+        return self.engine
+
+    def _get_token_strings(self):
+        if self.token_strings is None:
+            self.token_strings = get_token_strings(self.tokenizer)
+        return self.token_strings
+
+    def _get_agent_prefix(self, prompt, text):
+        """Returns the part of the chat template text up to the end of the prompt's agent prefix, if it has one."""
+        agent_prefix = self.agent_prefixes.get(prompt)
+        start = text.find(prompt)
+        if not agent_prefix or not prompt.startswith(agent_prefix) or start < 0:
+            return None
+        return text[:start + len(agent_prefix)]
+
+    def pop_early_stopping_stats(self):
+        """
+        Returns and resets the number of sequences stopped after their JSON object was closed and the tokens that were
+        not generated because of it (at most, as some sequences would have reached EOS before max_new_tokens).
+        """
+        stats = self.early_stopping_stats
+        self.early_stopping_stats = {'stopped_sequences': 0, 'saved_tokens': 0}
+        if self.engine is not None:
+            for key, value in self.engine.pop_early_stopping_stats().items():
+                stats[key] += value
+        return stats
+
+    def log_early_stopping_stats(self, stage):
+        stats = self.pop_early_stopping_stats()
+        if self.stop_at_json_end:
+            log_info(f'[{stage}] [GPU {self.gpu_id}] {stats["stopped_sequences"]} sequences stopped at the end of '
+                     f'their JSON object, saving up to {stats["saved_tokens"]} generated tokens.')
+
+    def _get_uncached_completions(self, prompts, schemas=None):
+        if not prompts:
+            return []
+        if not self.use_chat_template:
+            return [self._generate_response(self.get_messages(prompt)) for prompt in prompts]
+
+        texts = [self._apply_chat_template(self.get_messages(prompt)) for prompt in prompts]
+        if self._uses_assistant():
+            return self._get_assisted_completions(texts, schemas)
+        if self.continuous_batching:
+            sampling_parameters = self._get_default_sampling_parameters()
+            futures = [self._get_engine().submit(text, schemas[index] if schemas else None, prefix_key=self.stage,
+                                                 agent_prefix=self._get_agent_prefix(prompts[index], text),
+                                                 **sampling_parameters)
+                       for index, text in enumerate(texts)]
+            responses = [future.result()[0] for future in futures]
+            self.metrics.record(self.stage, self.engine.pop_batch_stats())
+            return responses
+
+        responses = [None] * len(texts)
+        for batch_indices in self._get_length_bucketed_batches(texts, self.batch_size):
+            batch_responses = self._generate_batch([texts[index] for index in batch_indices],
+                                                   [schemas[index] for index in batch_indices] if schemas else None)
+            for index, response in zip(batch_indices, batch_responses):
+                responses[index] = response
         return responses
 
-    def _generate_response(self, messages):
-        if self.use_chat_template:
-            text = self.tokenizer.apply_chat_template(
-                messages,
-                tokenize=False,
-                add_generation_prompt=True
+    def _uses_assistant(self):
+        if self.assistant_model is None:
+            return False
+        return self.assistant_stages is None or any((self.stage or '').startswith(stage)
+                                                    for stage in self.assistant_stages)
+
+    def _get_assisted_completions(self, texts, schemas=None):
+        """
+        Generates the completions with the assistant model drafting tokens that the model verifies in one forward pass.
+        Assisted generation only supports one sequence at a time, so it trades batching for a lower latency per token.
+        The forward passes of both models are counted to report how many of the drafted tokens were accepted.
+        """
+        stats = self.assisted_decoding_stats
+        stats_before = dict(stats)
+
+        def count(key):
+            def hook(module, args, output):
+                stats[key] += 1
+            return hook
+
+        hooks = [self.model.register_forward_hook(count('verification_passes')),
+                 self.assistant_model.register_forward_hook(count('draft_tokens'))]
+        try:
+            responses = []
+            for index, text in enumerate(texts):
+                responses.extend(self._generate_batch([text], [schemas[index]] if schemas else None,
+                                                      assistant_model=self.assistant_model))
+        finally:
+            for hook in hooks:
+                hook.remove()
+
+        draft_tokens = stats['draft_tokens'] - stats_before['draft_tokens']
+        accepted_tokens = stats['accepted_tokens'] - stats_before['accepted_tokens']
+        log_info(f'[{self.stage}] [GPU {self.gpu_id}] Assisted decoding: {accepted_tokens}/{draft_tokens} drafted tokens '
+                 f'accepted ({accepted_tokens / draft_tokens if draft_tokens else 0.0:.1%}).')
+        return responses
+
+    def pop_assisted_decoding_stats(self):
+        """Returns and resets the drafted and accepted tokens and the verification passes of assisted decoding."""
+        stats = self.assisted_decoding_stats
+        self.assisted_decoding_stats = {'draft_tokens': 0, 'accepted_tokens': 0, 'verification_passes': 0}
+        stats['acceptance_rate'] = stats['accepted_tokens'] / stats['draft_tokens'] if stats['draft_tokens'] else 0.0
+        return stats
+
+    def _get_uncached_sampled_completions(self, prompts, num_return_sequences, schemas=None):
+        if not self.use_chat_template:
+            return [self._generate_response(self.get_messages(prompt), num_return_sequences=count)
+                    for prompt, count in zip(prompts, num_return_sequences)]
+
+        texts = [self._apply_chat_template(self.get_messages(prompt)) for prompt in prompts]
+        if self.continuous_batching:
+            return self._get_continuously_batched_sampled_completions(texts, num_return_sequences, schemas)
+
+        # Requests with more sequences than fit into one batch are split into several chunks. Chunks with the same
+        # number of sequences are then batched together, as generate() only supports one num_return_sequences per call.
+        chunks_by_count = {}
+        for index, count in enumerate(num_return_sequences):
+            while count > 0:
+                chunk_count = min(count, self.batch_size)
+                chunks_by_count.setdefault(chunk_count, []).append(index)
+                count -= chunk_count
+
+        responses = [[] for _ in texts]
+        for count, indices in chunks_by_count.items():
+            prompts_per_batch = max(1, self.batch_size // count)
+            chunk_texts = [texts[index] for index in indices]
+            for batch_positions in self._get_length_bucketed_batches(chunk_texts, prompts_per_batch):
+                batch_schemas = [schemas[indices[position]] for position in batch_positions] if schemas else None
+                batch_responses = self._generate_batch([chunk_texts[position] for position in batch_positions],
+                                                       batch_schemas,
+                                                       num_return_sequences=count,
+                                                       **self.get_sampling_parameters())
+                for offset, position in enumerate(batch_positions):
+                    responses[indices[position]].extend(batch_responses[offset * count:(offset + 1) * count])
+        return responses
+
+    def _get_continuously_batched_sampled_completions(self, texts, num_return_sequences, schemas=None):
+        # requests with more sequences than slots are split, so that they can be admitted while other sequences run
+        futures = [[] for _ in texts]
+        for index, count in enumerate(num_return_sequences):
+            while count > 0:
+                chunk_count = min(count, self.batch_size)
+                futures[index].append(self._get_engine().submit(texts[index],
+                                                                schemas[index] if schemas else None,
+                                                                num_return_sequences=chunk_count,
+                                                                temperature=self.sample_temperature,
+                                                                top_p=self.sample_top_p,
+                                                                prefix_key=self.stage))
+                count -= chunk_count
+        responses = [[completion for future in request_futures for completion in future.result()]
+                     for request_futures in futures]
+        self.metrics.record(self.stage, self.engine.pop_batch_stats())
+        return responses
+
+    def _get_uncached_option_scores(self, prompts, options):
+        if not self.use_chat_template:
+            raise NotImplementedError('Scoring options requires a chat template')
+        texts = [self._apply_chat_template(self.get_messages(prompt)) for prompt in prompts]
+        scores = [None] * len(texts)
+        for batch_indices in self._get_length_bucketed_batches(texts, self.batch_size):
+            batch_scores = self._score_batch([texts[index] for index in batch_indices],
+                                             [options[index] for index in batch_indices])
+            for index, option_scores in zip(batch_indices, batch_scores):
+                scores[index] = option_scores
+        return scores
+
+    def _score_batch(self, texts, options):
+        """
+        Computes the log-probability of every option as answer to its prompt. The prompts are prefilled once, the
+        logits of their last token score the first option tokens. All options of all prompts are then passed through
+        the model in a single forward pass on top of the repeated prompt caches, which scores the remaining tokens.
+        """
+        model_inputs = self.tokenizer(texts, return_tensors="pt", padding=True)
+        model_inputs = {k: v.to(self.device) for k, v in model_inputs.items()}
+        attention_mask = model_inputs["attention_mask"]
+        option_ids = [self.tokenizer(option, add_special_tokens=False)["input_ids"]
+                      for text_options in options for option in text_options]
+        rows = [row for row, text_options in enumerate(options) for _ in text_options]
+        length = max(len(ids) for ids in option_ids)
+
+        with torch.inference_mode():
+            outputs = self.model(
+                **model_inputs,
+                position_ids=(attention_mask.cumsum(dim=1) - 1).clamp(min=0),
+                use_cache=length > 1,
+                logits_to_keep=1
             )
-            model_inputs = self.tokenizer([text], return_tensors="pt")
-            model_inputs = {k: v.to(self.device) for k, v in model_inputs.items()}
+            first_log_probs = torch.log_softmax(outputs.logits[:, -1].float(), dim=-1)[rows]
+            log_probs = None
+            if length > 1:
+                rows_tensor = torch.tensor(rows, device=self.device)
+                prompt_mask = attention_mask.index_select(0, rows_tensor)
+                option_mask = torch.tensor([[1] * len(ids) + [0] * (length - len(ids)) for ids in option_ids],
+                                           device=self.device)
+                option_outputs = self.model(
+                    input_ids=torch.tensor([ids + [self.tokenizer.pad_token_id] * (length - len(ids))
+                                            for ids in option_ids], device=self.device),
+                    attention_mask=torch.cat([prompt_mask, option_mask], dim=1),
+                    position_ids=prompt_mask.sum(dim=1, keepdim=True) + torch.arange(length, device=self.device),
+                    past_key_values=build_cache(select_layer_rows(get_cache_layers(outputs.past_key_values),
+                                                                  rows_tensor)),
+                    use_cache=False
+                )
+                log_probs = torch.log_softmax(option_outputs.logits.float(), dim=-1)
+
+        option_scores = []
+        for option_row, ids in enumerate(option_ids):
+            score = float(first_log_probs[option_row, ids[0]])
+            for position in range(1, len(ids)):
+                score += float(log_probs[option_row, position - 1, ids[position]])
+            option_scores.append(score)
+        self.metrics.record_batch(self.stage,
+                                  batch_size=len(option_ids),
+                                  prompt_tokens=int(attention_mask.sum()) + sum(len(ids) for ids in option_ids),
+                                  generated_tokens=0)
+
+        scores = []
+        for text_options in options:
+            scores.append(option_scores[:len(text_options)])
+            option_scores = option_scores[len(text_options):]
+        return scores
+
+    def _get_length_bucketed_batches(self, texts, batch_size):
+        # Sorting by prompt length puts prompts of similar length into the same micro-batch (length bucketing),
+        # which keeps the amount of padding per batch small.
+        lengths = [len(input_ids) for input_ids in self.tokenizer(texts)["input_ids"]]
+        order = sorted(range(len(texts)), key=lambda index: lengths[index])
+        return [order[start:start + batch_size] for start in range(0, len(order), batch_size)]
+
+    def _apply_chat_template(self, messages):
+        return self.tokenizer.apply_chat_template(
+            messages,
+            tokenize=False,
+            add_generation_prompt=True
+        )
+
+    def _generate_batch(self, texts, schemas=None, **generation_kwargs):
+        verification_passes_before = self.assisted_decoding_stats['verification_passes']
+        model_inputs = self.tokenizer(texts, return_tensors="pt", padding=True)
+        model_inputs = {k: v.to(self.device) for k, v in model_inputs.items()}
+        input_length = model_inputs["input_ids"].shape[1]
+        if schemas:
+            generation_kwargs['logits_processor'] = LogitsProcessorList([
+                JsonSchemaLogitsProcessor(self._get_token_index(), schemas, input_length)
+            ])
+        stopping_criteria = None
+        if self.stop_at_json_end:
+            stopping_criteria = JsonObjectStoppingCriteria(self._get_token_strings(), input_length, self.n_predict)
+            generation_kwargs['stopping_criteria'] = StoppingCriteriaList([stopping_criteria])
+        with torch.inference_mode():
             generated_ids = self.model.generate(
                 **model_inputs,
-                max_new_tokens=self.n_predict
+                max_new_tokens=self.n_predict,
+                pad_token_id=self.tokenizer.pad_token_id,
+                **generation_kwargs
             )
-            input_length = model_inputs["input_ids"].shape[1]
-            trimmed_ids = generated_ids[:, input_length:]
-            response = self.tokenizer.batch_decode(trimmed_ids, skip_special_tokens=True)[0]
-            return response
+        if stopping_criteria is not None:
+            self.early_stopping_stats['stopped_sequences'] += stopping_criteria.stopped_sequences
+            self.early_stopping_stats['saved_tokens'] += stopping_criteria.saved_tokens
+        trimmed_ids = generated_ids[:, input_length:]
+        generated_tokens = int((trimmed_ids != self.tokenizer.pad_token_id).sum())
+        if 'assistant_model' in generation_kwargs:
+            # every verification pass adds one token of the model itself, the others are accepted drafts
+            verification_passes = self.assisted_decoding_stats['verification_passes'] - verification_passes_before
+            self.assisted_decoding_stats['accepted_tokens'] += max(0, generated_tokens - verification_passes)
+        self.metrics.record_batch(self.stage,
+                                  batch_size=trimmed_ids.shape[0],
+                                  prompt_tokens=int(model_inputs["attention_mask"].sum()),
+                                  generated_tokens=generated_tokens)
+        return self.tokenizer.batch_decode(trimmed_ids, skip_special_tokens=True)
+
+    def _generate_response(self, messages, num_return_sequences=1):
+        if self.use_chat_template:
+            return self._generate_batch([self._apply_chat_template(messages)])[0]
         else:
             outputs = self.pipe(
                 messages,
@@ -88,9 +428,12 @@ class HuggingfaceChatAPI:
                 do_sample=True,
                 temperature=0.6,
                 top_p=0.9,
+                num_return_sequences=num_return_sequences,
             )
+            if num_return_sequences > 1:
+                return [output["generated_text"][-1]["content"] for output in outputs]
             full_text = outputs[0]["generated_text"][-1]["content"]
             return full_text
 
 if __name__ == "__main__":
-    chat = HuggingfaceChatAPI()
\ No newline at end of file
+    chat = HuggingfaceChatAPI()
@@ -0,0 +1,225 @@
+import json
+import multiprocessing
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+
+from llm.llm_backend import create_llm_backend
+from model.agent import Agent
+from model.agent_failure import AgentFailure
+from util.list import chunk_list
+from util.logging import log_error, log_info, log_warning
+
+# names of exception classes that hit every agent of a chunk alike (an outage, a full GPU), their chunks fail as a
+# whole instead of being split down to single agents
+INFRASTRUCTURE_EXCEPTIONS = ('OutOfMemoryError', 'ConnectionError', 'TimeoutError')
+
+# State of the current worker process
+_device_id = None
+_llm_config = None
+_llm_apis = {}
+
+
+def _init_worker(device_ids, llm_config, num_workers):
+    global _device_id, _llm_config
+    _device_id = device_ids.get()
+    _llm_config = llm_config
+
+    if (llm_config or {}).get('backend', 'huggingface') == 'huggingface':
+        import torch
+        if not torch.cuda.is_available():
+            from llm.cpu_inference import pin_worker_threads
+            pin_worker_threads(_device_id, num_workers)
+
+
+def get_stage_llm_config(llm_config, stage=None):
+    """
+    Returns the llm config of a pipeline stage: the entries of llm_config['stages'][stage] (e.g. another model_id)
+    override the shared ones.
+    """
+    llm_config = dict(llm_config or {})
+    stage_configs = llm_config.pop('stages', None) or {}
+    return {**llm_config, **stage_configs.get(stage, {})}
+
+
+def get_llm_api(worker_id=0, llm_config=None, stage=None):
+    """
+    Returns the LLM backend of the current process for the given stage and only loads the model on first use. Inside
+    an InferencePool the device assigned to the process is used, otherwise the one of the given worker id. Stages with
+    the same config share one backend, stages with different models keep both loaded.
+    """
+    device_id = _device_id if _device_id is not None else worker_id
+    if llm_config is None:
+        llm_config = _llm_config or {}
+    llm_config = get_stage_llm_config(llm_config, stage)
+
+    key = (device_id, json.dumps(llm_config, sort_keys=True))
+    if key not in _llm_apis:
+        log_info(f'[LLM] Loading {llm_config.get("model_id", "default model")} on device {device_id}...')
+        _llm_apis[key] = create_llm_backend(device_id, llm_config)
+    return _llm_apis[key]
+
+
+class InferencePool(ProcessPoolExecutor):
+    """
+    Process pool whose workers stay alive for the whole run. Each worker is bound to one device and keeps its model
+    loaded, so that all pipeline stages can be served without reloading the weights. Without CUDA each worker is
+    pinned to its own share of the cores instead.
+    """
+
+    def __init__(self, max_workers, llm_config=None):
+        device_ids = multiprocessing.Queue()
+        for device_id in range(max_workers):
+            device_ids.put(device_id)
+        super().__init__(max_workers=max_workers, initializer=_init_worker,
+                         initargs=(device_ids, llm_config, max_workers))
+        self.llm_config = llm_config
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        super().shutdown(wait=wait, cancel_futures=cancel_futures)
+        if wait and (self.llm_config or {}).get('agent_prefix_caching'):
+            from llm.prefix_cache import remove_offloaded_agent_prefixes
+            # the offloaded agent prefixes are only valid for the personas of this run
+            remove_offloaded_agent_prefixes(self.llm_config)
+
+
+@contextmanager
+def use_executor(executor, max_workers):
+    """
+    Yields the given executor or, if there is none, an inference pool that only lives for one stage. Its workers are
+    bound to their device, whichever chunks they pull.
+    """
+    if executor is not None:
+        yield executor
+    else:
+        with InferencePool(max_workers) as stage_executor:
+            yield stage_executor
+
+
+def map_agents(result, function):
+    """Applies function to every agent in the (nested) lists and tuples of a stage result."""
+    if isinstance(result, Agent):
+        return function(result)
+    if isinstance(result, (list, tuple)):
+        return type(result)(map_agents(item, function) for item in result)
+    return result
+
+
+def run_on_fields(function, output_fields, agents, *args, **kwargs):
+    """Runs a stage function in a worker and reduces the agents of its result to the fields the stage set."""
+    return map_agents(function(agents, *args, **kwargs), lambda agent: agent.with_fields(output_fields))
+
+
+def submit_chunk(executor, function, agents, *args, input_fields=None, output_fields=None, **kwargs):
+    """
+    Submits function(agents, *args, **kwargs). With input_fields the worker only receives these fields of the agents
+    and only sends back their output_fields, which are merged into the given agents before the returned future
+    completes, so that the agents of later stages (e.g. their routes) do not travel to and from every worker.
+    """
+    agents_by_id = {agent.id: agent for agent in agents}
+    if input_fields is None or len(agents_by_id) != len(agents):
+        # the fields of the agents can only be merged back by a unique id
+        return executor.submit(function, agents, *args, **kwargs)
+
+    future = Future()
+
+    def merge(worker_future):
+        try:
+            future.set_result(map_agents(worker_future.result(), lambda agent: agents_by_id[agent.id].update_fields(
+                agent, output_fields)))
+        except Exception as e:
+            future.set_exception(e)
+
+    executor.submit(run_on_fields, function, output_fields, [agent.with_fields(input_fields) for agent in agents],
+                    *args, **kwargs).add_done_callback(merge)
+    return future
+
+
+def is_infrastructure_exception(e, infrastructure_exceptions=INFRASTRUCTURE_EXCEPTIONS):
+    return any(exception_class.__name__ in infrastructure_exceptions for exception_class in type(e).__mro__)
+
+
+def split_failed_chunk(stage, chunk, e, failures, infrastructure_exceptions=INFRASTRUCTURE_EXCEPTIONS):
+    """
+    Returns the halves of a chunk that raised, to be queued again so that the other agents of the chunk are not lost
+    with the one that raised. An agent that raises on its own is appended to failures as AgentFailure instead, as are
+    all agents of a chunk that raised an infrastructure exception. A broken pool cannot take the halves and is raised.
+    """
+    if isinstance(e, BrokenProcessPool):
+        raise e
+    if is_infrastructure_exception(e, infrastructure_exceptions):
+        log_error(e)
+        log_error(f'[ERROR] [{stage}] A chunk of {len(chunk)} agents failed with {type(e).__name__}.')
+        failures.extend(AgentFailure(agent, stage, e, infrastructure=True) for agent in chunk)
+        return []
+    if len(chunk) > 1:
+        log_warning(f'[{stage}] A chunk of {len(chunk)} agents raised {type(e).__name__}: {e}. Re-queueing its halves.')
+        middle = len(chunk) // 2
+        return [chunk[:middle], chunk[middle:]]
+    log_error(e)
+    log_error(f'[ERROR] [{stage}] Agent {chunk[0].id} failed.')
+    failures.append(AgentFailure(chunk[0], stage, e))
+    return []
+
+
+def log_failures(stage_failures):
+    if not stage_failures:
+        return
+    exception_counts = Counter(failure.exception for failure in stage_failures)
+    log_warning(f'[{stage_failures[0].stage}] {len(stage_failures)} agents failed: ' +
+                ', '.join(f'{count}x {exception}' for exception, count in exception_counts.most_common()))
+
+
+def get_failed_agents(stage_failures):
+    """The agents of the failures of a stage, including those of chunks that failed with an infrastructure exception."""
+    return [failure.agent for failure in stage_failures]
+
+
+def record_failures(stage_failures, checkpoint=None, failures=None):
+    """Logs the failures of a stage, stores their agents as failed ones and returns them."""
+    log_failures(stage_failures)
+    agents = get_failed_agents(stage_failures)
+    if checkpoint is not None:
+        checkpoint.commit([], agents)
+    if failures is not None:
+        failures.extend(stage_failures)
+    return agents
+
+
+def map_chunks(executor, stage, function, agents, chunk_size, *args, input_fields=None, output_fields=None,
+               failures=None, infrastructure_exceptions=INFRASTRUCTURE_EXCEPTIONS, **kwargs):
+    """
+    Submits function(chunk, *args, **kwargs) for every chunk of chunk_size agents and yields the results as they
+    complete. Idle workers pull the next chunk, so that a slow chunk (e.g. with long schedules) only delays itself
+    instead of the shard of a whole worker. Chunks that raise are split and queued again down to single agents (see
+    split_failed_chunk), the failures of single agents are appended to failures. See submit_chunk for the fields.
+    """
+    failures = [] if failures is None else failures
+    futures = {}
+
+    def submit(chunk):
+        future = submit_chunk(executor, function, chunk, *args, input_fields=input_fields,
+                              output_fields=output_fields, **kwargs)
+        futures[future] = chunk
+
+    chunks = chunk_list(agents, max(1, chunk_size))
+    for chunk in chunks:
+        submit(chunk)
+    chunk_count = len(chunks)
+    done_count = 0
+    while futures:
+        done, _ = wait(futures, return_when=FIRST_COMPLETED)
+        for future in done:
+            chunk = futures.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                halves = split_failed_chunk(stage, chunk, e, failures, infrastructure_exceptions)
+                chunk_count += len(halves) - 1
+                for half in halves:
+                    submit(half)
+                continue
+            done_count += 1
+            log_info(f'[{stage}] {done_count}/{chunk_count} chunks done.')
+            yield result
@@ -0,0 +1,367 @@
+import bisect
+import hashlib
+import json
+
+import torch
+from transformers import LogitsProcessor
+
+# Node kinds of the compiled grammar
+LITERAL = 0
+ENUM = 1
+STRING = 2
+SEQUENCE = 3
+ARRAY = 4
+
+# States of a STRING node
+STRING_START = 0
+STRING_BODY = 1
+STRING_ESCAPE = 2
+STRING_UNICODE = 3  # 3 to 6: number of hex digits of a \uXXXX escape consumed so far
+
+ESCAPABLE_CHARACTERS = set('"\\/bfnrtu')
+HEX_CHARACTERS = set('0123456789abcdefABCDEF')
+
+
+def get_schema_key(schema):
+    return hashlib.sha256(json.dumps(schema, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def get_token_strings(tokenizer):
+    token_strings = []
+    for token_id in range(len(tokenizer)):
+        text = tokenizer.decode([token_id], clean_up_tokenization_spaces=False)
+        token = tokenizer.convert_ids_to_tokens(token_id)
+        # sentencepiece tokenizers drop the leading space when a single token is decoded
+        if isinstance(token, str) and token.startswith('▁') and not text.startswith(' '):
+            text = ' ' + text
+        token_strings.append(text)
+    return token_strings
+
+
+def is_plain_string_character(char):
+    return char not in '"\\' and ord(char) >= 0x20
+
+
+class JsonSchemaGrammar:
+    """
+    Character level automaton for compact JSON that follows a (small subset of a) JSON schema.
+
+    Supported are objects (all properties required, in the given order), arrays with "items" and optional "minItems",
+    fixed length arrays with "prefixItems", free strings and strings restricted by "enum" or "const". The automaton
+    state is an immutable tuple of (node, data) frames, so that states can be shared and cached.
+    """
+
+    def __init__(self, schema):
+        self.key = get_schema_key(schema)
+        self.nodes = []
+        self.root = self._compile(schema)
+
+    def initial_state(self):
+        return ((self.root, self._initial_data(self.root)),)
+
+    def advance(self, state, text):
+        for char in text:
+            state = self._advance_char(state, char)
+            if state is None:
+                return None
+        return state
+
+    @staticmethod
+    def is_complete(state):
+        return state is not None and len(state) == 0
+
+    def is_in_string_body(self, state):
+        if not state:
+            return False
+        node, data = state[-1]
+        return self.nodes[node][0] == STRING and data == STRING_BODY
+
+    def _add_node(self, *node):
+        self.nodes.append(node)
+        return len(self.nodes) - 1
+
+    def _compile(self, schema):
+        if 'const' in schema:
+            return self._compile_enum([schema['const']])
+        if 'enum' in schema:
+            return self._compile_enum(schema['enum'])
+
+        schema_type = schema.get('type')
+        if schema_type == 'string':
+            return self._add_node(STRING)
+        if schema_type == 'object':
+            properties = list(schema.get('properties', {}).items())
+            if not properties:
+                return self._add_node(LITERAL, '{}')
+            children = []
+            for index, (name, property_schema) in enumerate(properties):
+                separator = '{' if index == 0 else ','
+                children.append(self._add_node(LITERAL, f'{separator}{json.dumps(name, ensure_ascii=False)}:'))
+                children.append(self._compile(property_schema))
+            children.append(self._add_node(LITERAL, '}'))
+            return self._add_node(SEQUENCE, tuple(children))
+        if schema_type == 'array':
+            if 'prefixItems' in schema:
+                items = schema['prefixItems']
+                if not items:
+                    return self._add_node(LITERAL, '[]')
+                children = []
+                for index, item_schema in enumerate(items):
+                    children.append(self._add_node(LITERAL, '[' if index == 0 else ','))
+                    children.append(self._compile(item_schema))
+                children.append(self._add_node(LITERAL, ']'))
+                return self._add_node(SEQUENCE, tuple(children))
+            item = self._compile(schema['items'])
+            return self._add_node(ARRAY, item, schema.get('minItems', 0) > 0)
+        raise NotImplementedError(f'Schema not supported for constrained decoding: {schema}')
+
+    def _compile_enum(self, values):
+        options = frozenset(json.dumps(str(value), ensure_ascii=False) for value in values)
+        prefixes = frozenset(option[:end] for option in options for end in range(1, len(option) + 1))
+        return self._add_node(ENUM, options, prefixes)
+
+    def _initial_data(self, node):
+        kind = self.nodes[node][0]
+        if kind == ENUM:
+            return ''
+        return 0
+
+    def _advance_char(self, state, char):
+        stack = list(state)
+        while stack:
+            node, data = stack[-1]
+            kind = self.nodes[node][0]
+
+            if kind == SEQUENCE:
+                children = self.nodes[node][1]
+                child = children[data]
+                stack[-1] = (node, data + 1)
+                stack.append((child, self._initial_data(child)))
+                continue
+
+            if kind == ARRAY:
+                item, non_empty = self.nodes[node][1], self.nodes[node][2]
+                if data == 0:
+                    if char != '[':
+                        return None
+                    stack[-1] = (node, 1)
+                    return tuple(stack)
+                if data == 1 and char == ']' and not non_empty:
+                    stack.pop()
+                    return self._finish_children(stack)
+                if data in (1, 3):
+                    # an item has to follow the opening bracket or the comma
+                    stack[-1] = (node, 2)
+                    stack.append((item, self._initial_data(item)))
+                    continue
+                if char == ',':
+                    stack[-1] = (node, 3)
+                    return tuple(stack)
+                if char == ']':
+                    stack.pop()
+                    return self._finish_children(stack)
+                return None
+
+            new_data, done = self._advance_terminal(node, data, char)
+            if new_data is None:
+                return None
+            if done:
+                stack.pop()
+                return self._finish_children(stack)
+            stack[-1] = (node, new_data)
+            return tuple(stack)
+        return None
+
+    def _finish_children(self, stack):
+        # Pops every sequence whose last child just completed
+        while stack:
+            node, data = stack[-1]
+            if self.nodes[node][0] == SEQUENCE and data == len(self.nodes[node][1]):
+                stack.pop()
+            else:
+                break
+        return tuple(stack)
+
+    def _advance_terminal(self, node, data, char):
+        definition = self.nodes[node]
+        kind = definition[0]
+        if kind == LITERAL:
+            text = definition[1]
+            if text[data] != char:
+                return None, False
+            return data + 1, data + 1 == len(text)
+        if kind == ENUM:
+            options, prefixes = definition[1], definition[2]
+            prefix = data + char
+            if prefix not in prefixes:
+                return None, False
+            return prefix, prefix in options
+        # STRING
+        if data == STRING_START:
+            return (STRING_BODY, False) if char == '"' else (None, False)
+        if data == STRING_BODY:
+            if char == '"':
+                return STRING_BODY, True
+            if char == '\\':
+                return STRING_ESCAPE, False
+            return (STRING_BODY, False) if ord(char) >= 0x20 else (None, False)
+        if data == STRING_ESCAPE:
+            if char not in ESCAPABLE_CHARACTERS:
+                return None, False
+            return (STRING_UNICODE, False) if char == 'u' else (STRING_BODY, False)
+        if char not in HEX_CHARACTERS:
+            return None, False
+        return (STRING_BODY, False) if data == STRING_UNICODE + 3 else (data + 1, False)
+
+
+class ConstrainedTokenIndex:
+    """
+    Maps grammar states to the set of tokens that keep the output valid. The vocabulary is kept as a sorted list of
+    token strings, so that all tokens sharing a prefix form a contiguous range which can be searched depth first
+    while advancing the grammar. Masks are cached per (grammar, state).
+    """
+
+    def __init__(self, tokenizer, eos_token_ids, max_cached_masks=20000):
+        self.vocab_size = len(tokenizer)
+        self.eos_token_ids = [token_id for token_id in eos_token_ids if token_id is not None]
+        self.max_cached_masks = max_cached_masks
+
+        special_ids = set(tokenizer.all_special_ids)
+        token_strings = get_token_strings(tokenizer)
+
+        tokens = sorted((text, token_id) for token_id, text in enumerate(token_strings)
+                        if token_id not in special_ids and text)
+        self.token_texts = [text for text, _ in tokens]
+        self.token_ids = [token_id for _, token_id in tokens]
+
+        special_tokens = [(text, token_id) for text, token_id in tokens
+                          if not all(is_plain_string_character(char) for char in text)]
+        self.special_texts = [text for text, _ in special_tokens]
+        self.special_ids = [token_id for _, token_id in special_tokens]
+
+        self.plain_string_mask = torch.zeros(self.vocab_size, dtype=torch.bool)
+        plain_ids = [token_id for text, token_id in tokens if all(is_plain_string_character(char) for char in text)]
+        self.plain_string_mask[plain_ids] = True
+
+        self.token_string_by_id = token_strings
+        self.grammars = {}
+        self.masks = {}
+
+    def get_grammar(self, schema):
+        key = get_schema_key(schema)
+        if key not in self.grammars:
+            if len(self.grammars) >= self.max_cached_masks:
+                self.grammars.clear()
+            self.grammars[key] = JsonSchemaGrammar(schema)
+        return self.grammars[key]
+
+    def get_token_text(self, token_id):
+        if token_id < len(self.token_string_by_id):
+            return self.token_string_by_id[token_id]
+        return ''
+
+    def get_allowed_mask(self, grammar, state):
+        cache_key = (grammar.key, state)
+        mask = self.masks.get(cache_key)
+        if mask is not None:
+            return mask
+
+        mask = torch.zeros(self.vocab_size, dtype=torch.bool)
+        if grammar.is_complete(state):
+            mask[self.eos_token_ids] = True
+        elif grammar.is_in_string_body(state):
+            # Tokens without quotes, backslashes or control characters just extend the string. Only the remaining
+            # tokens have to be checked against the grammar.
+            mask |= self.plain_string_mask
+            allowed_ids = self._search(grammar, state, self.special_texts, self.special_ids)
+            mask[allowed_ids] = True
+        else:
+            allowed_ids = self._search(grammar, state, self.token_texts, self.token_ids)
+            mask[allowed_ids] = True
+
+        if len(self.masks) >= self.max_cached_masks:
+            self.masks.clear()
+        self.masks[cache_key] = mask
+        return mask
+
+    @staticmethod
+    def _search(grammar, state, texts, ids):
+        allowed_ids = []
+        stack = [(state, 0, 0, len(texts))]
+        while stack:
+            current_state, depth, low, high = stack.pop()
+            index = low
+            while index < high:
+                text = texts[index]
+                if len(text) == depth:
+                    # the whole token has been matched
+                    allowed_ids.append(ids[index])
+                    index += 1
+                    continue
+                char = text[depth]
+                prefix = text[:depth] + chr(ord(char) + 1) if ord(char) < 0x10FFFF else None
+                end = bisect.bisect_left(texts, prefix, index, high) if prefix is not None else high
+                next_state = grammar.advance(current_state, char)
+                if next_state is not None:
+                    stack.append((next_state, depth + 1, index, end))
+                index = end
+        return allowed_ids
+
+
+class JsonSchemaLogitsProcessor(LogitsProcessor):
+    """
+    Masks every token that would make the generated text of a row violate the row's JSON schema.
+
+    The state of a row is kept for every generated prefix, as assisted generation calls the processor for several
+    draft tokens at once, for the draft model as well, and rolls rejected draft tokens back.
+    """
+
+    def __init__(self, token_index, schemas, prompt_length):
+        self.token_index = token_index
+        self.grammars = [token_index.get_grammar(schema) for schema in schemas]
+        # generated token ids of each row and the grammar states after each prefix of them
+        self.token_ids = [[] for _ in self.grammars]
+        self.states = [[grammar.initial_state()] for grammar in self.grammars]
+        self.prompt_length = prompt_length
+
+    def __call__(self, input_ids, scores):
+        if len(self.grammars) != input_ids.shape[0]:
+            # generate() repeats each prompt num_return_sequences times
+            repeats = input_ids.shape[0] // len(self.grammars)
+            self.grammars = [grammar for grammar in self.grammars for _ in range(repeats)]
+            self.token_ids = [list(token_ids) for token_ids in self.token_ids for _ in range(repeats)]
+            self.states = [list(states) for states in self.states for _ in range(repeats)]
+
+        generated_ids = input_ids[:, self.prompt_length:].tolist()
+        for row, (grammar, token_ids) in enumerate(zip(self.grammars, generated_ids)):
+            state = self._advance_row(row, token_ids)
+            if state is None:
+                # the row left the grammar (e.g. it was padded after finishing), do not constrain it any further
+                continue
+            mask = self.token_index.get_allowed_mask(grammar, state).to(scores.device)
+            row_scores = scores[row, :mask.shape[0]]
+            row_scores.masked_fill_(~mask[:row_scores.shape[0]], float('-inf'))
+            # the embedding matrix may be padded beyond the tokenizer, these ids are no tokens of the grammar either
+            scores[row, mask.shape[0]:] = float('-inf')
+        return scores
+
+    def _advance_row(self, row, token_ids):
+        """Returns the state of the row after the given generated token ids, reusing the states of their prefix."""
+        known_ids, states = self.token_ids[row], self.states[row]
+        if known_ids != token_ids[:len(known_ids)]:
+            common_length = 0
+            for known_id, token_id in zip(known_ids, token_ids):
+                if known_id != token_id:
+                    break
+                common_length += 1
+            del known_ids[common_length:]
+            del states[common_length + 1:]
+
+        grammar = self.grammars[row]
+        for token_id in token_ids[len(known_ids):]:
+            state = states[-1]
+            if state is not None and not grammar.is_complete(state):
+                state = grammar.advance(state, self.token_index.get_token_text(token_id))
+            known_ids.append(token_id)
+            states.append(state)
+        return states[-1]
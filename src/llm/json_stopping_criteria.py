@@ -0,0 +1,70 @@
+import torch
+from transformers import StoppingCriteria
+
+
+class JsonObjectTracker:
+    """Tracks the brace balance of generated text and detects when the first top level JSON object is closed."""
+
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.closed = False
+
+    def feed(self, text):
+        for char in text:
+            if self.closed:
+                return True
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = self.depth > 0
+            elif char == '{':
+                self.depth += 1
+            elif char == '}' and self.depth > 0:
+                self.depth -= 1
+                self.closed = self.depth == 0
+        return self.closed
+
+
+class JsonObjectStoppingCriteria(StoppingCriteria):
+    """
+    Stops every row of a batch as soon as its top level JSON object is complete, instead of letting the model append
+    commentary until EOS or max_new_tokens.
+    """
+
+    def __init__(self, token_strings, prompt_length, max_new_tokens):
+        self.token_strings = token_strings
+        self.prompt_length = prompt_length
+        self.max_new_tokens = max_new_tokens
+        self.trackers = None
+        # assisted generation accepts several tokens per step, all tokens after these lengths are fed
+        self.fed_lengths = None
+        self.stopped_sequences = 0
+        self.saved_tokens = 0
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.trackers is None:
+            self.trackers = [JsonObjectTracker() for _ in range(input_ids.shape[0])]
+            self.fed_lengths = [self.prompt_length] * input_ids.shape[0]
+
+        generated_length = input_ids.shape[1] - self.prompt_length
+        is_done = []
+        for row, tracker in enumerate(self.trackers):
+            if tracker.closed:
+                is_done.append(True)
+                continue
+            new_ids = input_ids[row, self.fed_lengths[row]:].tolist()
+            self.fed_lengths[row] = input_ids.shape[1]
+            text = ''.join(self.token_strings[token_id] if token_id < len(self.token_strings) else ''
+                           for token_id in new_ids)
+            if tracker.feed(text):
+                self.stopped_sequences += 1
+                self.saved_tokens += max(0, self.max_new_tokens - generated_length)
+            is_done.append(tracker.closed)
+        return torch.tensor(is_done, dtype=torch.bool, device=input_ids.device)
@@ -0,0 +1,45 @@
+import torch
+from transformers import DynamicCache
+
+
+def get_cache_layers(cache):
+    """Returns the (keys, values) tensors of every layer, each of shape (batch, heads, length, head_dim)."""
+    return [(layer.keys, layer.values) for layer in cache.layers]
+
+
+def build_cache(layers):
+    return DynamicCache(ddp_cache_data=layers)
+
+
+def left_pad_layers(layers, length):
+    """Pads the sequence dimension of all layers on the left with zeros up to the given length."""
+    padded_layers = []
+    for keys, values in layers:
+        padding = length - keys.shape[2]
+        if padding > 0:
+            keys = torch.nn.functional.pad(keys, (0, 0, padding, 0))
+            values = torch.nn.functional.pad(values, (0, 0, padding, 0))
+        padded_layers.append((keys, values))
+    return padded_layers
+
+
+def concat_layers(first_layers, second_layers):
+    """Stacks the rows of two caches, the shorter one is left padded to the length of the longer one."""
+    length = max(first_layers[0][0].shape[2], second_layers[0][0].shape[2])
+    first_layers = left_pad_layers(first_layers, length)
+    second_layers = left_pad_layers(second_layers, length)
+    return [(torch.cat([first_keys, second_keys]), torch.cat([first_values, second_values]))
+            for (first_keys, first_values), (second_keys, second_values) in zip(first_layers, second_layers)]
+
+
+def select_layer_rows(layers, rows):
+    """Keeps (or repeats) the given rows of all layers, rows is a list or a tensor of row indices."""
+    rows = torch.as_tensor(rows, device=layers[0][0].device)
+    return [(keys.index_select(0, rows), values.index_select(0, rows)) for keys, values in layers]
+
+
+def trim_layers_left(layers, columns):
+    """Drops the first columns of the sequence dimension, e.g. padding no remaining row attends to anymore."""
+    if columns <= 0:
+        return layers
+    return [(keys[:, :, columns:], values[:, :, columns:]) for keys, values in layers]
@@ -0,0 +1,226 @@
+import inspect
+import json
+from abc import ABC, abstractmethod
+
+from llm.completion_cache import CompletionCache
+from llm.metrics import LLMMetrics
+from util.logging import log_info, log_warning
+
+SYSTEM_PROMPT = (
+    "You are a highly specialized sociologist and economist with extensive, "
+    "evidence-based knowledge of German cultural, behavioral, and economic patterns. "
+    "When given descriptions of specific individuals living in Germany, you must provide detailed, "
+    "realistic, and unbiased sociological and economic insights that accurately reflect "
+    "contemporary social and economic dynamics. Ensure every output is strictly valid JSON."
+)
+
+
+class LLMBackend(ABC):
+    """
+    Interface the pipeline stages use to talk to an LLM. Backends only implement the uncached generation, prompt
+    formatting and the completion cache are shared.
+    """
+
+    def __init__(self, model_id, n_predict=700, gpu_id=0, cache_path=None, cache_max_entries=1000000,
+                 sample_temperature=0.8, sample_top_p=0.95, constrained_decoding=False, metrics_path=None,
+                 metrics_log_interval=60):
+        self.model_id = model_id
+        self.n_predict = n_predict
+        self.gpu_id = gpu_id
+        self.sample_temperature = sample_temperature
+        self.sample_top_p = sample_top_p
+        self.constrained_decoding = constrained_decoding
+
+        self.cache = CompletionCache(cache_path, cache_max_entries) if cache_path else None
+        self.metrics = LLMMetrics(gpu_id, metrics_path, metrics_log_interval, model_id)
+        # pipeline stage of the running call, backends record their batches under it
+        self.stage = None
+        # backends that share the prefill of the instructions within a stage ask for prompts that end with the persona
+        self.prefix_caching = False
+        # backends that reuse the encoded persona across stages ask for prompts that start with it
+        self.agent_prefix_caching = False
+        # agent specific leading part of each prompt of the running call
+        self.agent_prefixes = {}
+        # backends that answer later (offline batches) return empty completions meanwhile, which are not repaired
+        self.defers_completions = False
+
+        self.system_prompt = SYSTEM_PROMPT
+
+    def get_messages(self, prompt):
+        return [
+            {"role": "system", "content": self.system_prompt},
+            {"role": "user", "content": prompt},
+        ]
+
+    def get_generation_parameters(self):
+        return {'n_predict': self.n_predict}
+
+    def get_sampling_parameters(self):
+        return {'do_sample': True, 'temperature': self.sample_temperature, 'top_p': self.sample_top_p}
+
+    def get_completion(self, prompt, schema=None, stage=None):
+        return self.get_completions([prompt], [schema] if schema else None, stage)[0]
+
+    def get_completions(self, prompts, schemas=None, stage=None, agent_prefixes=None):
+        """
+        Generates one completion per prompt. If constrained decoding is enabled, schemas[i] is the JSON schema the
+        completion of prompts[i] is forced to follow. The metrics of the call are recorded under the given stage.
+        agent_prefixes[i] is the leading part of prompts[i] that belongs to one agent (see agent_prefix_caching).
+        """
+        self.stage = stage
+        self.agent_prefixes = dict(zip(prompts, agent_prefixes)) if agent_prefixes else {}
+        with self.metrics.measure_call(stage, len(prompts)):
+            return self._get_completions(prompts, schemas)
+
+    def get_sampled_completions(self, prompts, num_return_sequences, schemas=None, stage=None):
+        """
+        Samples num_return_sequences[i] different completions for prompts[i] and returns one list of completions per
+        prompt. All sequences of a prompt share its prefill, which is far cheaper than sending the prompt repeatedly.
+        """
+        self.stage = stage
+        with self.metrics.measure_call(stage, sum(num_return_sequences)):
+            return self._get_sampled_completions(prompts, num_return_sequences, schemas)
+
+    def score_options(self, prompts, options, stage=None):
+        """
+        Returns for every prompt the log-probabilities of its options[i] as the complete answer, without generating.
+        Backends that cannot score raise a NotImplementedError.
+        """
+        self.stage = stage
+        with self.metrics.measure_call(stage, len(prompts)):
+            keys = [CompletionCache.get_key(self.model_id, {**self.get_generation_parameters(), 'scoring': True},
+                                            self._get_cache_content(prompt, None, index) + [options[index]])
+                    for index, prompt in enumerate(prompts)]
+
+            def generate(indices):
+                scores = self._get_uncached_option_scores([prompts[index] for index in indices],
+                                                          [options[index] for index in indices])
+                return [json.dumps(option_scores) for option_scores in scores]
+
+            return [json.loads(scores) for scores in self._get_cached_completions(keys, generate)]
+
+    def evict_completions(self, prompts, schemas=None):
+        """Removes the cached completions of the prompts, e.g. the ones that could not be parsed."""
+        if self.cache is None or not prompts:
+            return
+        self.cache.delete_many(self._get_cache_keys(prompts, self._get_active_schemas(schemas)))
+
+    def record_parse_results(self, stage, parsed_responses, parse_failures):
+        self.metrics.record_parse_results(stage, parsed_responses, parse_failures)
+
+    def _get_completions(self, prompts, schemas=None):
+        schemas = self._get_active_schemas(schemas)
+        keys = self._get_cache_keys(prompts, schemas)
+        return self._get_cached_completions(keys, lambda indices: self._get_uncached_completions(
+            [prompts[index] for index in indices],
+            [schemas[index] for index in indices] if schemas else None))
+
+    def _get_sampled_completions(self, prompts, num_return_sequences, schemas=None):
+        schemas = self._get_active_schemas(schemas)
+        keys = self._get_cache_keys(prompts, schemas, num_return_sequences)
+
+        def generate(indices):
+            sampled_completions = self._get_uncached_sampled_completions(
+                [prompts[index] for index in indices],
+                [num_return_sequences[index] for index in indices],
+                [schemas[index] for index in indices] if schemas else None)
+            return [json.dumps(completions, ensure_ascii=False) if completions is not None else None
+                    for completions in sampled_completions]
+
+        return [json.loads(completions) if completions else [''] * count
+                for completions, count in zip(self._get_cached_completions(keys, generate, num_return_sequences),
+                                              num_return_sequences)]
+
+    def log_early_stopping_stats(self, stage):
+        pass
+
+    @abstractmethod
+    def _get_uncached_completions(self, prompts, schemas=None):
+        pass
+
+    @abstractmethod
+    def _get_uncached_sampled_completions(self, prompts, num_return_sequences, schemas=None):
+        pass
+
+    def _get_uncached_option_scores(self, prompts, options):
+        raise NotImplementedError(f'{type(self).__name__} does not support scoring options')
+
+    def _get_active_schemas(self, schemas):
+        if not self.constrained_decoding or not schemas:
+            return None
+        return schemas
+
+    def _get_cache_keys(self, prompts, schemas=None, num_return_sequences=None):
+        """Returns the cache keys of the completions of the prompts, with num_return_sequences of sampled ones."""
+        generation_parameters = self.get_generation_parameters()
+        if num_return_sequences is not None:
+            generation_parameters = {**generation_parameters, **self.get_sampling_parameters()}
+        return [CompletionCache.get_key(self.model_id, generation_parameters,
+                                        self._get_cache_content(prompt, schemas, index) +
+                                        ([num_return_sequences[index]] if num_return_sequences is not None else []))
+                for index, prompt in enumerate(prompts)]
+
+    def _get_cache_content(self, prompt, schemas, index):
+        if schemas:
+            return [self.system_prompt, prompt, schemas[index]]
+        return [self.system_prompt, prompt]
+
+    def _get_cached_completions(self, keys, generate, completion_counts=None):
+        """
+        Looks the keys up in the cache and calls generate with the indices of the missing ones. Responses that could
+        not be generated (None) are returned as empty strings and are not cached. completion_counts is the number of
+        completions behind each key, for the metrics.
+        """
+        if self.cache is None:
+            return [response if response is not None else '' for response in generate(list(range(len(keys))))]
+
+        cached_responses = self.cache.get_many(keys)
+
+        # identical prompts within one call only have to be generated once
+        missing_indices = []
+        missing_keys = set()
+        for index, key in enumerate(keys):
+            if key not in cached_responses and key not in missing_keys:
+                missing_indices.append(index)
+                missing_keys.add(key)
+
+        self.metrics.record_cached_completions(self.stage, sum(
+            completion_counts[index] if completion_counts else 1
+            for index, key in enumerate(keys) if key in cached_responses))
+
+        generated_responses = generate(missing_indices) if missing_indices else []
+        new_responses = {keys[index]: response for index, response in zip(missing_indices, generated_responses)
+                         if response is not None}
+        self.cache.put_many(new_responses)
+        cached_responses.update(new_responses)
+
+        stats = self.cache.get_stats()
+        log_info(f'[LLM_CACHE] [GPU {self.gpu_id}] {stats["hits"]} hits, {stats["misses"]} misses '
+                 f'(hit rate {stats["hit_rate"]:.1%}).')
+        return [cached_responses.get(key, '') for key in keys]
+
+
+def create_llm_backend(gpu_id=0, llm_config=None):
+    """
+    Creates the backend selected by the 'backend' entry of the llm config ('huggingface', 'openai', 'mock' or
+    'offline'), the other entries are passed to its constructor. Entries the backend does not support (e.g.
+    'batch_size' for 'openai') are ignored, so that one config can be used with every backend.
+    """
+    llm_config = dict(llm_config or {})
+    backend = llm_config.pop('backend', 'huggingface')
+    if backend == 'huggingface':
+        from llm.huggingface_chat_api import HuggingfaceChatAPI as backend_class
+    elif backend == 'openai':
+        from llm.openai_chat_api import OpenAIChatAPI as backend_class
+    elif backend == 'mock':
+        from llm.mock_chat_api import MockChatAPI as backend_class
+    elif backend == 'offline':
+        from llm.offline_batch import OfflineBatchAPI as backend_class
+    else:
+        raise NotImplementedError(f'LLM backend "{backend}" not implemented')
+
+    parameters = inspect.signature(backend_class.__init__).parameters
+    ignored_keys = [key for key in llm_config if key not in parameters]
+    if ignored_keys:
+        log_warning(f'[LLM] Config entries not supported by the {backend} backend are ignored: {ignored_keys}')
+    return backend_class(gpu_id=gpu_id, **{key: value for key, value in llm_config.items() if key in parameters})
@@ -0,0 +1,164 @@
+import itertools
+import json
+import os
+import time
+from contextlib import contextmanager
+
+from util.file import create_folders, write_file
+from util.logging import log_info
+
+DEFAULT_STAGE = 'DEFAULT'
+
+
+def get_empty_stage_metrics():
+    return {
+        'calls': 0,
+        'completions': 0,
+        'cached_completions': 0,
+        'prompt_tokens': 0,
+        'prefix_cached_tokens': 0,
+        'generated_tokens': 0,
+        'wall_time': 0.0,
+        'batches': 0,
+        'batch_size_sum': 0,
+        'max_batch_size': 0,
+        'parsed_responses': 0,
+        'parse_failures': 0,
+    }
+
+
+def merge_stage_metrics(metrics, other_metrics):
+    for key, value in other_metrics.items():
+        if key == 'max_batch_size':
+            metrics[key] = max(metrics.get(key, 0), value)
+        elif key in get_empty_stage_metrics():
+            metrics[key] = metrics.get(key, 0) + value
+    return metrics
+
+
+def summarize_stage_metrics(metrics):
+    """Adds the derived rates to the raw counters of a stage."""
+    generated_completions = metrics['completions'] - metrics['cached_completions']
+    return {
+        **metrics,
+        'tokens_per_second': _divide(metrics['generated_tokens'], metrics['wall_time']),
+        'mean_batch_size': _divide(metrics['batch_size_sum'], metrics['batches']),
+        'mean_prompt_tokens': _divide(metrics['prompt_tokens'], generated_completions),
+        'prefix_cache_rate': _divide(metrics['prefix_cached_tokens'], metrics['prompt_tokens']),
+        'mean_generated_tokens': _divide(metrics['generated_tokens'], generated_completions),
+        'parse_failure_rate': _divide(metrics['parse_failures'],
+                                      metrics['parsed_responses'] + metrics['parse_failures']),
+    }
+
+
+def _divide(numerator, denominator):
+    return numerator / denominator if denominator > 0 else 0.0
+
+
+def merge_worker_metrics(worker_metrics):
+    """Merges the metrics files of all workers into per stage totals, keeping the per worker summaries as well."""
+    stages = {}
+    for metrics in worker_metrics:
+        for stage, stage_metrics in metrics['stages'].items():
+            merge_stage_metrics(stages.setdefault(stage, get_empty_stage_metrics()), stage_metrics)
+    return {
+        # wall times of parallel workers add up, so the total tokens/s is the sum of the workers' rates
+        'stages': {stage: {**summarize_stage_metrics(metrics),
+                           'tokens_per_second': sum(worker['stages'][stage]['tokens_per_second']
+                                                    for worker in worker_metrics if stage in worker['stages']),
+                           'model_ids': sorted({worker.get('model_id') or '' for worker in worker_metrics
+                                                if stage in worker['stages']})}
+                   for stage, metrics in stages.items()},
+        'workers': worker_metrics
+    }
+
+
+def log_stage_metrics(worker_id, stage, metrics):
+    log_info(f'[LLM_METRICS] [GPU {worker_id}] [{stage}] {metrics["completions"]} completions '
+             f'({metrics["cached_completions"]} cached), {metrics["prompt_tokens"]} prompt tokens '
+             f'({metrics["prefix_cache_rate"]:.1%} from the prefix cache), '
+             f'{metrics["generated_tokens"]} generated tokens, {metrics["tokens_per_second"]:.1f} tokens/s, '
+             f'mean batch size {metrics["mean_batch_size"]:.1f}, {metrics["parse_failure_rate"]:.1%} parse failures.')
+
+
+def log_merged_metrics(metrics):
+    for stage, stage_metrics in metrics['stages'].items():
+        log_stage_metrics('ALL', stage, stage_metrics)
+
+
+class LLMMetrics:
+    """
+    Token, throughput, batch size and parse failure counters of one backend instance, per pipeline stage. If a
+    metrics path is set, the counters are written to a JSON file there after every call, so that Storage can merge the
+    files of all worker processes (one file per backend, as a worker may serve several models).
+    """
+
+    _instance_ids = itertools.count()
+
+    def __init__(self, worker_id, metrics_path=None, log_interval=60, model_id=None):
+        self.worker_id = worker_id
+        self.model_id = model_id
+        self.instance_id = next(LLMMetrics._instance_ids)
+        self.metrics_path = metrics_path
+        self.log_interval = log_interval
+        self.stages = {}
+        self.last_log_time = time.monotonic()
+
+        if self.metrics_path:
+            create_folders(self.metrics_path)
+
+    def get_stage(self, stage):
+        return self.stages.setdefault(stage or DEFAULT_STAGE, get_empty_stage_metrics())
+
+    @contextmanager
+    def measure_call(self, stage, num_completions):
+        metrics = self.get_stage(stage)
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            metrics['calls'] += 1
+            metrics['completions'] += num_completions
+            metrics['wall_time'] += time.perf_counter() - start_time
+            self.flush()
+
+    def record_cached_completions(self, stage, count):
+        self.get_stage(stage)['cached_completions'] += count
+
+    def record_batch(self, stage, batch_size, prompt_tokens, generated_tokens):
+        self.record(stage, {
+            'batches': 1,
+            'batch_size_sum': batch_size,
+            'max_batch_size': batch_size,
+            'prompt_tokens': prompt_tokens,
+            'generated_tokens': generated_tokens
+        })
+
+    def record(self, stage, metrics):
+        merge_stage_metrics(self.get_stage(stage), metrics)
+
+    def record_parse_results(self, stage, parsed_responses, parse_failures):
+        metrics = self.get_stage(stage)
+        metrics['parsed_responses'] += parsed_responses
+        metrics['parse_failures'] += parse_failures
+        self.flush()
+
+    def get_summary(self):
+        return {
+            'worker_id': self.worker_id,
+            'model_id': self.model_id,
+            'pid': os.getpid(),
+            'stages': {stage: summarize_stage_metrics(metrics) for stage, metrics in self.stages.items()}
+        }
+
+    def flush(self):
+        if self.metrics_path:
+            write_file(f'{self.metrics_path}/worker_{self.worker_id}_{os.getpid()}_{self.instance_id}.json',
+                       json.dumps(self.get_summary(), indent=2))
+        if time.monotonic() - self.last_log_time >= self.log_interval:
+            self.last_log_time = time.monotonic()
+            self.log()
+
+    def log(self):
+        for stage, metrics in self.get_summary()['stages'].items():
+            log_stage_metrics(self.worker_id, stage, metrics)
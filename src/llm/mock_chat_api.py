@@ -0,0 +1,159 @@
+import json
+import math
+import random
+
+from llm.llm_backend import LLMBackend
+
+# Share of the modes in Berlin (SrV 2018), used to draw means_of_transport among the available options
+MODAL_SPLIT = {'walk': 0.30, 'bicycle': 0.18, 'public transport': 0.27, 'car': 0.25}
+
+# Keywords of building categories that fit the activities of the schedule templates
+ACTIVITY_KEYWORDS = {
+    'work': ['office', 'commercial', 'industrial', 'retail', 'warehouse', 'hospital', 'government', 'civic'],
+    'education': ['school', 'university', 'college', 'kindergarten'],
+    'shopping': ['supermarket', 'retail', 'shop', 'kiosk', 'mall', 'commercial'],
+    'leisure': ['sports', 'restaurant', 'cafe', 'church', 'theatre', 'cinema', 'park', 'stadium', 'civic'],
+}
+
+# Activity templates: (activity, earliest start, latest start in minutes, probability the activity takes place)
+SCHEDULE_TEMPLATES = {
+    'worker': [('home', 360, 420, 1.0), ('work', 450, 540, 1.0), ('leisure', 720, 780, 0.2),
+               ('work', 790, 840, 0.2), ('shopping', 1020, 1110, 0.5), ('home', 1110, 1200, 1.0),
+               ('leisure', 1200, 1260, 0.2), ('home', 1290, 1350, 0.2)],
+    'student': [('home', 390, 430, 1.0), ('education', 450, 480, 1.0), ('leisure', 840, 930, 0.5),
+                ('home', 960, 1080, 1.0)],
+    'retiree': [('home', 420, 540, 1.0), ('shopping', 570, 660, 0.8), ('home', 690, 720, 0.5),
+                ('leisure', 840, 960, 0.6), ('home', 990, 1080, 1.0)],
+    'caretaker': [('home', 390, 420, 1.0), ('education', 450, 480, 0.7), ('shopping', 540, 600, 0.8),
+                  ('home', 630, 690, 1.0), ('education', 780, 810, 0.7), ('leisure', 840, 900, 0.4),
+                  ('home', 930, 1020, 1.0)],
+}
+
+ACTIONS = {
+    'home': ['Wake up and get ready for the day', 'Come home and relax', 'Have dinner at home'],
+    'work': ['Start working', 'Continue working after the break'],
+    'education': ['Attend classes', 'Bring the children to school'],
+    'shopping': ['Buy groceries', 'Run some errands'],
+    'leisure': ['Meet friends', 'Do some sports', 'Have lunch'],
+}
+
+PERSONAS = [
+    'lives in a small apartment in Berlin and values a calm daily routine',
+    'is a sociable Berliner who likes to spend time with friends after work',
+    'has lived in Berlin for many years and knows the neighbourhood well',
+    'is careful with money and plans errands efficiently',
+]
+
+
+class MockChatAPI(LLMBackend):
+    """
+    Backend without a model for load-testing the rest of the pipeline. The completions are valid instances of the
+    JSON schemas the stages pass (persona descriptions, day schedules from activity templates over the building
+    categories of the schema, and mode choices drawn from the Berlin modal split), and deterministic per seed and prompt.
+    """
+
+    def __init__(self, model_id='mock', n_predict=700, gpu_id=0, seed=0, cache_path=None, cache_max_entries=1000000,
+                 sample_temperature=0.8, sample_top_p=0.95, constrained_decoding=True, metrics_path=None,
+                 metrics_log_interval=60):
+        super().__init__(model_id, n_predict, gpu_id, cache_path, cache_max_entries, sample_temperature, sample_top_p,
+                         constrained_decoding, metrics_path, metrics_log_interval)
+        self.seed = seed
+
+    def get_generation_parameters(self):
+        return {'n_predict': self.n_predict, 'seed': self.seed}
+
+    def _get_active_schemas(self, schemas):
+        # the schemas are what the mock completions are generated from, so they are used regardless of the setting
+        return schemas
+
+    def _get_uncached_completions(self, prompts, schemas=None):
+        return [self._get_mock_completions(prompt, schemas[index] if schemas else None, 1)[0]
+                for index, prompt in enumerate(prompts)]
+
+    def _get_uncached_sampled_completions(self, prompts, num_return_sequences, schemas=None):
+        return [self._get_mock_completions(prompt, schemas[index] if schemas else None, count)
+                for index, (prompt, count) in enumerate(zip(prompts, num_return_sequences))]
+
+    def _get_uncached_option_scores(self, prompts, options):
+        scores = []
+        for prompt, prompt_options in zip(prompts, options):
+            rng = random.Random(f'{self.seed}:{prompt}')
+            # log-probabilities of the modal split shares, perturbed per prompt and normalized over the options
+            weights = [MODAL_SPLIT.get(option, 0.1) * rng.uniform(0.5, 1.5) for option in prompt_options]
+            scores.append([math.log(weight / sum(weights)) for weight in weights])
+            self.metrics.record_batch(self.stage, len(prompt_options), len(prompt) // 4, 0)
+        return scores
+
+    def _get_mock_completions(self, prompt, schema, count):
+        completions = []
+        for sequence in range(count):
+            rng = random.Random(f'{self.seed}:{sequence}:{prompt}')
+            value = self._generate(schema, rng, prompt) if schema else {'response': 'mock'}
+            completions.append(json.dumps(value, ensure_ascii=False))
+        self.metrics.record_batch(self.stage, count, len(prompt) // 4,
+                                  sum(len(completion) // 4 for completion in completions))
+        return completions
+
+    def _generate(self, schema, rng, prompt, name=None):
+        if 'const' in schema:
+            return schema['const']
+        if name == 'description_of_today':
+            return self._generate_day_schedule(schema, rng, prompt)
+        if name == 'means_of_transport' and 'enum' in schema:
+            options = schema['enum']
+            return rng.choices(options, weights=[MODAL_SPLIT.get(option, 0.1) for option in options])[0]
+        if 'enum' in schema:
+            return rng.choice(schema['enum'])
+
+        schema_type = schema.get('type')
+        if schema_type == 'object':
+            return {property_name: self._generate(property_schema, rng, prompt, property_name)
+                    for property_name, property_schema in schema.get('properties', {}).items()}
+        if schema_type == 'array':
+            if 'prefixItems' in schema:
+                return [self._generate(item, rng, prompt) for item in schema['prefixItems']]
+            return [self._generate(schema['items'], rng, prompt) for _ in range(max(1, schema.get('minItems', 1)))]
+        if name == 'persona_description':
+            return f'A person who {rng.choice(PERSONAS)}.'
+        if name == 'reasoning':
+            return 'This is the most convenient option for this trip.'
+        return 'mock'
+
+    @staticmethod
+    def _generate_day_schedule(schema, rng, prompt):
+        task_properties = schema['items']['properties']
+        building_types = [building_type for building_type in task_properties['building_type']['enum']
+                          if building_type != 'home']
+
+        lowered_prompt = prompt.lower()
+        if 'retire' in lowered_prompt or 'pension' in lowered_prompt:
+            template = SCHEDULE_TEMPLATES['retiree']
+        elif 'student' in lowered_prompt or 'pupil' in lowered_prompt:
+            template = SCHEDULE_TEMPLATES['student']
+        else:
+            template = SCHEDULE_TEMPLATES[rng.choices(['worker', 'student', 'retiree', 'caretaker'],
+                                                      weights=[0.55, 0.15, 0.2, 0.1])[0]]
+
+        tasks = []
+        for activity, earliest, latest, probability in template:
+            if rng.random() > probability:
+                continue
+            if activity == 'home':
+                building_type = 'home'
+            else:
+                matching_types = [building_type for building_type in building_types
+                                  if any(keyword in building_type.lower() for keyword in ACTIVITY_KEYWORDS[activity])]
+                building_type = rng.choice(matching_types or building_types or ['home'])
+            if tasks and tasks[-1]['building_type'] == building_type:
+                continue
+            minutes = rng.randrange(earliest, latest + 1, 5) if latest > earliest else earliest
+            actions = ACTIONS[activity]
+            if activity == 'home':
+                # the day starts with getting up, returning home comes later
+                actions = actions[:1] if not tasks else actions[1:]
+            tasks.append({
+                'time': f'{minutes // 60:02}:{minutes % 60:02}',
+                'action': rng.choice(actions),
+                'building_type': building_type,
+            })
+        return tasks
@@ -0,0 +1,127 @@
+import json
+import os
+import time
+
+from llm.completion_cache import CompletionCache
+from llm.llm_backend import LLMBackend
+from util.logging import log_info, log_warning
+
+DEFAULT_OFFLINE_PATH = 'cache/offline_batch'
+
+
+def get_requests_folder(offline_path):
+    return os.path.join(offline_path, 'requests')
+
+
+def get_responses_folder(offline_path):
+    return os.path.join(offline_path, 'responses')
+
+
+def get_request_files(offline_path):
+    requests_folder = get_requests_folder(offline_path)
+    if not os.path.exists(requests_folder):
+        return []
+    return sorted(file_name for file_name in os.listdir(requests_folder) if file_name.endswith('.jsonl'))
+
+
+def get_pending_request_files(offline_path, run_id=None):
+    """Returns the request files (of the run, if given) that have no response file yet."""
+    responses_folder = get_responses_folder(offline_path)
+    return [file_name for file_name in get_request_files(offline_path)
+            if (run_id is None or file_name.startswith(f'{run_id}_')) and
+            not os.path.exists(os.path.join(responses_folder, file_name))]
+
+
+def read_jsonl(file_path):
+    with open(file_path, 'r') as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def write_jsonl(file_path, records):
+    """Writes the records under a temporary name first, so that readers never see a partial file."""
+    temporary_path = f'{file_path}.{os.getpid()}.tmp'
+    with open(temporary_path, 'w') as file:
+        for record in records:
+            file.write(json.dumps(record, ensure_ascii=False) + '\n')
+    os.replace(temporary_path, file_path)
+
+
+def ingest_response_files(offline_path, cache_path, cache_max_entries=1000000):
+    """
+    Puts all responses of the offline batches into the completion cache. Their custom_id is the cache key of the
+    request, so a rerun of the pipeline finds the completions as cache hits. Returns the number of responses.
+    """
+    responses_folder = get_responses_folder(offline_path)
+    if not os.path.exists(responses_folder):
+        return 0
+    cache = CompletionCache(cache_path, cache_max_entries)
+    count = 0
+    for file_name in sorted(os.listdir(responses_folder)):
+        if not file_name.endswith('.jsonl'):
+            continue
+        responses = {response['custom_id']: response['response']
+                     for response in read_jsonl(os.path.join(responses_folder, file_name))
+                     if response.get('response') is not None}
+        cache.put_many(responses)
+        count += len(responses)
+    cache.close()
+    log_info(f'[OFFLINE] {count} responses ingested into {cache_path}.')
+    return count
+
+
+class OfflineBatchAPI(LLMBackend):
+    """
+    Backend that does not generate, but writes every prompt missing in the completion cache as a request to a JSONL
+    file under offline_path/requests, one file per call. The files are answered in bulk and independently of the
+    pipeline (see scripts/llm/run_batch_inference.py), e.g. on a cluster, and the responses are ingested into the
+    completion cache, so that the next run of the pipeline gets them as cache hits.
+
+    Until then the completions are empty. As the repair of an empty completion would only emit another request, the
+    stages do not repair them (defers_completions). With an offline_run_id the file names start with it, so that a run
+    only waits for the requests it wrote itself and not for stale ones of other runs or configs in offline_path.
+    """
+
+    def __init__(self, model_id="Qwen/Qwen3-4B-Instruct-2507", n_predict=700, gpu_id=0,
+                 offline_path=DEFAULT_OFFLINE_PATH, cache_path=None, cache_max_entries=1000000, sample_temperature=0.8,
+                 sample_top_p=0.95, constrained_decoding=False, metrics_path=None, metrics_log_interval=60,
+                 offline_run_id=None):
+        super().__init__(model_id, n_predict, gpu_id, cache_path, cache_max_entries, sample_temperature, sample_top_p,
+                         constrained_decoding, metrics_path, metrics_log_interval)
+        self.offline_path = offline_path
+        self.offline_run_id = offline_run_id
+        self.defers_completions = True
+        if self.cache is None:
+            log_warning('[OFFLINE] Without a cache_path the responses of the offline batches cannot be used.')
+        os.makedirs(get_requests_folder(offline_path), exist_ok=True)
+
+    def _get_uncached_completions(self, prompts, schemas=None):
+        keys = self._get_cache_keys(prompts, schemas)
+        self._write_requests([self._get_request(key, prompt, schemas[index] if schemas else None)
+                              for index, (key, prompt) in enumerate(zip(keys, prompts))])
+        return [None] * len(prompts)
+
+    def _get_uncached_sampled_completions(self, prompts, num_return_sequences, schemas=None):
+        keys = self._get_cache_keys(prompts, schemas, num_return_sequences)
+        self._write_requests([{**self._get_request(key, prompt, schemas[index] if schemas else None),
+                               'num_return_sequences': num_return_sequences[index],
+                               'sampling_parameters': self.get_sampling_parameters()}
+                              for index, (key, prompt) in enumerate(zip(keys, prompts))])
+        return [None] * len(prompts)
+
+    def _get_request(self, key, prompt, schema):
+        return {
+            'custom_id': key,
+            'stage': self.stage,
+            'model_id': self.model_id,
+            'system_prompt': self.system_prompt,
+            'prompt': prompt,
+            'schema': schema,
+            'generation_parameters': self.get_generation_parameters(),
+        }
+
+    def _write_requests(self, requests):
+        file_name = f'{self.stage or "NONE"}_{self.gpu_id}_{os.getpid()}_{time.time_ns()}.jsonl'
+        if self.offline_run_id:
+            file_name = f'{self.offline_run_id}_{file_name}'
+        write_jsonl(os.path.join(get_requests_folder(self.offline_path), file_name), requests)
+        log_info(f'[OFFLINE] [GPU {self.gpu_id}] {len(requests)} requests written to {file_name}.')
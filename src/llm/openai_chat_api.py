@@ -0,0 +1,138 @@
+import asyncio
+import random
+
+import aiohttp
+
+from llm.llm_backend import LLMBackend
+from util.logging import log_error_without_trace, log_warning
+
+RETRY_STATUS_CODES = {408, 409, 425, 429, 500, 502, 503, 504}
+
+
+class RetryableResponseError(Exception):
+    pass
+
+
+def to_strict_json_schema(schema):
+    """Adds the 'required' and 'additionalProperties' entries strict structured output servers expect."""
+    if not isinstance(schema, dict):
+        return schema
+    strict_schema = {key: to_strict_json_schema(value) for key, value in schema.items()}
+    for key in ['items', 'prefixItems']:
+        if isinstance(schema.get(key), list):
+            strict_schema[key] = [to_strict_json_schema(item) for item in schema[key]]
+    if 'properties' in schema:
+        strict_schema['properties'] = {name: to_strict_json_schema(value)
+                                       for name, value in schema['properties'].items()}
+        strict_schema['required'] = list(schema['properties'].keys())
+        strict_schema['additionalProperties'] = False
+    return strict_schema
+
+
+class OpenAIChatAPI(LLMBackend):
+    """
+    Client for OpenAI compatible chat completion servers (e.g. vLLM or the llama.cpp server). All prompts of a call
+    are sent concurrently over a pooled connection, so that a continuous batching server can be saturated from a few
+    processes.
+    """
+
+    def __init__(self, model_id="Qwen/Qwen3-4B-Instruct-2507", n_predict=700, gpu_id=0,
+                 base_url="http://localhost:8000/v1", api_key="", max_concurrency=64, max_retries=5,
+                 request_timeout=600, cache_path=None, cache_max_entries=1000000, sample_temperature=0.8,
+                 sample_top_p=0.95, constrained_decoding=False, metrics_path=None, metrics_log_interval=60):
+        super().__init__(model_id, n_predict, gpu_id, cache_path, cache_max_entries, sample_temperature, sample_top_p,
+                         constrained_decoding, metrics_path, metrics_log_interval)
+        self.base_url = base_url.rstrip('/')
+        self.api_key = api_key
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.request_timeout = request_timeout
+
+        self.loop = asyncio.new_event_loop()
+        self.session = None
+        self.usage = {'prompt_tokens': 0, 'completion_tokens': 0}
+
+    def _get_uncached_completions(self, prompts, schemas=None):
+        payloads = [self._get_payload(prompt, schemas[index] if schemas else None)
+                    for index, prompt in enumerate(prompts)]
+        choices = self._run_requests(payloads)
+        return [choice[0] if choice else None for choice in choices]
+
+    def _get_uncached_sampled_completions(self, prompts, num_return_sequences, schemas=None):
+        payloads = [{**self._get_payload(prompt, schemas[index] if schemas else None),
+                     'n': num_return_sequences[index],
+                     'temperature': self.sample_temperature,
+                     'top_p': self.sample_top_p}
+                    for index, prompt in enumerate(prompts)]
+        return self._run_requests(payloads)
+
+    def _run_requests(self, payloads):
+        self.usage = {'prompt_tokens': 0, 'completion_tokens': 0}
+        choices = self.loop.run_until_complete(self._post_all(payloads))
+        # the concurrently sent requests are counted as one batch
+        self.metrics.record_batch(self.stage,
+                                  batch_size=len(payloads),
+                                  prompt_tokens=self.usage['prompt_tokens'],
+                                  generated_tokens=self.usage['completion_tokens'])
+        return choices
+
+    def _get_payload(self, prompt, schema=None):
+        payload = {
+            'model': self.model_id,
+            'messages': self.get_messages(prompt),
+            'max_tokens': self.n_predict,
+            'temperature': 0.0,
+        }
+        if schema:
+            payload['response_format'] = {
+                'type': 'json_schema',
+                'json_schema': {'name': 'response', 'schema': to_strict_json_schema(schema), 'strict': True}
+            }
+        return payload
+
+    def _get_session(self):
+        if self.session is None:
+            headers = {'Authorization': f'Bearer {self.api_key}'} if self.api_key else {}
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_concurrency),
+                timeout=aiohttp.ClientTimeout(total=self.request_timeout),
+                headers=headers
+            )
+        return self.session
+
+    async def _post_all(self, payloads):
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        return await asyncio.gather(*[self._post(payload, semaphore) for payload in payloads])
+
+    async def _post(self, payload, semaphore):
+        """Returns the message contents of all choices or None if the request failed after all retries."""
+        async with semaphore:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    async with self._get_session().post(f'{self.base_url}/chat/completions', json=payload) as response:
+                        if response.status in RETRY_STATUS_CODES:
+                            raise RetryableResponseError(f'HTTP {response.status}: {(await response.text())[:200]}')
+                        if response.status >= 400:
+                            log_error_without_trace(f'[LLM] Request rejected with HTTP {response.status}: '
+                                                    f'{(await response.text())[:200]}')
+                            return None
+                        data = await response.json()
+                    usage = data.get('usage') or {}
+                    for key in self.usage:
+                        self.usage[key] += usage.get(key) or 0
+                    choices = sorted(data['choices'], key=lambda choice: choice.get('index', 0))
+                    return [choice['message'].get('content') or '' for choice in choices]
+                except (aiohttp.ClientError, asyncio.TimeoutError, RetryableResponseError) as e:
+                    if attempt == self.max_retries:
+                        log_error_without_trace(f'[LLM] Request failed after {attempt + 1} attempts: {e}')
+                        return None
+                    # exponential backoff with jitter, so that retries of concurrent requests do not arrive together
+                    delay = min(2 ** attempt, 60) * (0.5 + random.random())
+                    log_warning(f'[LLM] Request failed ({e}), retrying in {delay:.1f}s...')
+                    await asyncio.sleep(delay)
+
+    def close(self):
+        if self.session is not None:
+            self.loop.run_until_complete(self.session.close())
+            self.session = None
+        self.loop.close()
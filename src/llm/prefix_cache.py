@@ -0,0 +1,169 @@
+import hashlib
+import os
+import shutil
+from collections import OrderedDict
+
+import torch
+
+
+class PrefixCache:
+    """
+    Keeps the KV cache of the token prefix the prompts of a stage share (system prompt, chat template and the static
+    instructions of the stage prompt), so that a prefill only has to process the agent specific suffix.
+
+    The shared prefix is learned from the prompts: the first prompt of a stage is stored, every further prompt shrinks
+    it to their common token prefix. Keys and values of a token only depend on the tokens before it, so the cache of a
+    shorter prefix is a slice of the stored one. A prompt sharing fewer than min_prefix_tokens with the stored prefix
+    is prefilled without it; only after max_misses such prompts in a row (e.g. a changed prompt template or system
+    prompt) the stored prefix is replaced, so that alternating prompts do not clone a new prefix for every prompt.
+    A different model means a different backend and thereby a different prefix cache.
+    """
+
+    def __init__(self, min_prefix_tokens=32, max_entries=4, max_misses=8):
+        self.min_prefix_tokens = min_prefix_tokens
+        self.max_entries = max_entries
+        self.max_misses = max_misses
+        # key -> (token ids, layers of shape (1, heads, len(token ids), head_dim))
+        self.prefixes = OrderedDict()
+        # key -> prompts in a row that did not share the stored prefix
+        self.misses = {}
+
+    def match(self, key, input_ids):
+        """
+        Returns the number of leading input_ids whose cache is available and the layers holding it (or 0 and None).
+        At least the last token is left out, as its logits are needed from the prefill.
+        """
+        if key not in self.prefixes:
+            return 0, None
+        prefix_ids, layers = self.prefixes[key]
+        self.prefixes.move_to_end(key)
+
+        common_length = self._get_common_length(prefix_ids, input_ids)
+        if common_length < self.min_prefix_tokens:
+            self.misses[key] = self.misses.get(key, 0) + 1
+            if self.misses[key] >= self.max_misses:
+                # the prompts of the stage changed, the prefix is replaced by the one of the next stored prompt
+                del self.prefixes[key]
+                del self.misses[key]
+            return 0, None
+        self.misses.pop(key, None)
+        if common_length < len(prefix_ids):
+            prefix_ids = prefix_ids[:common_length]
+            layers = [(keys[:, :, :common_length].clone(), values[:, :, :common_length].clone())
+                      for keys, values in layers]
+            self.prefixes[key] = (prefix_ids, layers)
+
+        length = min(common_length, len(input_ids) - 1)
+        if length < self.min_prefix_tokens:
+            return 0, None
+        return length, [(keys[:, :, :length], values[:, :, :length]) for keys, values in layers]
+
+    def contains(self, key):
+        return key in self.prefixes
+
+    def store(self, key, input_ids, layers):
+        """Stores the cache of a complete prompt, it is shrunk to the shared prefix by the following matches."""
+        self.prefixes[key] = (list(input_ids), [(keys.clone(), values.clone()) for keys, values in layers])
+        self.prefixes.move_to_end(key)
+        while len(self.prefixes) > self.max_entries:
+            evicted_key, _ = self.prefixes.popitem(last=False)
+            self.misses.pop(evicted_key, None)
+
+    @staticmethod
+    def _get_common_length(first_ids, second_ids):
+        length = 0
+        for first_id, second_id in zip(first_ids, second_ids):
+            if first_id != second_id:
+                break
+            length += 1
+        return length
+
+
+class AgentPrefixStore:
+    """
+    Keeps the KV cache of each agent's prompt prefix (system prompt and persona) across the stages, so that the
+    schedule and mode choice prompts of an agent only encode its persona once. The entries are keyed by the token ids
+    of the prefix, i.e. a changed persona or system prompt is a different entry.
+
+    The entries live in host memory (at most max_entries, least recently used first out). With an offload_path they
+    are also written to disk, where the workers of all processes find them, as the stages distribute the agents over
+    the workers independently. The path should be specific to the model and dtype, the entries are only valid for them.
+    The offloaded files take at most max_offload_bytes, the least recently used ones (by modification time, which a
+    hit renews) are deleted first. remove_offloaded_agent_prefixes deletes them at the end of the run.
+    """
+
+    def __init__(self, max_entries=1024, offload_path=None, max_offload_bytes=None):
+        self.max_entries = max_entries
+        self.offload_path = offload_path
+        self.max_offload_bytes = max_offload_bytes
+        self.entries = OrderedDict()
+        if offload_path:
+            os.makedirs(offload_path, exist_ok=True)
+
+    def get(self, token_ids, device):
+        key = self._get_key(token_ids)
+        layers = self.entries.get(key)
+        if layers is None and self.offload_path and os.path.exists(self._get_file_path(key)):
+            try:
+                layers = torch.load(self._get_file_path(key), map_location='cpu')
+                self._put_in_memory(key, layers)
+                os.utime(self._get_file_path(key))
+            except (OSError, RuntimeError, EOFError):
+                layers = None
+        if layers is None:
+            return None
+        self.entries.move_to_end(key)
+        return [(keys.to(device), values.to(device)) for keys, values in layers]
+
+    def put(self, token_ids, layers):
+        key = self._get_key(token_ids)
+        layers = [(keys.detach().to('cpu', copy=True), values.detach().to('cpu', copy=True)) for keys, values in layers]
+        self._put_in_memory(key, layers)
+        if self.offload_path and not os.path.exists(self._get_file_path(key)):
+            # written under a temporary name first, so that other processes never load a partial file
+            temporary_path = f'{self._get_file_path(key)}.{os.getpid()}.tmp'
+            torch.save(layers, temporary_path)
+            os.replace(temporary_path, self._get_file_path(key))
+            self._evict_offloaded()
+
+    def _evict_offloaded(self):
+        if not self.max_offload_bytes:
+            return
+        files = []
+        for entry in os.scandir(self.offload_path):
+            try:
+                if entry.name.endswith('.pt'):
+                    files.append((entry.stat().st_mtime, entry.stat().st_size, entry.path))
+            except OSError:
+                # deleted by another process in the meantime
+                continue
+        total_bytes = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total_bytes <= self.max_offload_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total_bytes -= size
+
+    def _put_in_memory(self, key, layers):
+        self.entries[key] = layers
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _get_file_path(self, key):
+        return os.path.join(self.offload_path, f'{key}.pt')
+
+    @staticmethod
+    def _get_key(token_ids):
+        return hashlib.sha256(','.join(map(str, token_ids)).encode('utf-8')).hexdigest()
+
+
+def remove_offloaded_agent_prefixes(llm_config):
+    """Deletes the folders the agent prefix stores of the llm config (and its stages) offloaded their entries to."""
+    stage_configs = (llm_config or {}).get('stages') or {}
+    for config in [llm_config or {}, *stage_configs.values()]:
+        if config.get('agent_prefix_cache_path'):
+            shutil.rmtree(config['agent_prefix_cache_path'], ignore_errors=True)
@@ -0,0 +1,92 @@
+from util.logging import log_error_without_trace, log_info
+
+MAX_REPAIRED_RESPONSE_LENGTH = 4000
+
+
+def get_repair_prompt(prompt, response, error):
+    return (f'Your answer to the following request could not be processed.\n'
+            f'Request:\n{prompt}\n'
+            f'Your answer:\n{(response or "")[:MAX_REPAIRED_RESPONSE_LENGTH]}\n'
+            f'Error: {error}\n'
+            f'Answer the request again. Do not include any explanations, only provide the corrected RFC8259 compliant '
+            f'JSON response.\n'
+            f'The JSON Response:\n')
+
+
+def get_empty_repair_stats():
+    return {'total': 0, 'first_pass': 0, 'repaired': 0, 'failed': 0}
+
+
+def merge_repair_stats(stats, other_stats):
+    for key, value in other_stats.items():
+        stats[key] = stats.get(key, 0) + value
+    return stats
+
+
+def log_repair_stats(stage, stats):
+    log_info(f'[{stage}] [REPAIR] {stats["first_pass"]}/{stats["total"]} parsed in the first pass, '
+             f'{stats["repaired"]} repaired, {stats["failed"]} failed.')
+
+
+def parse_with_repair(llm_api, stage, items, prompts, schemas, responses, parse, max_repair_attempts=2):
+    """
+    Calls parse(item, response) for every item and re-prompts the items it raised for in one batch per attempt, with
+    the invalid response and the error added to the prompt. Returns the parsed items, the items that still failed after
+    max_repair_attempts and the repair stats (first pass vs. repaired yield). Repair calls are recorded under the stage
+    '<stage>_REPAIR' in the LLM metrics. Pending responses of a backend that defers its completions are not repaired.
+    Responses that fail to parse are evicted from the completion cache, so that a rerun does not replay them (except
+    for deferring backends, whose next round would only request them again).
+    """
+    stats = get_empty_repair_stats()
+    stats['total'] = len(items)
+
+    parsed = [False] * len(items)
+    failures = []
+    for index, (item, response) in enumerate(zip(items, responses)):
+        try:
+            parse(item, response)
+            parsed[index] = True
+        except Exception as e:
+            failures.append((index, response, e))
+    stats['first_pass'] = sum(parsed)
+    llm_api.record_parse_results(stage, stats['first_pass'], len(failures))
+    if llm_api.defers_completions:
+        # empty responses are still pending in an offline batch, they are answered instead of repaired
+        failures = [failure for failure in failures if failure[1]]
+    else:
+        llm_api.evict_completions([prompts[index] for index, _, _ in failures],
+                                  [schemas[index] for index, _, _ in failures] if schemas else None)
+
+    for _ in range(max_repair_attempts):
+        if not failures:
+            break
+        repair_prompts = [get_repair_prompt(prompts[index], response, error) for index, response, error in failures]
+        repair_schemas = [schemas[index] for index, _, _ in failures] if schemas else None
+        repaired_responses = llm_api.get_completions(repair_prompts, repair_schemas, stage=f'{stage}_REPAIR')
+
+        remaining_failures = []
+        failed_positions = []
+        for position, ((index, _, _), response) in enumerate(zip(failures, repaired_responses)):
+            try:
+                parse(items[index], response)
+                parsed[index] = True
+                stats['repaired'] += 1
+            except Exception as e:
+                remaining_failures.append((index, response, e))
+                failed_positions.append(position)
+        if not llm_api.defers_completions:
+            llm_api.evict_completions([repair_prompts[position] for position in failed_positions],
+                                      [repair_schemas[position] for position in failed_positions]
+                                      if repair_schemas else None)
+        llm_api.record_parse_results(f'{stage}_REPAIR', len(failures) - len(remaining_failures),
+                                     len(remaining_failures))
+        failures = remaining_failures
+
+    for index, response, error in failures:
+        log_error_without_trace(f'[ERROR] Failed to parse response after {max_repair_attempts} repair attempts: '
+                                f'{error}\nResponse:\n{response}')
+    stats['failed'] = len(items) - sum(parsed)
+
+    parsed_items = [item for item, is_parsed in zip(items, parsed) if is_parsed]
+    failed_items = [item for item, is_parsed in zip(items, parsed) if not is_parsed]
+    return parsed_items, failed_items, stats
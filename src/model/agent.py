@@ -40,6 +40,18 @@ class Agent:
             "route_descriptions": self.route_descriptions,
         }
 
+    def with_fields(self, fields):
+        """Returns a copy of the agent that only carries its id and the given fields, e.g. to hand it to a worker."""
+        agent = Agent(self.id)
+        for field in fields:
+            setattr(agent, field, getattr(self, field))
+        return agent
+
+    def update_fields(self, other, fields):
+        for field in fields:
+            setattr(self, field, getattr(other, field))
+        return self
+
     def to_json(self):
         return json.dumps(self.to_dict(), cls=NumpyEncoder, sort_keys=True)
 
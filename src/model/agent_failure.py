@@ -0,0 +1,21 @@
+class AgentFailure:
+    """
+    An agent that raised in a stage on its own, i.e. after the other agents of its chunk were re-queued, or whose
+    chunk failed as a whole with an infrastructure exception (e.g. an outage of the backend).
+    """
+
+    def __init__(self, agent, stage, exception, infrastructure=False):
+        self.agent = agent
+        self.stage = stage
+        self.exception = type(exception).__name__
+        self.message = str(exception)
+        self.infrastructure = infrastructure
+
+    def to_dict(self):
+        return {
+            "agent_id": self.agent.id,
+            "stage": self.stage,
+            "exception": self.exception,
+            "message": self.message,
+            "infrastructure": self.infrastructure,
+        }
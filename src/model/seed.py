@@ -15,6 +15,10 @@ class Seed:
     def get_attributes_string(self):
         return str(self.attributes)
 
+    def get_content_key(self):
+        """Key that is identical for seeds with the same attributes, e.g. replicas of one survey respondent."""
+        return json.dumps(self.attributes, ensure_ascii=False, sort_keys=True, default=str)
+
     def to_dict(self):
         return {
             "ga_id": self.ga_id,
@@ -0,0 +1,63 @@
+from typing import Dict, List, Tuple
+
+# Curated categories the LLM chooses from, with the OSM values (of any candidate attribute) that belong to them
+BUILDING_CATEGORY_VALUES = {
+    'office': ['office', 'commercial', 'company', 'coworking', 'it', 'consulting', 'lawyer', 'accountant',
+               'insurance', 'estate_agent', 'architect', 'advertising_agency', 'financial', 'telecommunication'],
+    'kindergarten': ['kindergarten', 'childcare'],
+    'school': ['school', 'music_school', 'language_school', 'driving_school', 'prep_school'],
+    'university': ['university', 'college', 'research_institute'],
+    'supermarket': ['supermarket', 'convenience', 'greengrocer', 'bakery', 'butcher', 'deli', 'kiosk', 'marketplace'],
+    'shop': ['retail', 'mall', 'department_store', 'clothes', 'shoes', 'electronics', 'hardware', 'doityourself',
+             'furniture', 'books', 'chemist', 'florist', 'gift', 'jewelry', 'mobile_phone', 'optician', 'toys',
+             'sports', 'variety_store', 'second_hand', 'beverages', 'alcohol', 'hairdresser', 'beauty', 'laundry',
+             'dry_cleaning', 'bicycle', 'car', 'car_repair', 'pet', 'stationery', 'tobacco'],
+    'restaurant': ['restaurant', 'fast_food', 'food_court', 'ice_cream'],
+    'cafe': ['cafe'],
+    'bar': ['bar', 'pub', 'biergarten', 'nightclub'],
+    'doctor': ['doctors', 'dentist', 'clinic', 'physiotherapist', 'therapist', 'veterinary'],
+    'hospital': ['hospital'],
+    'pharmacy': ['pharmacy'],
+    'sports': ['sports_centre', 'sports_hall', 'fitness_centre', 'swimming_pool', 'stadium', 'dojo', 'grandstand'],
+    'place_of_worship': ['place_of_worship', 'church', 'chapel', 'mosque', 'synagogue', 'temple', 'cathedral'],
+    'culture': ['theatre', 'cinema', 'museum', 'library', 'arts_centre', 'community_centre', 'social_centre',
+                'events_venue', 'concert_hall', 'gallery'],
+    'public_service': ['townhall', 'post_office', 'police', 'bank', 'courthouse', 'fire_station', 'public',
+                       'government', 'civic', 'social_facility', 'administrative', 'employment_agency'],
+    'industrial': ['industrial', 'warehouse', 'factory', 'manufacture', 'depot', 'storage_tank', 'service'],
+    'hotel': ['hotel', 'hostel', 'guest_house'],
+}
+
+# Categories values of an attribute fall into if they are not listed above
+ATTRIBUTE_FALLBACK_CATEGORIES = {
+    'office': 'office',
+    'shop': 'shop',
+    'craft': 'industrial',
+}
+
+
+class BuildingVocabulary:
+    """
+    Compact set of building categories for the day schedule prompts. Instead of every distinct OSM value of the
+    network (several hundred), the LLM chooses from about twenty curated categories, which are mapped back to the
+    concrete (attribute, value) pairs the location choice can query.
+    """
+
+    def __init__(self, attribute_values: Dict[str, List[str]]):
+        category_by_value = {value: category for category, values in BUILDING_CATEGORY_VALUES.items()
+                             for value in values}
+        self.values_by_category = {}
+        for attribute, values in attribute_values.items():
+            for value in values:
+                category = category_by_value.get(value, ATTRIBUTE_FALLBACK_CATEGORIES.get(attribute))
+                if category is not None:
+                    self.values_by_category.setdefault(category, []).append((attribute, value))
+
+        # only categories that exist in the network are offered, in the curated order
+        self.categories = [category for category in BUILDING_CATEGORY_VALUES if category in self.values_by_category]
+
+    def get_categories(self) -> List[str]:
+        return self.categories
+
+    def get_attribute_values(self, category) -> List[Tuple[str, str]]:
+        return self.values_by_category.get(category, [])
@@ -43,11 +43,14 @@ class ClosestLocationChoice:
             all_values = []
             for attr in self.candidate_attributes:
                 all_values.extend(self.buildings[attr].dropna().unique().tolist())
-            return list(set(all_values))
+            return sorted(set(all_values))
         elif attribute in self.buildings.columns:
             return self.buildings[attribute].dropna().unique().tolist()
         return []
 
+    def get_attribute_values_by_attribute(self):
+        return {attr: self.get_attribute_values(attr) for attr in self.candidate_attributes}
+
     def sample_residential_apartment_location(self):
         """Sample a residential building (weighted by area)."""
         if self.residential_buildings.empty:
@@ -84,14 +87,34 @@ class ClosestLocationChoice:
         self.candidates_cache[cache_key] = candidates
         return candidates
 
-    def sample_building_near_reference(self, reference_point, attribute=None, attribute_value=None):
+    def _get_candidates_for_any(self, attribute_values):
+        """
+        Retrieve or compute the buildings matching any of the given (attribute, attribute_value) pairs, e.g. all
+        values of a compact building category. The result is cached like the single value candidates.
+        """
+        cache_key = tuple(attribute_values)
+        if cache_key in self.candidates_cache:
+            return self.candidates_cache[cache_key]
+
+        mask = np.zeros(len(self.buildings), dtype=bool)
+        for attribute, attribute_value in attribute_values:
+            mask |= (self.buildings[attribute] == attribute_value).to_numpy()
+        candidates = self.buildings[mask]
+
+        self.candidates_cache[cache_key] = candidates
+        return candidates
+
+    def sample_building_near_reference(self, reference_point, attribute=None, attribute_value=None,
+                                       attribute_values=None):
         if not isinstance(reference_point, Point):
             reference_point = Point(reference_point)
 
-        if attribute is None and attribute_value is not None:
-            attribute = self._find_attribute_for_value(attribute_value)
-
-        candidates = self._get_candidates(attribute, attribute_value)
+        if attribute_values is not None:
+            candidates = self._get_candidates_for_any(attribute_values)
+        else:
+            if attribute is None and attribute_value is not None:
+                attribute = self._find_attribute_for_value(attribute_value)
+            candidates = self._get_candidates(attribute, attribute_value)
         if candidates.empty:
             return gpd.GeoDataFrame(geometry=[], crs=self.buildings.crs)
 
@@ -3,12 +3,20 @@ from module.action.sumo.traci_wrapper import start_sim, get_num_expected_vehicle
     add_car, add_bicycle, find_intermodal_route, add_intermodal
 from model.building import Building
 from model.possible_route import PossibleRoute
+from module.action.building_vocabulary import BuildingVocabulary
 
 
 class SumoAdapter:
-    def __init__(self, urban_sampler, net_file, poly_file, v_types_file, pt_stops_file, pt_vehicles_file):
+    def __init__(self, urban_sampler, net_file, poly_file, v_types_file, pt_stops_file, pt_vehicles_file,
+                 compact_building_categories=False):
         self.urban_sampler = urban_sampler
-        self.building_categories = urban_sampler.get_attribute_values()
+        # with compact categories the prompts offer ~20 curated categories instead of every OSM value
+        self.building_vocabulary = None
+        if compact_building_categories:
+            self.building_vocabulary = BuildingVocabulary(urban_sampler.get_attribute_values_by_attribute())
+            self.building_categories = self.building_vocabulary.get_categories()
+        else:
+            self.building_categories = urban_sampler.get_attribute_values()
 
         self.start_sim(net_file, poly_file, v_types_file, pt_stops_file, pt_vehicles_file)
 
@@ -39,7 +47,12 @@ class SumoAdapter:
         return apartment
 
     def get_building_with(self, reference_point, attribute_value):
-        building = self.urban_sampler.sample_building_near_reference(reference_point, attribute_value=attribute_value)
+        if self.building_vocabulary is not None and attribute_value in self.building_categories:
+            building = self.urban_sampler.sample_building_near_reference(
+                reference_point, attribute_values=self.building_vocabulary.get_attribute_values(attribute_value))
+        else:
+            building = self.urban_sampler.sample_building_near_reference(reference_point,
+                                                                         attribute_value=attribute_value)
         building = self.row_to_building(building.iloc[0], [attribute_value])
         return building
 
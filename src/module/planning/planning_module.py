@@ -1,102 +1,124 @@
-from concurrent.futures import ProcessPoolExecutor, as_completed
 from typing import List, Tuple
 
+import numpy as np
+
 from module.action.action_module import ActionModule
-from llm.huggingface_chat_api import HuggingfaceChatAPI
+from llm.inference_pool import INFRASTRUCTURE_EXCEPTIONS, get_llm_api, map_chunks, record_failures, use_executor
+from llm.repair import get_empty_repair_stats, log_repair_stats, merge_repair_stats, parse_with_repair
 from model.agent import Agent
 from model.day_schedule import DaySchedule
 from model.location_change import LocationChange
 from model.task import Task
-from module.planning.prompt.day_schedules import get_day_schedule_with_places_prompt
-from module.planning.prompt.means_of_transport_selection import get_select_means_of_transport_prompt, map_string_to_means_of_transport
-from util.json import extract_json_from
-from util.list import split_list
-from util.logging import log_error, log_debug
+from module.planning.prompt.day_schedules import get_day_schedule_with_places_prompt, \
+    get_day_schedule_with_places_schema
+from module.planning.prompt.means_of_transport_selection import get_select_means_of_transport_prompt, \
+    get_select_means_of_transport_schema, map_string_to_means_of_transport, get_packed_agent_key, \
+    get_packed_select_means_of_transport_prompt, get_packed_select_means_of_transport_schema, \
+    get_means_of_transport_options, get_score_means_of_transport_prompt
+from module.planning.prompt.persona import get_persona_prefix
+from util.json import extract_json_from, extract_keyed_values_from
+from util.logging import log_error, log_debug, log_info, log_warning
+from util.shared_object import SharedObject, resolve_shared
 from util.time import time_to_seconds
 
+# fields of the agents each stage reads and sets, the workers only exchange these
+DAY_SCHEDULE_FIELDS = {'input_fields': ('description',), 'output_fields': ('day_schedule',)}
+LOCATION_CHANGES_FIELDS = {'input_fields': ('day_schedule',), 'output_fields': ('home', 'location_changes')}
+ROUTES_FIELDS = {'input_fields': ('description', 'location_changes'),
+                 'output_fields': ('location_changes', 'route_descriptions')}
+
 
 class PlanningModule:
     @staticmethod
-    def generate_day_schedules_with_places_multithreaded(agents, building_options, max_workers, day):
-        agents_per_worker = split_list(agents, max_workers)
-
+    def generate_day_schedules_with_places_multithreaded(agents, building_options, max_workers, day, llm_config=None,
+                                                         inference_pool=None, max_repair_attempts=2, chunk_size=64,
+                                                         checkpoint=None, failures=None,
+                                                         infrastructure_exceptions=INFRASTRUCTURE_EXCEPTIONS):
         result_agents = []
         skipped_agents = []
-        with ProcessPoolExecutor(max_workers=max_workers) as executor:
-            futures = []
-            for worker_id in range(max_workers):
-                future = executor.submit(
-                    PlanningModule.generate_day_schedules_with_places,
-                    agents_per_worker[worker_id],
-                    building_options,
-                    worker_id,
-                    day
-                )
-                futures.append(future)
-            for future in as_completed(futures):
-                try:
-                    agents_with_day_schedule, agents_without_day_schedule = future.result()
-                    result_agents.extend(agents_with_day_schedule)
-                    skipped_agents.extend(agents_without_day_schedule)
-                except Exception as e:
-                    log_error(e)
-                    log_error(f'[ERROR] Failed to execute task {future}')
+        if checkpoint is not None:
+            agents, result_agents, skipped_agents = checkpoint.restore(agents)
+        repair_stats = get_empty_repair_stats()
+        stage_failures = []
+        with use_executor(inference_pool, max_workers) as executor:
+            for agents_with_day_schedule, agents_without_day_schedule, chunk_repair_stats in map_chunks(
+                    executor, 'DAY_SCHEDULE', PlanningModule.generate_day_schedules_with_places, agents, chunk_size,
+                    building_options, 0, day, llm_config, max_repair_attempts, failures=stage_failures,
+                    infrastructure_exceptions=infrastructure_exceptions, **DAY_SCHEDULE_FIELDS):
+                result_agents.extend(agents_with_day_schedule)
+                skipped_agents.extend(agents_without_day_schedule)
+                if checkpoint is not None:
+                    checkpoint.commit(agents_with_day_schedule, agents_without_day_schedule)
+                merge_repair_stats(repair_stats, chunk_repair_stats)
+        skipped_agents.extend(record_failures(stage_failures, checkpoint, failures))
+        log_repair_stats('DAY_SCHEDULE', repair_stats)
 
         return result_agents, skipped_agents
 
     @staticmethod
-    def generate_day_schedules_with_places(agents, building_options, worker_id, day):
-        llm_api = HuggingfaceChatAPI(gpu_id=worker_id)
+    def puts_persona_last(llm_api):
+        # the instructions only lead if the stage prefix cache shares them and the persona is not reused across stages
+        return llm_api.prefix_caching and not llm_api.agent_prefix_caching
 
-        prompts = [get_day_schedule_with_places_prompt(building_options, agent.description, day)
+    @staticmethod
+    def generate_day_schedules_with_places(agents, building_options, worker_id, day, llm_config=None,
+                                           max_repair_attempts=2):
+        llm_api = get_llm_api(worker_id, llm_config, stage='DAY_SCHEDULE')
+
+        building_options_string = ', '.join(building_options)
+        persona_last = PlanningModule.puts_persona_last(llm_api)
+        prompts = [get_day_schedule_with_places_prompt(building_options_string, agent.description, day, persona_last)
                    for agent in agents]
-        responses = llm_api.get_completions(prompts)
+        schema = get_day_schedule_with_places_schema(building_options)
+        schemas = [schema] * len(prompts)
+        agent_prefixes = [get_persona_prefix(agent.description) for agent in agents] \
+            if llm_api.agent_prefix_caching else None
+        responses = llm_api.get_completions(prompts, schemas, stage='DAY_SCHEDULE', agent_prefixes=agent_prefixes)
 
-        agents_with_day_schedule = []
-        agents_without_day_schedule = []
-        for agent, response in zip(agents, responses):
-            try:
-                day_schedule_data = extract_json_from(response)['description_of_today']
-                agent.day_schedule = DaySchedule.from_json({
-                    'day': day,
-                    'task_list': day_schedule_data
-                })
-                agents_with_day_schedule.append(agent)
-            except Exception as e:
-                log_error(e)
-                log_error(f'[ERROR] Failed to generate day schedule for {agent.to_json()}')
-                log_error(f'[ERROR] Response:\n{response}')
-                agents_without_day_schedule.append(agent)
+        def set_day_schedule(agent, response):
+            day_schedule_data = extract_json_from(response)['description_of_today']
+            agent.day_schedule = DaySchedule.from_json({
+                'day': day,
+                'task_list': day_schedule_data
+            })
 
-        return agents_with_day_schedule, agents_without_day_schedule
+        agents_with_day_schedule, agents_without_day_schedule, repair_stats = parse_with_repair(
+            llm_api, 'DAY_SCHEDULE', agents, prompts, schemas, responses, set_day_schedule, max_repair_attempts)
+        llm_api.log_early_stopping_stats('DAY_SCHEDULE')
+
+        return agents_with_day_schedule, agents_without_day_schedule, repair_stats
 
     @staticmethod
     def extend_with_location_changes_multithreaded(agents: List[Agent],
                                                    max_workers,
-                                                   traffic_sim) -> (List[Agent], List[Agent]):
-        agents_per_worker = split_list(agents, max_workers)
-
-        agents = []
+                                                   traffic_sim,
+                                                   inference_pool=None,
+                                                   chunk_size=64,
+                                                   checkpoint=None,
+                                                   failures=None,
+                                                   infrastructure_exceptions=INFRASTRUCTURE_EXCEPTIONS
+                                                   ) -> (List[Agent], List[Agent]):
+        result_agents = []
         skipped_agents = []
-        with ProcessPoolExecutor(max_workers=max_workers) as executor:
-            futures = []
-            for worker_id in range(max_workers):
-                future = executor.submit(PlanningModule.extend_with_location_changes,
-                                         agents_per_worker[worker_id],
-                                         traffic_sim)
-                futures.append(future)
-            for future in as_completed(futures):
-                try:
-                    agents_with_location_changes, agents_without_location_changes = future.result()
-                    agents.extend(agents_with_location_changes)
-                    skipped_agents.extend(agents_without_location_changes)
-                except Exception as e:
-                    log_error(e)
+        if checkpoint is not None:
+            agents, result_agents, skipped_agents = checkpoint.restore(agents)
+        stage_failures = []
+        with use_executor(inference_pool, max_workers) as executor, SharedObject(traffic_sim) as shared_traffic_sim:
+            for agents_with_location_changes, agents_without_location_changes in map_chunks(
+                    executor, 'LOCATION_CHANGES', PlanningModule.extend_with_location_changes, agents, chunk_size,
+                    shared_traffic_sim, failures=stage_failures, infrastructure_exceptions=infrastructure_exceptions,
+                    **LOCATION_CHANGES_FIELDS):
+                result_agents.extend(agents_with_location_changes)
+                skipped_agents.extend(agents_without_location_changes)
+                if checkpoint is not None:
+                    checkpoint.commit(agents_with_location_changes, agents_without_location_changes)
+        skipped_agents.extend(record_failures(stage_failures, checkpoint, failures))
 
-        return agents, skipped_agents
+        return result_agents, skipped_agents
 
     @staticmethod
     def extend_with_location_changes(agents: List[Agent], traffic_sim) -> (List[Agent], List[Agent]):
+        traffic_sim = resolve_shared(traffic_sim)
         agents_with_location_changes = []
         agents_without_location_changes = []
 
@@ -162,65 +184,183 @@ class PlanningModule:
 
     @staticmethod
     def add_routes_multithreaded(agents: List[Agent], max_workers, traffic_sim, actually_add_route_to_sim=False,
-                                 use_geocoord=False) -> List[Agent]:
-        agents_per_worker = split_list(agents, max_workers)
-
-        agents = []
-        with ProcessPoolExecutor(max_workers=max_workers) as executor:
-            futures = []
-            for worker_id in range(max_workers):
-                future = executor.submit(PlanningModule.add_routes,
-                                         agents_per_worker[worker_id],
-                                         worker_id,
-                                         traffic_sim,
-                                         actually_add_route_to_sim,
-                                         use_geocoord)
-                futures.append(future)
-            for future in as_completed(futures):
-                try:
-                    agents_with_routes = future.result()
-                    agents.extend(agents_with_routes)
-                except Exception as e:
-                    log_error(e)
+                                 use_geocoord=False, llm_config=None, inference_pool=None,
+                                 max_repair_attempts=2, mode_choice_pack_size=1,
+                                 mode_choice_strategy='generate', chunk_size=64, checkpoint=None,
+                                 failures=None, infrastructure_exceptions=INFRASTRUCTURE_EXCEPTIONS
+                                 ) -> (List[Agent], List[Agent]):
+        result_agents = []
+        agents_without_routes = []
+        if checkpoint is not None:
+            agents, result_agents, agents_without_routes = checkpoint.restore(agents)
+        repair_stats = get_empty_repair_stats()
+        stage_failures = []
+        with use_executor(inference_pool, max_workers) as executor, SharedObject(traffic_sim) as shared_traffic_sim:
+            for agents_with_routes, chunk_repair_stats in map_chunks(
+                    executor, 'ROUTE_DECISIONS', PlanningModule.add_routes, agents, chunk_size, 0, shared_traffic_sim,
+                    actually_add_route_to_sim, use_geocoord, llm_config, max_repair_attempts, mode_choice_pack_size,
+                    mode_choice_strategy, failures=stage_failures, infrastructure_exceptions=infrastructure_exceptions,
+                    **ROUTES_FIELDS):
+                result_agents.extend(agents_with_routes)
+                merge_repair_stats(repair_stats, chunk_repair_stats)
+                if checkpoint is not None:
+                    checkpoint.commit(agents_with_routes, [])
+        agents_without_routes.extend(record_failures(stage_failures, checkpoint, failures))
+        log_repair_stats('ROUTE_DECISIONS', repair_stats)
 
-        return agents
+        return result_agents, agents_without_routes
 
     @staticmethod
-    def add_routes(agents: List[Agent], worker_id, traffic_sim, actually_add_route_to_sim=False, use_geocoord=False) -> \
-            List[Agent]:
-        try:
-            llm_api = HuggingfaceChatAPI(gpu_id=worker_id)
-            agents = ActionModule.get_possible_routes_for_agents(agents, traffic_sim, use_geocoord=use_geocoord)
-            agents = PlanningModule.get_route_decisions(agents, llm_api)
-            agents = PlanningModule.set_sim_routes(agents, traffic_sim, actually_add_route_to_sim)
-            return agents
-        except Exception as e:
-            log_error(e)
+    def add_routes(agents: List[Agent], worker_id, traffic_sim, actually_add_route_to_sim=False, use_geocoord=False,
+                   llm_config=None, max_repair_attempts=2, mode_choice_pack_size=1,
+                   mode_choice_strategy='generate') -> Tuple[List[Agent], dict]:
+        # exceptions reach the caller, which re-queues the other agents of the chunk (see map_chunks)
+        traffic_sim = resolve_shared(traffic_sim)
+        llm_api = get_llm_api(worker_id, llm_config, stage='ROUTE_DECISIONS')
+        agents = ActionModule.get_possible_routes_for_agents(agents, traffic_sim, use_geocoord=use_geocoord)
+        agents, repair_stats = PlanningModule.get_route_decisions(agents, llm_api, max_repair_attempts,
+                                                                  mode_choice_pack_size, mode_choice_strategy)
+        agents = PlanningModule.set_sim_routes(agents, traffic_sim, actually_add_route_to_sim)
+        return agents, repair_stats
 
     @staticmethod
-    def get_route_decisions(agents: List[Agent], llm_api) -> List[Agent]:
-        prompts = [get_select_means_of_transport_prompt(agent) for agent in agents]
-        if not prompts:
+    def get_route_decisions(agents: List[Agent], llm_api, max_repair_attempts=2, pack_size=1,
+                            strategy='generate') -> Tuple[List[Agent], dict]:
+        """
+        With a pack size > 1 the decisions of pack_size agents are requested in one prompt first, the agents whose part
+        of the response is missing or invalid fall back to one prompt per agent. The 'logprob' and 'logprob_sample'
+        strategies score the modes instead (see get_scored_route_decisions).
+        """
+        if not agents:
             raise Exception('No routes available')
-        results = llm_api.get_completions(prompts)
-
-        for agent, result, prompt in zip(agents, results, prompts):
-            log_debug(f'[ROUTE_DECISIONS][PROMPT]{prompt}')
-            log_debug(f'[ROUTE_DECISIONS][RESPONSE]{result}')
+        if strategy in ('logprob', 'logprob_sample'):
             try:
-                decisions = extract_json_from(result)['decisions']
-                decision_map = {decision['route_id']: decision for decision in decisions if 'route_id' in decision}
-                for location_change in agent.location_changes:
-                    if location_change.possible_routes:
-                        route_id = str(location_change.route_id)
-                        if route_id not in decision_map:
-                            raise Exception(f'No decision found for route_id: {route_id}')
-                        location_change.decision = decision_map[route_id]
-                        location_change.decision['means_of_transport'] = map_string_to_means_of_transport(
-                            location_change.decision['means_of_transport'])
-            except Exception as e:
-                log_error(f'Error: {e}\n\nNo decision found found for result:\n{result}')
-        return agents
+                return PlanningModule.get_scored_route_decisions(agents, llm_api, strategy == 'logprob_sample')
+            except NotImplementedError as e:
+                log_warning(f'[ROUTE_DECISIONS] {e}, generating the decisions instead.')
+        elif strategy != 'generate':
+            raise NotImplementedError(f'Mode choice strategy "{strategy}" not implemented')
+
+        undecided_agents = agents
+        packed_decided_count = 0
+        if pack_size > 1:
+            undecided_agents, packed_decided_count = PlanningModule.get_packed_route_decisions(agents, llm_api,
+                                                                                               pack_size)
+
+        repair_stats = get_empty_repair_stats()
+        if undecided_agents:
+            persona_last = PlanningModule.puts_persona_last(llm_api)
+            prompts = [get_select_means_of_transport_prompt(agent, persona_last) for agent in undecided_agents]
+            schemas = [get_select_means_of_transport_schema(agent) for agent in undecided_agents]
+            agent_prefixes = [get_persona_prefix(agent.description) for agent in undecided_agents] \
+                if llm_api.agent_prefix_caching else None
+            results = llm_api.get_completions(prompts, schemas, stage='ROUTE_DECISIONS', agent_prefixes=agent_prefixes)
+            llm_api.log_early_stopping_stats('ROUTE_DECISIONS')
+
+            for result, prompt in zip(results, prompts):
+                log_debug(f'[ROUTE_DECISIONS][PROMPT]{prompt}')
+                log_debug(f'[ROUTE_DECISIONS][RESPONSE]{result}')
+
+            # agents whose decisions can still not be parsed are kept, their routes without decision are not added
+            _, _, repair_stats = parse_with_repair(llm_api, 'ROUTE_DECISIONS', undecided_agents, prompts, schemas,
+                                                   results, PlanningModule.set_route_decisions, max_repair_attempts)
+
+        # agents without routes or with a pending offline request parsed nothing and are not counted
+        repair_stats['total'] += packed_decided_count
+        repair_stats['first_pass'] += packed_decided_count
+        return agents, repair_stats
+
+    @staticmethod
+    def get_scored_route_decisions(agents: List[Agent], llm_api, sample=False) -> Tuple[List[Agent], dict]:
+        """
+        Decides every leg by the log-probabilities of its modes as answer, computed in one forward pass without any
+        generated reasoning. The best mode is taken or, with sample, one is drawn from their softmax. The legs are
+        decided in rounds of one leg per agent, so that the prompt of a leg contains the decisions of the previous ones.
+        """
+        legs_per_agent = [[location_change for location_change in agent.location_changes
+                           if location_change.possible_routes] for agent in agents]
+        decisions_per_agent = [[] for _ in agents]
+        for leg_index in range(max((len(legs) for legs in legs_per_agent), default=0)):
+            positions = [position for position, legs in enumerate(legs_per_agent) if leg_index < len(legs)]
+            location_changes = [legs_per_agent[position][leg_index] for position in positions]
+            options = [get_means_of_transport_options(location_change) for location_change in location_changes]
+            prompts = [get_score_means_of_transport_prompt(agents[position], location_change,
+                                                           decisions_per_agent[position], leg_options)
+                       for position, location_change, leg_options in zip(positions, location_changes, options)]
+            scores = llm_api.score_options(prompts, options, stage='ROUTE_DECISIONS_SCORED')
+
+            for position, location_change, leg_options, leg_scores in zip(positions, location_changes, options,
+                                                                           scores):
+                if sample:
+                    probabilities = np.exp((np.array(leg_scores) - max(leg_scores)) / llm_api.sample_temperature)
+                    choice = np.random.choice(len(leg_options), p=probabilities / probabilities.sum())
+                else:
+                    choice = int(np.argmax(leg_scores))
+                decisions_per_agent[position].append({
+                    'route_id': str(location_change.route_id),
+                    'means_of_transport': leg_options[choice],
+                    'log_probabilities': dict(zip(leg_options, leg_scores)),
+                })
+
+        for agent, decisions in zip(agents, decisions_per_agent):
+            PlanningModule.apply_route_decisions(agent, decisions)
+        decided_count = sum(1 for legs in legs_per_agent if legs)
+        log_info(f'[ROUTE_DECISIONS] {decided_count}/{len(agents)} agents decided by scoring their modes.')
+        return agents, {**get_empty_repair_stats(), 'total': decided_count, 'first_pass': decided_count}
+
+    @staticmethod
+    def get_packed_route_decisions(agents: List[Agent], llm_api, pack_size) -> Tuple[List[Agent], int]:
+        """
+        Requests the decisions of pack_size agents per prompt. Returns the agents still without decisions and the
+        number of agents whose decisions were parsed from their packed response.
+        """
+        agents_with_routes = [agent for agent in agents
+                              if any(location_change.possible_routes for location_change in agent.location_changes)]
+        packs = [agents_with_routes[start:start + pack_size] for start in range(0, len(agents_with_routes), pack_size)]
+        prompts = [get_packed_select_means_of_transport_prompt(pack) for pack in packs]
+        schemas = [get_packed_select_means_of_transport_schema(pack) for pack in packs]
+        results = llm_api.get_completions(prompts, schemas, stage='ROUTE_DECISIONS_PACKED')
+        llm_api.log_early_stopping_stats('ROUTE_DECISIONS_PACKED')
+
+        undecided_agents = []
+        pending_count = 0
+        for pack, result, prompt in zip(packs, results, prompts):
+            log_debug(f'[ROUTE_DECISIONS_PACKED][PROMPT]{prompt}')
+            log_debug(f'[ROUTE_DECISIONS_PACKED][RESPONSE]{result}')
+            if not result and llm_api.defers_completions:
+                # the pack is still pending in an offline batch, single prompts would only duplicate its requests
+                pending_count += len(pack)
+                continue
+            # a partial (e.g. truncated) response still yields the decisions of the agents that are complete
+            decisions_per_agent = extract_keyed_values_from(result, [get_packed_agent_key(agent) for agent in pack])
+            for agent in pack:
+                try:
+                    PlanningModule.apply_route_decisions(agent,
+                                                         decisions_per_agent[get_packed_agent_key(agent)]['decisions'])
+                except Exception:
+                    undecided_agents.append(agent)
+
+        decided_count = len(agents_with_routes) - len(undecided_agents) - pending_count
+        llm_api.record_parse_results('ROUTE_DECISIONS_PACKED', decided_count, len(undecided_agents) + pending_count)
+        log_info(f'[ROUTE_DECISIONS] {decided_count}/{len(agents_with_routes)} '
+                 f'agents decided in {len(packs)} packed prompts, {len(undecided_agents)} fall back to single prompts.')
+        return undecided_agents, decided_count
+
+    @staticmethod
+    def set_route_decisions(agent: Agent, result):
+        PlanningModule.apply_route_decisions(agent, extract_json_from(result)['decisions'])
+
+    @staticmethod
+    def apply_route_decisions(agent: Agent, decisions):
+        decision_map = {decision['route_id']: decision for decision in decisions if 'route_id' in decision}
+        for location_change in agent.location_changes:
+            if location_change.possible_routes:
+                route_id = str(location_change.route_id)
+                if route_id not in decision_map:
+                    raise Exception(f'No decision found for route_id: {route_id}')
+                location_change.decision = decision_map[route_id]
+                location_change.decision['means_of_transport'] = map_string_to_means_of_transport(
+                    location_change.decision['means_of_transport'])
 
     @staticmethod
     def set_sim_routes(agents: List[Agent], traffic_sim, actually_add_route_to_sim=False) -> List[Agent]:
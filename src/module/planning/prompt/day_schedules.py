@@ -1,6 +1,14 @@
-def get_day_schedule_with_places_prompt(building_options, description, day):
+from module.planning.prompt.persona import get_persona_prefix
+
+
+def get_day_schedule_with_places_prompt(building_options, description, day, persona_last=False):
+    # The persona leads, so that its encoding can be reused by the mode choice prompt of the agent. With persona_last
+    # the instructions and building options, which are the same for all agents, come first instead, so that the
+    # prefix cache can share their prefill.
+    persona_head = '' if persona_last else get_persona_prefix(description)
+    persona_tail = get_persona_prefix(description) if persona_last else ''
     return (
-        f'You are:\n{description}\n'
+        f'{persona_head}'
         f'Today is {day}. Write in broad strokes what you are doing during the day. Start the day at home. '
         f'Only include tasks that occur at a specific location which must be one of the provided building options and '
         f'do not include any transportation or commuting tasks (for example, do not include actions like "walking by foot" or "driving a car" or "taking the bus") or locations (for example "parking", bicycle_parking", etc.).\n'
@@ -9,5 +17,28 @@ def get_day_schedule_with_places_prompt(building_options, description, day):
         f'without deviation.\n{{"description_of_today": '
         f'[{{"time":"HH:MM","action":"a one sentence description of what you start doing at that time", '
         f'"building_type": "building for your task which must be from above building options and can not be anything else"}},...]}}\n'
+        f'{persona_tail}'
         f'The JSON Response for {day}:\n'
     )
+
+
+def get_day_schedule_with_places_schema(building_categories):
+    building_types = list(dict.fromkeys(['home'] + list(building_categories)))
+    times = [f'{hours:02}:{minutes:02}' for hours in range(24) for minutes in range(60)]
+    return {
+        'type': 'object',
+        'properties': {
+            'description_of_today': {
+                'type': 'array',
+                'minItems': 1,
+                'items': {
+                    'type': 'object',
+                    'properties': {
+                        'time': {'type': 'string', 'enum': times},
+                        'action': {'type': 'string'},
+                        'building_type': {'type': 'string', 'enum': building_types},
+                    }
+                }
+            }
+        }
+    }
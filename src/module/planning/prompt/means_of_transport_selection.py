@@ -1,6 +1,8 @@
 import json
+from typing import List
 
 from model.agent import Agent
+from module.planning.prompt.persona import get_persona_prefix
 
 
 def map_means_of_transport_to_string(means_of_transport):
@@ -23,8 +25,7 @@ def map_string_to_means_of_transport(means_of_transport):
     return mapping.get(means_of_transport, means_of_transport)
 
 
-def get_select_means_of_transport_prompt(agent: Agent) -> str:
-    few_shot = r"""
+FEW_SHOT = r"""
 You live in Berlin and have several tasks to complete today , for which you need to plan
 several trips . Berliners typically
 - walk for very short trips ( <1 km ) ,
@@ -43,6 +44,8 @@ split (2 walk , 1 bicycle , 3 car , 2 public transport ):
 8. 12.0 km in 30 min -> ** car ** (" direct suburban route is best by car ")
 """
 
+
+def get_route_choices_string(agent: Agent) -> str:
     route_choices = [
         {
             'route_id': location_change.route_id,
@@ -60,22 +63,117 @@ split (2 walk , 1 bicycle , 3 car , 2 public transport ):
         for location_change in agent.location_changes
         if location_change.possible_routes
     ]
-    route_choices_str = json.dumps(route_choices, indent=4)
+    return json.dumps(route_choices, indent=4)
+
 
+def get_decisions_template(agent: Agent) -> str:
     json_template = ",".join(
         f'{{"route_id":"{lc.route_id}","reasoning":"a one sentence reasoning for your decision","means_of_transport":"<car/walk/bicycle/public transport>"}}'
         for lc in agent.location_changes
         if lc.possible_routes
     )
+    return f"{{\"decisions\":[{json_template}]}}"
+
+
+def get_packed_agent_key(agent: Agent) -> str:
+    return f'person_{agent.id}'
+
 
+def get_select_means_of_transport_prompt(agent: Agent, persona_last=False) -> str:
+    # The persona leads, as in the day schedule prompt, to reuse its encoding. With persona_last the few-shot block,
+    # which is the same for all agents, comes first instead, so that the prefix cache can share its prefill.
+    if persona_last:
+        head = f"{FEW_SHOT}\n{get_persona_prefix(agent.description)}\n"
+    else:
+        head = f"{get_persona_prefix(agent.description)}\n{FEW_SHOT}\n"
     prompt = (
-        f"You are:\n{agent.description}\n\n"
-        f"{few_shot}\n"
-        f"Your route options are:\n{route_choices_str}\n\n"
+        f"{head}"
+        f"Your route options are:\n{get_route_choices_string(agent)}\n\n"
         f"For each leg, write one personal sentence explaining your choice, then pick the mode. Only switch modes if you’d logically have that vehicle with you.\n\n"
         f"Return exactly one compact JSON, no line breaks:\n"
-        f"{{\"decisions\":[{json_template}]}}\n\n"
+        f"{get_decisions_template(agent)}\n\n"
+        f"Now, your JSON response:"
+    )
+
+    return prompt.strip()
+
+
+def get_means_of_transport_options(location_change) -> List[str]:
+    return list(dict.fromkeys(map_means_of_transport_to_string(possible_route.means_of_transport)
+                              for possible_route in location_change.possible_routes))
+
+
+def get_score_means_of_transport_prompt(agent: Agent, location_change, previous_decisions, options) -> str:
+    """
+    Asks for the mode of one leg as a bare answer, whose options are scored by their log-probability instead of
+    generated. The decisions of the previous legs are included, so that vehicles are not switched without reason.
+    """
+    decisions = "".join(f"- route {decision['route_id']}: {decision['means_of_transport']}\n"
+                        for decision in previous_decisions)
+    if decisions:
+        decisions = f"Your decisions for the previous routes:\n{decisions}\n"
+    prompt = (
+        f"{FEW_SHOT}\n"
+        f"You are:\n{agent.description}\n\n"
+        f"Your route options are:\n{get_route_choices_string(agent)}\n\n"
+        f"{decisions}"
+        f"Only switch modes if you’d logically have that vehicle with you.\n"
+        f"Which means of transport do you take for route {location_change.route_id}? "
+        f"Answer with only one of: {', '.join(options)}."
+    )
+
+    return prompt.strip()
+
+
+def get_packed_select_means_of_transport_prompt(agents: List[Agent]) -> str:
+    """Asks for the route decisions of several persons at once, so that the instructions are only sent once."""
+    persons = "\n\n".join(
+        f"Person {get_packed_agent_key(agent)}:\n{agent.description}\n"
+        f"Route options of {get_packed_agent_key(agent)}:\n{get_route_choices_string(agent)}"
+        for agent in agents
+    )
+    json_template = ",".join(f'"{get_packed_agent_key(agent)}":{get_decisions_template(agent)}' for agent in agents)
+
+    prompt = (
+        f"Put yourself in the position of each of the following persons in turn.\n"
+        f"{FEW_SHOT}\n"
+        f"{persons}\n\n"
+        f"For each leg of each person, write one personal sentence explaining their choice, then pick the mode. Decide for every person independently and only switch modes if they’d logically have that vehicle with them.\n\n"
+        f"Return exactly one compact JSON with one entry per person, no line breaks:\n"
+        f"{{{json_template}}}\n\n"
         f"Now, your JSON response:"
     )
 
     return prompt.strip()
+
+
+def get_select_means_of_transport_schema(agent: Agent) -> dict:
+    decisions = [
+        {
+            'type': 'object',
+            'properties': {
+                'route_id': {'const': str(location_change.route_id)},
+                'reasoning': {'type': 'string'},
+                'means_of_transport': {
+                    'type': 'string',
+                    'enum': [map_means_of_transport_to_string(possible_route.means_of_transport)
+                             for possible_route in location_change.possible_routes],
+                },
+            }
+        }
+        for location_change in agent.location_changes
+        if location_change.possible_routes
+    ]
+    return {
+        'type': 'object',
+        'properties': {
+            'decisions': {'type': 'array', 'prefixItems': decisions, 'items': False}
+        }
+    }
+
+
+def get_packed_select_means_of_transport_schema(agents: List[Agent]) -> dict:
+    return {
+        'type': 'object',
+        'properties': {get_packed_agent_key(agent): get_select_means_of_transport_schema(agent) for agent in agents}
+    }
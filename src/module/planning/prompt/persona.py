@@ -0,0 +1,6 @@
+def get_persona_prefix(description):
+    """
+    Leading part of the schedule and mode choice prompts unless the persona comes last. It has to be identical in
+    both prompts, so that the KV cache of the encoded persona can be reused (see llm.prefix_cache.AgentPrefixStore).
+    """
+    return f'You are:\n{description}\n'
@@ -1,11 +1,12 @@
-from concurrent.futures import ProcessPoolExecutor, as_completed
-
-from llm.huggingface_chat_api import HuggingfaceChatAPI
+from llm.inference_pool import INFRASTRUCTURE_EXCEPTIONS, get_llm_api, map_chunks, record_failures, use_executor
+from llm.repair import get_empty_repair_stats, log_repair_stats, merge_repair_stats, parse_with_repair
 from model.agent import Agent
-from module.profile.prompt.description import get_description_prompt
+from module.profile.prompt.description import get_description_prompt, get_description_schema
 from util.json import extract_json_from
-from util.list import split_list
-from util.logging import log_error
+from util.logging import log_info
+
+# fields of the agents the stage reads and sets, the workers only exchange these
+DESCRIPTION_FIELDS = {'input_fields': ('seed',), 'output_fields': ('description',)}
 
 
 class ProfileModule:
@@ -20,36 +21,39 @@ class ProfileModule:
         return agents
 
     @staticmethod
-    def generate_descriptions_multithreaded(agents, max_workers, exclude_too_young, exclude_too_old):
-        agents_per_worker = split_list(agents, max_workers)
+    def generate_descriptions_multithreaded(agents, max_workers, exclude_too_young, exclude_too_old, llm_config=None,
+                                            deduplicate_seeds=True, inference_pool=None, max_repair_attempts=2,
+                                            chunk_size=64, checkpoint=None, failures=None,
+                                            infrastructure_exceptions=INFRASTRUCTURE_EXCEPTIONS):
+        if deduplicate_seeds:
+            # keep replicas of the same seed in the same chunk so that they are generated together
+            agents = sorted(agents, key=lambda agent: agent.seed.get_content_key())
 
         result_agents = []
         agents_without_description = []
-        with ProcessPoolExecutor(max_workers=max_workers) as executor:
-            futures = []
-            for worker_id in range(max_workers):
-                future = executor.submit(
-                    ProfileModule.generate_descriptions,
-                    agents_per_worker[worker_id],
-                    worker_id,
-                    exclude_too_young,
-                    exclude_too_old
-                )
-                futures.append(future)
-            for future in as_completed(futures):
-                try:
-                    described_agents, skipped_agents = future.result()
-                    result_agents.extend(described_agents)
-                    agents_without_description.extend(skipped_agents)
-                except Exception as e:
-                    log_error(e)
-                    log_error(f'[ERROR] Failed to execute task {future}')
+        if checkpoint is not None:
+            agents, result_agents, agents_without_description = checkpoint.restore(agents)
+        repair_stats = get_empty_repair_stats()
+        stage_failures = []
+        with use_executor(inference_pool, max_workers) as executor:
+            for described_agents, skipped_agents, chunk_repair_stats in map_chunks(
+                    executor, 'DESCRIPTION', ProfileModule.generate_descriptions, agents, chunk_size, 0,
+                    exclude_too_young, exclude_too_old, llm_config, deduplicate_seeds, max_repair_attempts,
+                    failures=stage_failures, infrastructure_exceptions=infrastructure_exceptions, **DESCRIPTION_FIELDS):
+                result_agents.extend(described_agents)
+                agents_without_description.extend(skipped_agents)
+                if checkpoint is not None:
+                    checkpoint.commit(described_agents, skipped_agents)
+                merge_repair_stats(repair_stats, chunk_repair_stats)
+        agents_without_description.extend(record_failures(stage_failures, checkpoint, failures))
+        log_repair_stats('DESCRIPTION', repair_stats)
 
         return result_agents, agents_without_description
 
     @staticmethod
-    def generate_descriptions(agents, worker_id, exclude_too_young=True, exclude_too_old=True):
-        llm_api = HuggingfaceChatAPI(gpu_id=worker_id)
+    def generate_descriptions(agents, worker_id, exclude_too_young=True, exclude_too_old=True, llm_config=None,
+                              deduplicate_seeds=True, max_repair_attempts=2):
+        llm_api = get_llm_api(worker_id, llm_config, stage='DESCRIPTION')
 
         agents_to_be_described = []
         skipped_agents = []
@@ -62,16 +66,54 @@ class ProfileModule:
                 agents_to_be_described.append(agent)
 
         prompts = [get_description_prompt(agent.seed) for agent in agents_to_be_described]
-        responses = llm_api.get_completions(prompts)
-
-        for agent, response in zip(agents_to_be_described, responses):
-            try:
-                description = extract_json_from(response)['persona_description']
-                agent.description = description
-            except Exception as e:
-                log_error(e)
-                log_error(f'[ERROR] Failed to extract description from {agent}')
-                agents_to_be_described.remove(agent)
-                skipped_agents.append(agent)
+        schemas = [get_description_schema()] * len(prompts)
+        if deduplicate_seeds:
+            responses = ProfileModule.get_deduplicated_description_responses(agents_to_be_described, llm_api)
+        else:
+            responses = llm_api.get_completions(prompts, schemas, stage='DESCRIPTION')
+
+        described_agents, agents_without_description, repair_stats = parse_with_repair(
+            llm_api, 'DESCRIPTION', agents_to_be_described, prompts, schemas, responses, ProfileModule.set_description,
+            max_repair_attempts)
+        llm_api.log_early_stopping_stats('DESCRIPTION')
+
+        return described_agents, skipped_agents + agents_without_description, repair_stats
+
+    @staticmethod
+    def set_description(agent, response):
+        agent.description = extract_json_from(response)['persona_description']
+
+    @staticmethod
+    def get_deduplicated_description_responses(agents, llm_api):
+        """
+        Sends one prompt per unique seed instead of one per agent. Seeds that occur once are generated as before,
+        replicated seeds get as many sampled descriptions as they have agents, so that the replicas still differ.
+        """
+        agents_by_seed = {}
+        for index, agent in enumerate(agents):
+            agents_by_seed.setdefault(agent.seed.get_content_key(), []).append(index)
+        groups = list(agents_by_seed.values())
+        unique_groups = [group for group in groups if len(group) == 1]
+        replicated_groups = [group for group in groups if len(group) > 1]
+
+        log_info(f'[DESCRIPTION] {len(groups)} unique seeds for {len(agents)} agents.')
+
+        schema = get_description_schema()
+        responses = [None] * len(agents)
+        unique_responses = llm_api.get_completions([get_description_prompt(agents[group[0]].seed)
+                                                    for group in unique_groups],
+                                                   [schema] * len(unique_groups),
+                                                   stage='DESCRIPTION')
+        for group, response in zip(unique_groups, unique_responses):
+            responses[group[0]] = response
+
+        replicated_responses = llm_api.get_sampled_completions(
+            [get_description_prompt(agents[group[0]].seed) for group in replicated_groups],
+            [len(group) for group in replicated_groups],
+            [schema] * len(replicated_groups),
+            stage='DESCRIPTION')
+        for group, group_responses in zip(replicated_groups, replicated_responses):
+            for index, response in zip(group, group_responses):
+                responses[index] = response
 
-        return agents_to_be_described, skipped_agents
+        return responses
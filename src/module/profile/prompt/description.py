@@ -8,3 +8,12 @@ def get_description_prompt(seed: Seed):
             f'without deviation.\n'
             f'{{"persona_description":"realistic one paragraph description of someone with these attributes"}}\n'
             f'The JSON Response:\n')
+
+
+def get_description_schema():
+    return {
+        'type': 'object',
+        'properties': {
+            'persona_description': {'type': 'string'}
+        }
+    }
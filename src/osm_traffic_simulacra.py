@@ -1,8 +1,13 @@
+import os
+import sys
+
+from llm.metrics import log_merged_metrics
+from llm.offline_batch import DEFAULT_OFFLINE_PATH, get_pending_request_files, ingest_response_files
 from module.action.otp.sumo_otp_adapter import SumoOTPAdapter
-from config.config import config_berlin_sumo as config
+from config.config import config_berlin_otp as config
 from module.planning.planning_module import PlanningModule
 from util.logging import log_info
-from util.storage import Storage
+from util.storage import StageCheckpoint, Storage
 from util.time import Timer
 
 log_info("Starting traffic simulacra")
@@ -30,18 +35,54 @@ pt_vehicles_file = config['pt_vehicles_file']
 exclude_too_young = config['exclude_too_young']
 exclude_too_old = config['exclude_too_old']
 
+llm_config = config['llm']
+max_repair_attempts = config['max_repair_attempts']
+mode_choice_pack_size = config['mode_choice_pack_size']
+mode_choice_strategy = config['mode_choice_strategy']
+chunk_size = config['chunk_size']
+checkpoint_chunks = config['checkpoint_chunks']
+infrastructure_exceptions = config['infrastructure_exceptions']
+resume_routes = config['resume_routes']
+
+# agents with location changes of a traffic_simulacra run, by default from the storage of this run
+agents_path = config.get('location_changes_path') or f'{storage_path}/agents_3_location_changes.json'
+if not load_from_storage and os.path.commonpath([os.path.abspath(agents_path), os.path.abspath(storage_path)]) == \
+        os.path.abspath(storage_path):
+    raise Exception(f'The agents to route ({agents_path}) are inside {storage_path}, which is cleared without '
+                    f'load_from_storage. Set location_changes_path to agents outside of it or enable '
+                    f'load_from_storage.')
 storage = Storage(storage_path, load_from_storage)
+llm_config = {**llm_config, 'metrics_path': storage.llm_metrics_path, 'offline_run_id': storage.run_id}
+# the offline backend writes the mode choice requests to files, their responses are cache hits of the next run
+offline_path = llm_config.get('offline_path', DEFAULT_OFFLINE_PATH) if llm_config.get('backend') == 'offline' else None
+if offline_path and llm_config.get('cache_path'):
+    ingest_response_files(offline_path, llm_config['cache_path'])
 otp_api_url = 'http://paula01.sc.uni-leipzig.de:8080/otp/gtfs/v1'
 traffic_sim = SumoOTPAdapter(net_file, poly_file, v_types_file, pt_stops_file, pt_vehicles_file, otp_api_url)
 
 log_info("Loading agents from storage...")
-agents_path = 'results/baseline-monday-wedding-sumo/agents_3_location_changes.json'
 agents = storage.get_agents(agents_path)
-log_info('Loaded agents from storage...')
+log_info(f'Loaded {len(agents)} agents from {agents_path}.')
 
+# with resume_routes, the stored routes (or chunks of them) of an earlier run are kept instead of routing them again
+route_checkpoint = StageCheckpoint(storage, 'ROUTE_DECISIONS', '4_route_descriptions', '4_no_route_descriptions',
+                                   commit_chunks=checkpoint_chunks and not offline_path, resume=resume_routes)
 log_info('Adding routes...')
-agents = PlanningModule.add_routes_multithreaded(agents, max_workers, traffic_sim, use_geocoord=True)
-storage.write_agents(agents, '4_route_descriptions')
+failures = []
+agents, agents_without_routes = PlanningModule.add_routes_multithreaded(
+    agents, max_workers, traffic_sim, use_geocoord=True, llm_config=llm_config,
+    max_repair_attempts=max_repair_attempts, mode_choice_pack_size=mode_choice_pack_size,
+    mode_choice_strategy=mode_choice_strategy, chunk_size=chunk_size, checkpoint=route_checkpoint, failures=failures,
+    infrastructure_exceptions=infrastructure_exceptions)
+pending_request_files = get_pending_request_files(offline_path, storage.run_id) if offline_path else []
+if pending_request_files:
+    log_info(f'[OFFLINE] [ROUTE_DECISIONS] {len(pending_request_files)} request files are waiting in {offline_path}. '
+             f'Answer them with scripts/llm/run_batch_inference.py and rerun to continue.')
+    traffic_sim.stop_sim()
+    sys.exit(0)
+route_checkpoint.complete(agents, agents_without_routes)
+storage.write_failures(failures)
+log_info(f'[ROUTES] {len(agents_without_routes)} agents without routes, {len(failures)} failed on their own.')
 created_route_description_count = sum(len(agent.route_descriptions) for agent in agents)
 total_route_descriptions_count = sum(sum(1 for index in range(len(agent.day_schedule.task_list) - 1) if
                                          agent.day_schedule.task_list[index].building_type !=
@@ -49,6 +90,10 @@ total_route_descriptions_count = sum(sum(1 for index in range(len(agent.day_sche
 log_info(f'[ROUTES] {created_route_description_count}/{total_route_descriptions_count} routes created.')
 log_info(f'[ROUTES] {len(agents)} final agents.')
 
+llm_metrics = storage.write_llm_metrics()
+if llm_metrics:
+    log_merged_metrics(llm_metrics)
+
 log_info(f'[TIME] Total runtime: {timer.stop()}.')
 traffic_sim.stop_sim()
 log_info('Finished traffic simulation.')
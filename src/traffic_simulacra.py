@@ -1,11 +1,21 @@
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from llm.inference_pool import InferencePool, submit_chunk
+from llm.metrics import log_merged_metrics
+from llm.offline_batch import DEFAULT_OFFLINE_PATH, get_pending_request_files, ingest_response_files
 from module.action.closest_location_choice import ClosestLocationChoice
 from module.action.sumo.sumo_adapter import SumoAdapter
 from config.config import config_berlin_sumo as config
-from module.planning.planning_module import PlanningModule
-from module.profile.profile_module import ProfileModule
+from module.planning.planning_module import DAY_SCHEDULE_FIELDS, LOCATION_CHANGES_FIELDS, PlanningModule, \
+    ROUTES_FIELDS
+from module.profile.profile_module import DESCRIPTION_FIELDS, ProfileModule
 from module.profile.seed.mid_b1_seed_generator import SeedGeneratorMiD
 from util.logging import log_info
-from util.storage import Storage
+from util.list import chunk_list
+from util.shared_object import SharedObject
+from util.storage import StageCheckpoint, Storage
+from util.streaming_pipeline import PipelineStage, StreamingPipeline
 from util.time import Timer
 from util.trips import generate_trips_xml
 
@@ -32,56 +42,205 @@ pt_vehicles_file = config['pt_vehicles_file']
 
 exclude_too_young = config['exclude_too_young']
 exclude_too_old = config['exclude_too_old']
+deduplicate_seeds = config['deduplicate_seeds']
+max_repair_attempts = config['max_repair_attempts']
+mode_choice_pack_size = config['mode_choice_pack_size']
+mode_choice_strategy = config['mode_choice_strategy']
+compact_building_categories = config['compact_building_categories']
+streaming_pipeline = config['streaming_pipeline']
+chunk_size = config['chunk_size']
+pipeline_queue_size = config['pipeline_queue_size']
+checkpoint_chunks = config['checkpoint_chunks']
+infrastructure_exceptions = config['infrastructure_exceptions']
+
+llm_config = config['llm']
 
 buildings_file = config['buildings_file']
 taz_file = config['taz_file']
 
 storage = Storage(storage_path, load_from_storage)
+llm_config = {**llm_config, 'metrics_path': storage.llm_metrics_path, 'offline_run_id': storage.run_id}
+# the offline backend writes the requests of the stages to files, their responses are cache hits of the next run
+offline_path = llm_config.get('offline_path', DEFAULT_OFFLINE_PATH) if llm_config.get('backend') == 'offline' else None
+if offline_path and llm_config.get('cache_path'):
+    ingest_response_files(offline_path, llm_config['cache_path'])
 urban_sampler = ClosestLocationChoice(buildings_file, taz_file)
-traffic_sim = SumoAdapter(urban_sampler, net_file, poly_file, v_types_file, pt_stops_file, pt_vehicles_file)
+traffic_sim = SumoAdapter(urban_sampler, net_file, poly_file, v_types_file, pt_stops_file, pt_vehicles_file,
+                          compact_building_categories)
 seed_generator = SeedGeneratorMiD(census_file)
+# The worker processes keep their model loaded across all stages
+inference_pool = InferencePool(max_workers, llm_config)
+
+
+def stop_if_requests_pending(stage):
+    """Ends the run after a stage whose prompts are waiting in offline batches, a rerun resumes at the stage."""
+    pending_request_files = get_pending_request_files(offline_path, storage.run_id) if offline_path else []
+    if not pending_request_files:
+        return
+    log_info(f'[OFFLINE] [{stage}] {len(pending_request_files)} request files are waiting in {offline_path}. Answer '
+             f'them with scripts/llm/run_batch_inference.py and rerun with load_from_storage to continue.')
+    inference_pool.shutdown()
+    traffic_sim.stop_sim()
+    sys.exit(0)
+
+
+def load_or_generate_seeded_agents():
+    if load_from_storage and storage.has_agents('0_seeds'):
+        return storage.read_agents('0_seeds')
+    agents = ProfileModule.generate_seeded_agents(seed_generator, num_agents)
+    # the seeds are drawn randomly, a resumed run has to prompt for the same agents
+    storage.write_agents(agents, '0_seeds')
+    return agents
+
+
+def get_stage_checkpoints():
+    """Checkpoints of the stages, the offline backend only stores a stage once none of its requests is pending."""
+    commit_chunks = checkpoint_chunks and not offline_path
+    description = StageCheckpoint(storage, 'DESCRIPTION', '1_description', '1_no_description', commit_chunks)
+    day_schedule = StageCheckpoint(storage, 'DAY_SCHEDULE', '2_day_schedule', '2_no_day_schedule', commit_chunks,
+                                   description)
+    location_changes = StageCheckpoint(storage, 'LOCATION_CHANGES', '3_location_changes', '3_no_location_changes',
+                                       commit_chunks, day_schedule)
+    route_decisions = StageCheckpoint(storage, 'ROUTE_DECISIONS', '4_route_descriptions', '4_no_route_descriptions',
+                                      commit_chunks,
+                                      location_changes)
+    return {'DESCRIPTION': description, 'DAY_SCHEDULE': day_schedule, 'LOCATION_CHANGES': location_changes,
+            'ROUTE_DECISIONS': route_decisions}
+
+
+def run_streaming_pipeline():
+    """
+    Runs the stages on chunks of agents that flow from stage to stage, with the LLM stages on the inference pool and
+    the location choice on a pool of its own. With load_from_storage every stage skips the agents it stored before.
+    """
+    building_options = traffic_sim.get_building_categories()
+    shared_traffic_sim = SharedObject(traffic_sim)
+    checkpoints = get_stage_checkpoints()
+    stages = [
+        PipelineStage('DESCRIPTION', 'llm',
+                      lambda executor, agents: submit_chunk(executor, ProfileModule.generate_descriptions, agents, 0,
+                                                            exclude_too_young, exclude_too_old, llm_config,
+                                                            deduplicate_seeds, max_repair_attempts,
+                                                            **DESCRIPTION_FIELDS),
+                      lambda result: result,
+                      checkpoints['DESCRIPTION']),
+        PipelineStage('DAY_SCHEDULE', 'llm',
+                      lambda executor, agents: submit_chunk(executor, PlanningModule.generate_day_schedules_with_places,
+                                                            agents, building_options, 0, day, llm_config,
+                                                            max_repair_attempts, **DAY_SCHEDULE_FIELDS),
+                      lambda result: result,
+                      checkpoints['DAY_SCHEDULE']),
+        PipelineStage('LOCATION_CHANGES', 'cpu',
+                      lambda executor, agents: submit_chunk(executor, PlanningModule.extend_with_location_changes,
+                                                            agents, shared_traffic_sim, **LOCATION_CHANGES_FIELDS),
+                      lambda result: (result[0], result[1], None),
+                      checkpoints['LOCATION_CHANGES']),
+        PipelineStage('ROUTE_DECISIONS', 'llm',
+                      lambda executor, agents: submit_chunk(executor, PlanningModule.add_routes, agents, 0,
+                                                            shared_traffic_sim, llm_config=llm_config,
+                                                            max_repair_attempts=max_repair_attempts,
+                                                            mode_choice_pack_size=mode_choice_pack_size,
+                                                            mode_choice_strategy=mode_choice_strategy,
+                                                            **ROUTES_FIELDS),
+                      lambda result: (result[0], [], result[1]),
+                      checkpoints['ROUTE_DECISIONS']),
+    ]
+
+    agents = load_or_generate_seeded_agents()
+    if deduplicate_seeds:
+        # keep replicas of the same seed in the same chunk so that they are generated together
+        agents = sorted(agents, key=lambda agent: agent.seed.get_content_key())
+
+    with ProcessPoolExecutor(max_workers=max_workers) as location_pool, shared_traffic_sim:
+        pools = {'llm': (inference_pool, max_workers), 'cpu': (location_pool, max_workers)}
+        pipeline = StreamingPipeline(stages, pools, pipeline_queue_size, infrastructure_exceptions)
+        final_agents = pipeline.run(agents, chunk_size)
+    failures.extend(failure for stage in stages for failure in stage.failures)
+    return final_agents
+
+
+# agents that raised in a stage on their own, the other agents of their chunks are run again without them
+failures = []
+# the offline backend needs the barriers, a stage has to be complete to know whether requests are pending
+if streaming_pipeline and not offline_path:
+    log_info('Running the stages as a streaming pipeline...')
+    final_agents = run_streaming_pipeline()
+else:
+    # with load_from_storage, every stage skips the agents it stored before, stage by stage or chunk by chunk
+    checkpoints = get_stage_checkpoints()
+    final_agents = load_or_generate_seeded_agents()
+
+    log_info('Initialising agents and enriching them with descriptions...')
+    final_agents, agents_without_description = ProfileModule.generate_descriptions_multithreaded(
+        final_agents,
+        max_workers,
+        exclude_too_young,
+        exclude_too_old,
+        llm_config,
+        deduplicate_seeds,
+        inference_pool,
+        max_repair_attempts,
+        chunk_size,
+        checkpoints['DESCRIPTION'],
+        failures,
+        infrastructure_exceptions)
+    stop_if_requests_pending('DESCRIPTION')
+
+    checkpoints['DESCRIPTION'].complete(final_agents, agents_without_description)
+    log_info(f'[DESCRIPTION] {len(agents_without_description)} agents without description.')
+    agents_without_description = None
+    log_info(f'[DESCRIPTION] {len(final_agents)} described agents.')
+
+    building_options = traffic_sim.get_building_categories()
+    log_info('Adding day schedules with the respective places to the agents...')
+    final_agents, agents_without_day_schedule = PlanningModule.generate_day_schedules_with_places_multithreaded(
+        final_agents,
+        building_options,
+        max_workers,
+        day,
+        llm_config,
+        inference_pool,
+        max_repair_attempts,
+        chunk_size,
+        checkpoints['DAY_SCHEDULE'],
+        failures,
+        infrastructure_exceptions)
+    stop_if_requests_pending('DAY_SCHEDULE')
+
+    checkpoints['DAY_SCHEDULE'].complete(final_agents, agents_without_day_schedule)
+    log_info(f'[DAY_SCHEDULE] {len(agents_without_day_schedule)} agents without day schedule.')
+    agents_without_day_schedule = None
+    log_info(f'[DAY_SCHEDULE] {len(final_agents)} agents with day schedule.')
+
+    log_info('Extracting location changes of agents...')
+    final_agents, agents_without_location_changes = PlanningModule.extend_with_location_changes_multithreaded(
+        final_agents, max_workers, traffic_sim, inference_pool, chunk_size, checkpoints['LOCATION_CHANGES'], failures,
+        infrastructure_exceptions)
+
+    checkpoints['LOCATION_CHANGES'].complete(final_agents, agents_without_location_changes)
+    log_info(f'[LOCATION_CHANGES] {len(agents_without_location_changes)} agents without location changes.')
+    agents_without_location_changes = None
+    log_info(f'[LOCATION_CHANGES] {len(final_agents)} agents with location changes.')
+
+    log_info('Adding routes...')
+    final_agents, agents_without_routes = PlanningModule.add_routes_multithreaded(
+        final_agents, max_workers, traffic_sim,
+        llm_config=llm_config,
+        inference_pool=inference_pool,
+        max_repair_attempts=max_repair_attempts,
+        mode_choice_pack_size=mode_choice_pack_size,
+        mode_choice_strategy=mode_choice_strategy,
+        chunk_size=chunk_size,
+        checkpoint=checkpoints['ROUTE_DECISIONS'],
+        failures=failures,
+        infrastructure_exceptions=infrastructure_exceptions)
+    stop_if_requests_pending('ROUTE_DECISIONS')
+    checkpoints['ROUTE_DECISIONS'].complete(final_agents, agents_without_routes)
+    log_info(f'[ROUTES] {len(agents_without_routes)} agents without routes.')
+
+storage.write_failures(failures)
+log_info(f'[FAILURES] {len(failures)} agents failed in a stage on their own, see {storage.failures_file_path}.')
 
-log_info('Initialising agents and enriching them with descriptions...')
-final_agents = ProfileModule.generate_seeded_agents(seed_generator, num_agents)
-final_agents, agents_without_description = ProfileModule.generate_descriptions_multithreaded(final_agents,
-                                                                                             max_workers,
-                                                                                             exclude_too_young,
-                                                                                             exclude_too_old)
-
-storage.write_agents(final_agents, '1_description')
-storage.write_agents(agents_without_description, '1_no_description')
-log_info(f'[DESCRIPTION] {len(final_agents)} described agents.')
-log_info(f'[DESCRIPTION] {len(agents_without_description)} agents without description.')
-agents_without_description = None
-
-log_info('Adding day schedules with the respective places to the agents...')
-building_options = traffic_sim.get_building_categories_string()
-final_agents, agents_without_day_schedule = PlanningModule.generate_day_schedules_with_places_multithreaded(
-    final_agents,
-    building_options,
-    max_workers,
-    day)
-
-storage.write_agents(final_agents, '2_day_schedule')
-storage.write_agents(agents_without_day_schedule, '2_no_day_schedule')
-log_info(f'[DAY_SCHEDULE] {len(final_agents)} agents with day schedule.')
-log_info(f'[DAY_SCHEDULE] {len(agents_without_day_schedule)} agents without day schedule.')
-agents_without_day_schedule = None
-
-log_info('Extracting location changes of agents...')
-final_agents, agents_without_location_changes = PlanningModule.extend_with_location_changes_multithreaded(
-    final_agents, max_workers, traffic_sim)
-
-storage.write_agents(final_agents, '3_location_changes')
-storage.write_agents(agents_without_location_changes, '3_no_location_changes')
-log_info(f'[LOCATION_CHANGES] {len(final_agents)} agents with location changes.')
-log_info(f'[LOCATION_CHANGES] {len(agents_without_location_changes)} agents without location changes.')
-agents_without_location_changes = None
-
-log_info('Adding routes...')
-final_agents = PlanningModule.add_routes_multithreaded(final_agents, max_workers, traffic_sim)
-
-storage.write_agents(final_agents, '4_route_descriptions')
 created_route_description_count = sum(len(agent.route_descriptions) for agent in final_agents)
 total_route_descriptions_count = sum(sum(1 for index in range(len(agent.day_schedule.task_list) - 1) if
                                          agent.day_schedule.task_list[index].building_type !=
@@ -95,7 +254,12 @@ route_descriptions = [route_description for agent in final_agents for route_desc
 trips_xml = generate_trips_xml(route_descriptions)
 storage.write_trips(trips_xml)
 
+llm_metrics = storage.write_llm_metrics()
+if llm_metrics:
+    log_merged_metrics(llm_metrics)
+
 log_info(f'[TIME] Total runtime: {timer.stop()}.')
 
+inference_pool.shutdown()
 traffic_sim.stop_sim()
 log_info('Finished traffic simulation.')
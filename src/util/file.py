@@ -7,6 +7,13 @@ def write_file(filename, content):
         f.write(content)
 
 
+def write_file_atomically(filename, content):
+    # a process killed while writing leaves the previous file (or none) instead of a truncated one
+    temporary_filename = f'{filename}.tmp'
+    write_file(temporary_filename, content)
+    os.replace(temporary_filename, filename)
+
+
 def read_file(file_path):
     with open(file_path, 'r') as file:
         return file.read()
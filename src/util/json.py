@@ -31,3 +31,36 @@ def extract_json_from_polluted_string(input_string):
                 # Unexpected closing brace, reset
                 stack = []
     raise json.JSONDecodeError("Invalid JSON format", input_string, len(input_string))
+
+
+def extract_keyed_values_from(input_string, keys):
+    """
+    Returns the values of the given top level keys that can be parsed from the string, also if the JSON object as a
+    whole is invalid or truncated (e.g. the value of the last key was cut off).
+    """
+    if not input_string:
+        return {}
+    try:
+        data = extract_json_from(input_string)
+        if isinstance(data, dict):
+            return {key: data[key] for key in keys if key in data}
+    except json.JSONDecodeError:
+        pass
+
+    decoder = json.JSONDecoder()
+    values = {}
+    for key in keys:
+        key_index = input_string.find(json.dumps(key))
+        if key_index < 0:
+            continue
+        value_index = input_string.find(':', key_index + len(json.dumps(key)))
+        if value_index < 0:
+            continue
+        value_index += 1
+        while value_index < len(input_string) and input_string[value_index].isspace():
+            value_index += 1
+        try:
+            values[key], _ = decoder.raw_decode(input_string, value_index)
+        except json.JSONDecodeError:
+            continue
+    return values
@@ -1,6 +1,2 @@
-from copy import deepcopy
-
-
-def split_list(a, n):
-    k, m = divmod(len(a), n)
-    return [deepcopy(a[i * k + min(i, m):(i + 1) * k + min(i + 1, m)]) for i in range(n)]
+def chunk_list(a, size):
+    return [a[i:i + size] for i in range(0, len(a), size)]
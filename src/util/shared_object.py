@@ -0,0 +1,57 @@
+import mmap
+import os
+import pickle
+import tempfile
+import uuid
+
+# objects created in this process (or inherited by forking) by the path of their file
+_created_objects = {}
+# the object a worker loaded last, a persistent worker drops it once the next stage shares a new one
+_loaded_object = {}
+
+
+class SharedObject:
+    """
+    Hands a large read-only object (e.g. the traffic simulation adapter with its buildings) to worker processes once
+    per process instead of once per task: the object is pickled to a file once, the tasks only carry its path and every
+    process loads the memory-mapped file on first use. Processes forked afterwards inherit the object without loading.
+    """
+
+    def __init__(self, obj, folder=None):
+        self.path = os.path.join(folder or tempfile.gettempdir(), f'shared_object_{uuid.uuid4().hex}.pkl')
+        temporary_path = f'{self.path}.tmp'
+        with open(temporary_path, 'wb') as file:
+            pickle.dump(obj, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_path, self.path)
+        _created_objects[self.path] = obj
+
+    def get(self):
+        if self.path in _created_objects:
+            return _created_objects[self.path]
+        if self.path not in _loaded_object:
+            _loaded_object.clear()
+            with open(self.path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+                _loaded_object[self.path] = pickle.loads(mapped_file)
+        return _loaded_object[self.path]
+
+    def close(self):
+        _created_objects.pop(self.path, None)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.path = state['path']
+
+
+def resolve_shared(obj):
+    """Returns the object behind a SharedObject, other objects are returned as they are."""
+    return obj.get() if isinstance(obj, SharedObject) else obj
@@ -1,12 +1,18 @@
 import json
+import os
+import shutil
+import time
 
+from llm.metrics import merge_worker_metrics
 from model.agent import Agent
-from util.file import write_file, read_file, remove_files_in, create_folders
+from util.file import write_file, write_file_atomically, read_file, remove_files_in, create_folders
+from util.logging import log_info, log_warning
 
 
 class Storage:
     def __init__(self, storage_path, load_from_storage=False):
         self.storage_path = storage_path
+        self.load_from_storage = load_from_storage
         if not load_from_storage:
             remove_files_in(self.storage_path)
 
@@ -16,12 +22,30 @@ class Storage:
 
         self.agents_file = 'agents.json'
 
+        # tells the files of this run (e.g. its worker metrics, its offline requests) from those of earlier runs
+        self.run_id = f'run_{time.strftime("%Y%m%d_%H%M%S")}_{os.getpid()}'
+
+        # the LLM workers write their metrics here, write_llm_metrics merges them. Every run has a folder of its own, a
+        # run with load_from_storage must not count the workers of the runs before
+        self.llm_metrics_path = f'{storage_path}/llm_metrics/{self.run_id}'
+        self.llm_metrics_file_path = f'{storage_path}/llm_metrics.json'
+        self.failures_file_path = f'{storage_path}/failures.json'
+
     def write_agents(self, agents, postfix):
         agents_str = json.dumps([agent.to_json() for agent in agents])
-        agents_file_path = f'{self.storage_path}/agents_{postfix}.json'
-        write_file(agents_file_path, agents_str)
+        agents_file_path = self.get_agents_file_path(postfix)
+        write_file_atomically(agents_file_path, agents_str)
         return agents_file_path
 
+    def get_agents_file_path(self, postfix):
+        return f'{self.storage_path}/agents_{postfix}.json'
+
+    def has_agents(self, postfix):
+        return os.path.exists(self.get_agents_file_path(postfix))
+
+    def read_agents(self, postfix):
+        return self.get_agents(self.get_agents_file_path(postfix))
+
     def get_agents(self, agents_file_path):
         agents_json = read_file(agents_file_path)
 
@@ -29,5 +53,128 @@ class Storage:
 
         return [Agent.from_json(agent_data) for agent_data in agents_data]
 
+    def get_chunks_folder(self, postfix):
+        return f'{self.storage_path}/chunks_{postfix}'
+
+    def write_chunk(self, passed_agents, failed_agents, postfix):
+        """Stores the agents of one finished chunk of a stage, named by the id of its first agent."""
+        agents = passed_agents + failed_agents
+        if not agents:
+            return None
+        create_folders(self.get_chunks_folder(postfix))
+        chunk_file_path = f'{self.get_chunks_folder(postfix)}/{agents[0].id}.json'
+        write_file_atomically(chunk_file_path, json.dumps({
+            'passed': [agent.to_json() for agent in passed_agents],
+            'failed': [agent.to_json() for agent in failed_agents],
+        }))
+        return chunk_file_path
+
+    def read_chunks(self, postfix):
+        """Returns the passed and failed agents of all stored chunks of a stage."""
+        passed_agents = []
+        failed_agents = []
+        chunks_folder = self.get_chunks_folder(postfix)
+        if not os.path.exists(chunks_folder):
+            return passed_agents, failed_agents
+        for file_name in sorted(os.listdir(chunks_folder)):
+            if not file_name.endswith('.json'):
+                continue
+            chunk = json.loads(read_file(f'{chunks_folder}/{file_name}'))
+            passed_agents.extend(Agent.from_json(agent_data) for agent_data in chunk['passed'])
+            failed_agents.extend(Agent.from_json(agent_data) for agent_data in chunk['failed'])
+        return passed_agents, failed_agents
+
+    def remove_chunks(self, postfix):
+        shutil.rmtree(self.get_chunks_folder(postfix), ignore_errors=True)
+
+    def write_failures(self, failures):
+        """Adds the AgentFailures of a run to failures.json, a resumed run keeps those of the runs before."""
+        failure_dicts = []
+        if os.path.exists(self.failures_file_path):
+            failure_dicts = json.loads(read_file(self.failures_file_path))
+        failure_dicts.extend(failure.to_dict() for failure in failures)
+        write_file_atomically(self.failures_file_path, json.dumps(failure_dicts, indent=2))
+
     def write_trips(self, trips_xml):
         write_file(self.trips_xml_path, trips_xml)
+
+    def write_llm_metrics(self):
+        if not os.path.exists(self.llm_metrics_path):
+            return None
+        worker_metrics = [json.loads(read_file(f'{self.llm_metrics_path}/{file_name}'))
+                          for file_name in sorted(os.listdir(self.llm_metrics_path)) if file_name.endswith('.json')]
+        metrics = merge_worker_metrics(worker_metrics)
+        write_file(self.llm_metrics_file_path, json.dumps(metrics, indent=2))
+        return metrics
+
+
+class StageCheckpoint:
+    """
+    Stores the agents of a stage chunk by chunk as they finish, so that a run that dies within the stage resumes with
+    the agents whose chunks are not stored yet (with load_from_storage). Once the stage is complete, its agents are
+    written to agents_<postfix>.json (and the failed ones to agents_<failed_postfix>.json) and the chunks are removed.
+    A stage with missing agents (e.g. of a killed run) or an incomplete previous stage is not written, a rerun retries
+    the missing agents.
+    """
+
+    def __init__(self, storage, stage, postfix, failed_postfix=None, commit_chunks=True, previous=None, resume=None):
+        self.storage = storage
+        # by default a stage resumes whenever the storage is loaded
+        self.resume = storage.load_from_storage if resume is None else resume
+        self.stage = stage
+        self.postfix = postfix
+        self.failed_postfix = failed_postfix
+        self.commit_chunks = commit_chunks
+        self.previous = previous
+        self.stored = False
+        self.input_ids = set()
+        self.passed_ids = set()
+
+    def restore(self, agents):
+        """Returns the agents the stage still has to process and the passed and failed agents stored already."""
+        self.input_ids = {agent.id for agent in agents}
+        if not self.resume:
+            # chunks of an earlier run must not mix with the ones of this run
+            self.storage.remove_chunks(self.postfix)
+            return agents, [], []
+        if self.storage.has_agents(self.postfix):
+            self.stored = True
+            passed_agents = self.storage.read_agents(self.postfix)
+            failed_agents = self.storage.read_agents(self.failed_postfix) \
+                if self.failed_postfix and self.storage.has_agents(self.failed_postfix) else []
+            self.passed_ids = {agent.id for agent in passed_agents}
+            log_info(f'[CHECKPOINT] [{self.stage}] Loaded {len(passed_agents)} passed and {len(failed_agents)} failed '
+                     f'agents from {self.storage.get_agents_file_path(self.postfix)}.')
+            return [], passed_agents, failed_agents
+
+        passed_agents, failed_agents = self.storage.read_chunks(self.postfix)
+        done_ids = {agent.id for agent in passed_agents + failed_agents}
+        remaining_agents = [agent for agent in agents if agent.id not in done_ids]
+        if done_ids:
+            log_info(f'[CHECKPOINT] [{self.stage}] Restored {len(passed_agents)} passed and {len(failed_agents)} '
+                     f'failed agents from stored chunks, {len(remaining_agents)} agents left.')
+        return remaining_agents, passed_agents, failed_agents
+
+    def commit(self, passed_agents, failed_agents):
+        if self.commit_chunks:
+            self.storage.write_chunk(passed_agents, failed_agents, self.postfix)
+
+    def complete(self, passed_agents, failed_agents):
+        if self.stored:
+            return
+        if self.previous is not None and not self.previous.stored:
+            log_warning(f'[CHECKPOINT] [{self.stage}] Not stored, as the previous stage is incomplete.')
+            return
+        # the agents passed by the previous stage, or given to restore by the first one
+        input_ids = self.previous.passed_ids if self.previous is not None else self.input_ids
+        missing_ids = input_ids - {agent.id for agent in passed_agents + failed_agents}
+        if missing_ids:
+            log_warning(f'[CHECKPOINT] [{self.stage}] Not stored, {len(missing_ids)} agents of failed chunks are '
+                        f'missing. A rerun with load_from_storage retries them.')
+            return
+        self.storage.write_agents(passed_agents, self.postfix)
+        if self.failed_postfix:
+            self.storage.write_agents(failed_agents, self.failed_postfix)
+        self.storage.remove_chunks(self.postfix)
+        self.stored = True
+        self.passed_ids = {agent.id for agent in passed_agents}
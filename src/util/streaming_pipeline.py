@@ -0,0 +1,129 @@
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+
+from llm.inference_pool import INFRASTRUCTURE_EXCEPTIONS, get_failed_agents, log_failures, split_failed_chunk
+from llm.repair import log_repair_stats, merge_repair_stats
+from util.list import chunk_list
+from util.logging import log_info
+from util.time import Timer
+
+
+class PipelineStage:
+    """
+    One stage of a StreamingPipeline. submit(executor, agents) submits the stage for a chunk of agents to the executor
+    of its pool and returns the future, collect(result) turns the result of the future into the passed agents, the
+    failed agents and the repair stats (or None). A chunk that raises is split and queued again, the agents that raise
+    on their own are failed agents of the stage and their AgentFailure is kept in failures. With a StageCheckpoint,
+    the stage restores the agents it stored before, stores every finished chunk and writes its agents once the last
+    chunk is done.
+    """
+
+    def __init__(self, name, pool, submit, collect, checkpoint=None):
+        self.name = name
+        self.pool = pool
+        self.submit = submit
+        self.collect = collect
+        self.checkpoint = checkpoint
+
+        self.queue = deque()
+        self.in_flight = 0
+        self.passed_agents = []
+        self.failed_agents = []
+        self.failures = []
+        self.repair_stats = None
+        self.completed = False
+
+
+class StreamingPipeline:
+    """
+    Runs the stages on chunks of agents instead of one barrier per stage: a chunk moves on to the next stage as soon
+    as it left the previous one, so that e.g. the location choice and routing of the first chunks overlap the
+    inference of the later ones, and no stage waits for the slowest worker of the previous one.
+
+    Every pool (name -> (executor, capacity)) runs at most capacity chunks at once, the later stages first, so that
+    chunks leave the pipeline before new ones enter. A stage only starts a chunk while the queue of the next stage
+    holds fewer than queue_size chunks (backpressure), which bounds the agents waiting between the stages.
+    """
+
+    def __init__(self, stages, pools, queue_size=2, infrastructure_exceptions=INFRASTRUCTURE_EXCEPTIONS):
+        self.stages = stages
+        self.pools = pools
+        self.queue_size = queue_size
+        self.infrastructure_exceptions = infrastructure_exceptions
+
+    def run(self, agents, chunk_size):
+        """
+        Runs the agents in chunks of chunk_size through the stages and returns the agents passing all. The agents a
+        stage restores from its checkpoint skip the stage, the passed ones enter the next stage right away.
+        """
+        timer = Timer()
+        timer.start()
+        stages = self.stages
+        for stage in stages:
+            if stage.checkpoint is not None:
+                agents, stage.passed_agents, stage.failed_agents = stage.checkpoint.restore(agents)
+            stage.queue.extend(chunk_list(agents, chunk_size))
+            agents = list(stage.passed_agents)
+        pool_in_flight = {pool: 0 for pool in self.pools}
+        futures = {}
+
+        while futures or any(stage.queue for stage in stages):
+            # the later stages come first, their chunks are closest to leaving the pipeline
+            for index in reversed(range(len(stages))):
+                stage = stages[index]
+                next_stage = stages[index + 1] if index + 1 < len(stages) else None
+                executor, capacity = self.pools[stage.pool]
+                while stage.queue and pool_in_flight[stage.pool] < capacity and \
+                        (next_stage is None or len(next_stage.queue) < self.queue_size):
+                    chunk = stage.queue.popleft()
+                    futures[stage.submit(executor, chunk)] = index, chunk
+                    stage.in_flight += 1
+                    pool_in_flight[stage.pool] += 1
+
+            if not futures:
+                break
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, chunk = futures.pop(future)
+                stage = stages[index]
+                stage.in_flight -= 1
+                pool_in_flight[stage.pool] -= 1
+                try:
+                    passed_agents, failed_agents, repair_stats = stage.collect(future.result())
+                except Exception as e:
+                    chunk_failures = []
+                    # the halves go first, their agents have waited longest
+                    stage.queue.extendleft(reversed(split_failed_chunk(stage.name, chunk, e, chunk_failures,
+                                                                       self.infrastructure_exceptions)))
+                    passed_agents, failed_agents, repair_stats = [], get_failed_agents(chunk_failures), None
+                    stage.failures.extend(chunk_failures)
+                stage.passed_agents.extend(passed_agents)
+                stage.failed_agents.extend(failed_agents)
+                if stage.checkpoint is not None:
+                    stage.checkpoint.commit(passed_agents, failed_agents)
+                if repair_stats is not None:
+                    stage.repair_stats = merge_repair_stats(stage.repair_stats or {}, repair_stats)
+                if index + 1 < len(stages) and passed_agents:
+                    stages[index + 1].queue.append(passed_agents)
+
+            self._complete_stages(stages, timer)
+
+        self._complete_stages(stages, timer)
+        return stages[-1].passed_agents
+
+    @staticmethod
+    def _complete_stages(stages, timer):
+        # a stage is complete once all stages before it are and it has no chunks left
+        for index, stage in enumerate(stages):
+            if stage.completed:
+                continue
+            if (index > 0 and not stages[index - 1].completed) or stage.queue or stage.in_flight:
+                break
+            stage.completed = True
+            log_info(f'[PIPELINE] [{stage.name}] Completed after {timer.stop()} with {len(stage.passed_agents)} '
+                     f'passed and {len(stage.failed_agents)} failed agents.')
+            log_failures(stage.failures)
+            if stage.repair_stats is not None:
+                log_repair_stats(stage.name, stage.repair_stats)
+            if stage.checkpoint is not None:
+                stage.checkpoint.complete(stage.passed_agents, stage.failed_agents)